@@ -0,0 +1,2 @@
+from .fake_tdjson import FakeTDJson
+from .harness import Bench, format_report
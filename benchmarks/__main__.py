@@ -0,0 +1,85 @@
+import sys
+import argparse
+import subprocess
+
+from src.luagram.runtime import LUA_VERSION, LUA_VERSIONS
+
+from .harness import Bench, format_report, dumps
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for item in value.split(','):
+        update_type, _, weight = item.partition(':')
+        mix[update_type.strip()] = float(weight or 1)
+
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Luagram offline benchmarks')
+
+    parser.add_argument('--lua', '-l',
+                        help='Lua version, or "all" to run each one in its own process',
+                        default=LUA_VERSION, choices=list(LUA_VERSIONS) + ['all'])
+
+    parser.add_argument('--queries', '-q',
+                        help='Number of queries sent through client.batch', type=int, default=10000)
+
+    parser.add_argument('--concurrency', '-c',
+                        help='Queries in flight at once', type=int, default=100)
+
+    parser.add_argument('--updates', '-u',
+                        help='Number of synthetic updates', type=int, default=20000)
+
+    parser.add_argument('--rate', '-r',
+                        help='Updates per second, 0 is as fast as possible', type=float, default=0)
+
+    parser.add_argument('--mix', '-m',
+                        help='Update type mix as type:weight,...', type=parse_mix, default='updateNewMessage:1')
+
+    parser.add_argument('--payload', '-p',
+                        help='Filler bytes in every answer and update', type=int, default=64)
+
+    parser.add_argument('--workers', '-w',
+                        help='Dispatcher workers for get_updates', type=int, default=0)
+
+    parser.add_argument('--setting', '-s',
+                        help='Extra Settings field as lua, e.g. -s multiplexed=true', action='append', default=[])
+
+    parser.add_argument('--idle-timeout',
+                        help='Seconds without a handled update before the run ends anyway', type=float, default=10)
+
+    parser.add_argument('--json',
+                        help='Print one JSON report per line', action='store_true')
+
+    arguments = parser.parse_args()
+
+    if arguments.lua == 'all':
+        # lupa can not host every Lua version in one process
+        argv = sys.argv[1:]
+        for version in LUA_VERSIONS:
+            command = [sys.executable, '-m', 'benchmarks'] + argv + ['--lua', version]
+            if subprocess.call(command) != 0:
+                return 1
+
+        return 0
+
+    bench = Bench(arguments.lua,
+                  queries=arguments.queries,
+                  concurrency=arguments.concurrency,
+                  updates=arguments.updates,
+                  rate=arguments.rate,
+                  mix=arguments.mix,
+                  payload_size=arguments.payload,
+                  workers=arguments.workers,
+                  settings=arguments.setting,
+                  idle_timeout=arguments.idle_timeout)
+
+    report = bench.run()
+    print(dumps(report) if arguments.json else format_report(report), flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
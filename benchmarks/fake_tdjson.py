@@ -0,0 +1,166 @@
+import json
+import time
+import queue
+import random
+import itertools
+import threading
+from typing import Optional, Dict, List, Tuple
+
+
+class FakeFunction:
+    """A callable that accepts the `restype`/`argtypes` ctypes assigns to it."""
+
+    def __init__(self, function) -> None:
+        self.function = function
+        self.restype = None
+        self.argtypes = None
+
+    def __call__(self, *args):
+        return self.function(*args)
+
+
+class FakeTDJson:
+    """
+    Offline stand-in for libtdjson, shaped like the `CDLL` TDJson loads.
+
+    Every query is answered at once: `getAuthorizationState` with
+    `authorizationStateReady`, anything else with an `ok` echoing its
+    `@extra` plus `payload_size` bytes of filler. `generate` streams
+    synthetic updates at a given rate and type mix. Both the single client
+    (`td_json_client_*`) and the multiplexed (`td_*`) interfaces are served.
+    """
+
+    def __init__(self, payload_size: int = 0, seed: int = 0) -> None:
+        self.payload = 'x' * payload_size
+        self.random = random.Random(seed)
+
+        self._ids = itertools.count(1)
+        self._queues: Dict[int, queue.SimpleQueue] = {}
+        self._shared = queue.SimpleQueue()
+
+        for name in ('td_json_client_create', 'td_json_client_receive', 'td_json_client_send',
+                     'td_json_client_execute', 'td_json_client_destroy', 'td_create_client_id',
+                     'td_receive', 'td_send', 'td_execute', 'td_set_log_verbosity_level',
+                     'td_set_log_fatal_error_callback'):
+            setattr(self, name, FakeFunction(getattr(self, '_' + name)))
+
+    def __call__(self, library_path: Optional[str] = None) -> 'FakeTDJson':
+        # stands in for ctypes.CDLL
+        return self
+
+    def answer(self, data: bytes, client_id: Optional[int] = None) -> bytes:
+        query = json.loads(data)
+
+        if query.get('@type') == 'getAuthorizationState':
+            result = {'@type': 'authorizationStateReady'}
+
+        elif query.get('@type') == 'close':
+            result = {'@type': 'updateAuthorizationState',
+                      'authorization_state': {'@type': 'authorizationStateClosed'}}
+
+        else:
+            result = {'@type': 'ok', 'payload': self.payload}
+
+        if '@extra' in query:
+            result['@extra'] = query['@extra']
+
+        if client_id is not None:
+            result['@client_id'] = client_id
+
+        return json.dumps(result, separators=(',', ':')).encode()
+
+    def update(self, update_type: str, client_id: Optional[int] = None) -> bytes:
+        update = {
+            '@type': update_type,
+            'chat_id': self.random.randrange(1, 1000),
+            'message': {
+                '@type': 'message',
+                'id': self.random.randrange(1, 1 << 40),
+                'content': {'@type': 'messageText', 'text': {'@type': 'formattedText', 'text': self.payload}}
+            },
+            '@bench_ts': time.perf_counter()
+        }
+
+        if client_id is not None:
+            update['@client_id'] = client_id
+
+        return json.dumps(update, separators=(',', ':')).encode()
+
+    def generate(self,
+                 client_id: int,
+                 count: int,
+                 rate: float = 0,
+                 mix: Optional[List[Tuple[str, float]]] = None,
+                 multiplexed: bool = False) -> threading.Thread:
+        """Push `count` updates at `rate` per second (0 is unthrottled) from a background thread."""
+        mix = mix or [('updateNewMessage', 1.0)]
+        types = [update_type for update_type, _ in mix]
+        weights = [weight for _, weight in mix]
+        target = self._shared if multiplexed else self._queues[client_id]
+
+        def run():
+            started = time.perf_counter()
+            for index, update_type in enumerate(self.random.choices(types, weights, k=count)):
+                if rate:
+                    delay = started + index / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                target.put(self.update(update_type, client_id if multiplexed else None))
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _get(source: Optional[queue.SimpleQueue], timeout: float) -> Optional[bytes]:
+        if source is None:
+            # destroyed while a receive was pending
+            return None
+
+        try:
+            return source.get(timeout=timeout) if timeout > 0 else source.get_nowait()
+
+        except queue.Empty:
+            return None
+
+    # single client interface
+
+    def _td_json_client_create(self) -> int:
+        client = next(self._ids)
+        self._queues[client] = queue.SimpleQueue()
+        return client
+
+    def _td_json_client_receive(self, client: int, timeout: float) -> Optional[bytes]:
+        return self._get(self._queues.get(client), timeout)
+
+    def _td_json_client_send(self, client: int, data: bytes) -> None:
+        self._queues[client].put(self.answer(data))
+
+    def _td_json_client_execute(self, client: int, data: bytes) -> bytes:
+        return self.answer(data)
+
+    def _td_json_client_destroy(self, client: int) -> None:
+        self._queues.pop(client, None)
+
+    # multiplexed interface
+
+    def _td_create_client_id(self) -> int:
+        return next(self._ids)
+
+    def _td_receive(self, timeout: float) -> Optional[bytes]:
+        return self._get(self._shared, timeout)
+
+    def _td_send(self, client_id: int, data: bytes) -> None:
+        self._shared.put(self.answer(data, client_id))
+
+    def _td_execute(self, data: bytes) -> bytes:
+        return self.answer(data)
+
+    # logging
+
+    def _td_set_log_verbosity_level(self, level: int) -> None:
+        pass
+
+    def _td_set_log_fatal_error_callback(self, callback) -> None:
+        pass
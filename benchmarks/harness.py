@@ -0,0 +1,289 @@
+import json
+import time
+import functools
+import threading
+from typing import Dict, List, Optional
+
+from src.luagram.gadget import tdjson
+from src.luagram.loop import current_loop
+from src.luagram.runtime import Script
+
+from .fake_tdjson import FakeTDJson
+
+
+SCRIPT = '''
+client = create_new_client{
+    name = name,
+    params = Params{api_id = 1, api_hash = 'bench', database_encryption_key = 'bench'},
+    settings = Settings{%(settings)s},
+    library_path = 'libtdjson-fake.so'
+}
+
+-- workers load the script again, only the first run drives the benchmark
+if worker == nil then
+    client.start{}
+    bench.ready(client)
+
+    local queries = {}
+    for i = 1, bench.queries do
+        queries[i] = {['@type'] = 'getMessages', chat_id = i, message_ids = {i, i + 1, i + 2}}
+    end
+
+    bench.mark('queries')
+    client.batch{queries = queries, concurrency = bench.concurrency}
+    bench.mark('queries')
+
+    bench.generate()
+end
+
+local function on_update(update)
+    local text = update.message.content.text.text
+    bench.received()
+end
+
+client.get_updates{handlers = {{on_update, bench.types}}, workers = bench.workers}
+'''
+
+
+def percentiles(values: List[float], points=(50, 90, 99, 100)) -> Dict[str, float]:
+    if not values:
+        return {}
+
+    values = sorted(values)
+    return {'p%s' % point: values[min(len(values) - 1, len(values) * point // 100)] for point in points}
+
+
+class Stage:
+    __slots__ = ('calls', 'cpu', '_lock')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.cpu = 0
+        self._lock = threading.Lock()
+
+    def add(self, cpu: int) -> None:
+        with self._lock:
+            self.cpu += cpu
+            self.calls += 1
+
+
+class Bench:
+    """Drive one benchmark run of a Lua script against `FakeTDJson`, exposed to Lua as `bench`."""
+
+    def __init__(self,
+                 version: str,
+                 queries: int = 10000,
+                 concurrency: int = 100,
+                 updates: int = 20000,
+                 rate: float = 0,
+                 mix: Optional[Dict[str, float]] = None,
+                 payload_size: int = 64,
+                 workers: int = 0,
+                 settings: Optional[List[str]] = None,
+                 idle_timeout: float = 10) -> None:
+
+        self.version = version
+        self.queries = queries
+        self.concurrency = concurrency
+        self.updates = updates
+        self.rate = rate
+        self.mix = mix or {'updateNewMessage': 1.0}
+        self.types = list(self.mix)
+        self.workers = workers
+        self.settings = settings or []
+        self.idle_timeout = idle_timeout
+
+        self.library = FakeTDJson(payload_size=payload_size)
+        self.client = None
+        self.marks: Dict[str, List[float]] = {}
+        self.stages: Dict[str, Stage] = {}
+        self.query_latency: List[float] = []
+        self.update_latency: List[float] = []
+        self._received = 0
+        self._received_lock = threading.Lock()
+        self._finished = False
+        # updates the queue dropped or merged, they never reach a handler
+        self.lost = 0
+
+    def run(self) -> dict:
+        tdjson.CDLL = self.library
+
+        settings = ', '.join(['updates_queue_size = %s' % (self.updates + self.queries + 16)] + self.settings)
+        script = Script('bench', SCRIPT % {'settings': settings}, version=self.version)
+        script.create_runtime = self._with_globals(script.create_runtime)
+        script.execute()
+        return self.report()
+
+    def _with_globals(self, create_runtime):
+        @functools.wraps(create_runtime)
+        def wrapper(*args, **kwargs):
+            lua_runtime = create_runtime(*args, **kwargs)
+            lua_runtime.globals().bench = self
+            return lua_runtime
+
+        return wrapper
+
+    # called from Lua
+
+    def ready(self, client) -> None:
+        self.client = client
+
+        self._stage(client._tdjson, 'send', 'send')
+        self._stage(client._tdjson.codec, 'loads', 'decode')
+        self._stage(client._tdjson.codec, 'dumps', 'encode')
+        self._stage(client, '_to_query', 'lua_encode')
+        self._stage(client._dispatcher, 'dispatch', 'dispatch', latency=self.update_latency)
+
+        create_worker_dispatcher = client._create_worker_dispatcher
+
+        @functools.wraps(create_worker_dispatcher)
+        def timed_worker_dispatcher(*args, **kwargs):
+            dispatcher = create_worker_dispatcher(*args, **kwargs)
+            self._stage(dispatcher, 'dispatch', 'dispatch', latency=self.update_latency)
+            return dispatcher
+
+        client._create_worker_dispatcher = timed_worker_dispatcher
+
+        send_query = client._send_query
+
+        @functools.wraps(send_query)
+        def timed_send_query(*args, **kwargs):
+            started = time.perf_counter()
+            result = send_query(*args, **kwargs)
+            result.on_done(lambda _: self.query_latency.append(time.perf_counter() - started))
+            return result
+
+        client._send_query = timed_send_query
+
+    def received(self) -> None:
+        with self._received_lock:
+            self._received += 1
+
+        if self._settled():
+            self._finish()
+
+    def _settled(self) -> bool:
+        queue = self.client._updates_queue
+        self.lost = queue.dropped + queue.coalesced
+        return self._received + self.lost >= self.updates
+
+    def _finish(self) -> None:
+        with self._received_lock:
+            if self._finished:
+                return
+
+            self._finished = True
+
+        self.mark('updates')
+        self.client.stop()
+
+    def _watch(self, generator: threading.Thread) -> None:
+        # the last updates may be dropped rather than received, or lost elsewhere
+        generator.join()
+        seen, idle_since = -1, time.monotonic()
+
+        while not self._finished:
+            if self._settled():
+                return self._finish()
+
+            if self._received != seen:
+                seen, idle_since = self._received, time.monotonic()
+
+            elif time.monotonic() - idle_since > self.idle_timeout:
+                self.lost = self.updates - self._received
+                return self._finish()
+
+            time.sleep(0.05)
+
+    def mark(self, name: str) -> None:
+        self.marks.setdefault(name, []).append(time.perf_counter())
+
+    def generate(self) -> None:
+        # queued as a task, it runs once get_updates has registered the handlers,
+        # so `prefilter_updates` does not drop the generated updates
+        current_loop().call_soon(self._generate)
+
+    def _generate(self) -> None:
+        self.mark('updates')
+        multiplexed = self.client.settings.multiplexed
+        client_id = self.client._tdjson.client_id if multiplexed else self.client._tdjson.td_json_client
+        generator = self.library.generate(client_id,
+                                          count=self.updates,
+                                          rate=self.rate,
+                                          mix=list(self.mix.items()),
+                                          multiplexed=multiplexed)
+
+        threading.Thread(target=self._watch, args=(generator,), daemon=True).start()
+
+    # instrumentation
+
+    def _stage(self, target, attribute: str, name: str, latency: Optional[list] = None) -> None:
+        function = getattr(target, attribute)
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage()
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if latency is not None:
+                stamp = args[0].get('@bench_ts') if args and isinstance(args[0], dict) else None
+                if stamp is not None:
+                    latency.append(time.perf_counter() - stamp)
+
+            started = time.thread_time_ns()
+            try:
+                return function(*args, **kwargs)
+
+            finally:
+                stage.add(time.thread_time_ns() - started)
+
+        setattr(target, attribute, timed)
+
+    def report(self) -> dict:
+        report = {'lua': self.version, 'settings': self.settings}
+
+        for name, count, latency in (('queries', self.queries, self.query_latency),
+                                     ('updates', self.updates, self.update_latency)):
+            marks = self.marks.get(name, [])
+            elapsed = marks[-1] - marks[0] if len(marks) > 1 else None
+            report[name] = {
+                'count': count,
+                'seconds': elapsed,
+                'per_second': count / elapsed if elapsed else None,
+                'latency': percentiles(latency)
+            }
+
+        report['updates']['lost'] = self.lost
+
+        report['cpu'] = {name: {'calls': stage.calls,
+                                'seconds': stage.cpu / 1e9,
+                                'per_call_us': stage.cpu / 1e3 / stage.calls if stage.calls else None}
+                         for name, stage in self.stages.items()}
+        return report
+
+
+def format_report(report: dict) -> str:
+    lines = ['lua %s %s' % (report['lua'], ' '.join(report['settings']))]
+
+    for name in ('queries', 'updates'):
+        result = report[name]
+        latency = ' '.join('%s=%.3fms' % (point, value * 1e3) for point, value in result['latency'].items())
+        if result['seconds']:
+            lines.append('  %-8s %8d in %7.3fs %10.0f/s  %s' % (name, result['count'], result['seconds'],
+                                                                 result['per_second'], latency))
+            if result.get('lost'):
+                lines.append('  %-8s %8d dropped or coalesced' % ('', result['lost']))
+
+        else:
+            lines.append('  %-8s did not complete' % name)
+
+    for name, stage in report['cpu'].items():
+        if stage['calls']:
+            lines.append('  cpu %-10s %8d calls %7.3fs %8.2fus/call' % (name, stage['calls'], stage['seconds'],
+                                                                      stage['per_call_us']))
+
+    return '\n'.join(lines)
+
+
+def dumps(report: dict) -> str:
+    return json.dumps(report, sort_keys=True)
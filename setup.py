@@ -30,6 +30,7 @@ keywords = [
     'telegram-mtproto'
 ]
 requirements = ['lupa>=2.2']
+extras = {'fast': ['orjson>=3']}
 
 
 setup(
@@ -42,6 +43,7 @@ setup(
     author='Milad Heidary',
     description='lua telegram client',
     install_requires=requirements,
+    extras_require=extras,
     python_requires='>=3',
     entry_points={'console_scripts': ['luagram=src.__main__:main']},
     zip_safe=False,
@@ -1,23 +1,44 @@
 import os
-import lupa
+import signal
+import logging
 import argparse
-import importlib
-from .luagram import LuagramClient, Params, Settings, BaseLogger, enums
+import threading
+from .luagram.runtime import Script, LUA_VERSION, LUA_VERSIONS
+from .luagram.supervisor import Supervisor, load_manifest
+from .luagram.journal import Replay
 
 
-LUA_VERSION = os.getenv('LUAGRAM_LUA_VERSION', 'jit')
+if not os.path.isdir('.app-data'):
+    os.makedirs('.app-data')
 
-__LUA_VERSIONS = {
-    '5.1': 'lupa.lua51',
-    '5.2': 'lupa.lua52',
-    '5.3': 'lupa.lua53',
-    '5.4': 'lupa.lua54',
-    'jit': 'lupa.luajit21'
-}
 
+def on_signal(signum: int, callback) -> None:
+    """
+    Run `callback` whenever `signum` arrives. The handler only writes to a
+    pipe, taking locks inside it could deadlock the interrupted thread, so
+    `callback` runs on a thread of its own.
+    """
+    read_fd, write_fd = os.pipe()
+    os.set_blocking(write_fd, False)
 
-if not os.path.isdir('.app-data'):
-    os.makedirs('.app-data')
+    def notify(*_) -> None:
+        try:
+            os.write(write_fd, b'\0')
+
+        except BlockingIOError:
+            # plenty of wakeups are already pending
+            pass
+
+    def run() -> None:
+        while os.read(read_fd, 1):
+            try:
+                callback()
+
+            except Exception:
+                logging.exception('signal %s', signum)
+
+    threading.Thread(target=run, name='luagram-signal-%s' % signum, daemon=True).start()
+    signal.signal(signum, notify)
 
 
 def main():
@@ -25,33 +46,75 @@ def main():
 
 
     parser.add_argument('--name', '-n',
-                        help='Session name', required=True)
+                        help='Session name')
 
     parser.add_argument('--script', '-s',
                         help='Path to the Lua script file',
-                        type=argparse.FileType('r'), required=True)
+                        type=argparse.FileType('r'))
     
     parser.add_argument('--version', '-v',
-                        help='Lua Version', default=LUA_VERSION, choices=__LUA_VERSIONS.keys())
+                        help='Lua Version', default=LUA_VERSION, choices=LUA_VERSIONS.keys())
+
+    parser.add_argument('--manifest', '-m',
+                        help='Path to a JSON manifest of sessions to supervise')
+
+    parser.add_argument('--workers', '-w',
+                        help='Worker processes for the manifest (default: one per CPU core)', type=int, default=0)
+
+    parser.add_argument('--stats-interval',
+                        help='Seconds between stats reports of the supervisor', type=float, default=30)
+
+    parser.add_argument('--replay',
+                        help='Feed the journal recorded under .app-data/<client name> to the handlers instead of TDLib',
+                        action='store_true')
+
+    parser.add_argument('--reload',
+                        help='Reload the script when its file changes or on SIGHUP, keeping the TDLib sessions',
+                        action='store_true')
+
+    parser.add_argument('--profile',
+                        help='Toggle the Lua profiler on SIGUSR1, writing collapsed stacks to this path when it stops')
+
+    parser.add_argument('--speed',
+                        help='Replay pacing relative to the recording, 0 replays as fast as possible', type=float, default=1)
 
     
     arguments = parser.parse_args()
-    with lupa.allow_lua_module_loading():
-        LUA = importlib.import_module(__LUA_VERSIONS[arguments.version])
 
-    lua_runtime = LUA.LuaRuntime(unpack_returned_tuples=True)
-    variables = lua_runtime.globals()
-    variables.name = arguments.name
+    if arguments.manifest:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+        supervisor = Supervisor(load_manifest(arguments.manifest),
+                                workers=arguments.workers,
+                                stats_interval=arguments.stats_interval)
+        return supervisor.run()
+
+    if not arguments.name or not arguments.script:
+        parser.error('--name and --script are required without --manifest')
 
-    variables.enums = enums
-    variables.Params = Params
-    variables.Settings = Settings
-    variables.BaseLogger = BaseLogger
-    variables.create_new_client = LuagramClient
+    script = Script(arguments.name,
+                    arguments.script.read(),
+                    version=arguments.version,
+                    path=arguments.script.name)
 
-    return lua_runtime.execute(arguments.script.read())
+    if arguments.replay:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+        return Replay(script, speed=arguments.speed).run()
+
+    if arguments.profile:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+        script.profiling.path = arguments.profile
+        if hasattr(signal, 'SIGUSR1'):
+            on_signal(signal.SIGUSR1, script.profiling.toggle)
+
+    if arguments.reload:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+        if hasattr(signal, 'SIGHUP'):
+            on_signal(signal.SIGHUP, script.request_reload)
+
+        script.watch()
+
+    return script.execute()
 
 
 if __name__ == '__main__':
     main()
-
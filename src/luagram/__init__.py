@@ -1,2 +1,3 @@
 from . import enums
-from .luagram import LuagramClient, Params, Settings, BaseLogger
\ No newline at end of file
+from .luagram import LuagramClient, Params, Settings, BaseLogger
+from .runtime import Script
\ No newline at end of file
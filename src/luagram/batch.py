@@ -0,0 +1,73 @@
+import queue
+from typing import TYPE_CHECKING, Optional, List
+
+from .loop import current_loop
+from .response import Response
+
+
+if TYPE_CHECKING:
+    from .luagram import LuagramClient
+
+
+class Batch:
+    """
+    Submit many queries keeping at most `concurrency` of them in flight.
+
+    Queries are sent from the consuming thread: every finished result frees a
+    slot that is refilled before the next result is handed out. A failed
+    query only marks its own `Response` as an error, the rest of the batch
+    goes on.
+    """
+
+    def __init__(self,
+                 client: 'LuagramClient',
+                 queries: List[dict],
+                 concurrency: int = 0,
+                 timeout: Optional[float] = None) -> None:
+
+        self.client = client
+        self.queries = queries
+        self.timeout = timeout
+        self.concurrency = concurrency if concurrency > 0 else len(queries)
+
+        self.results: List[Optional[Response]] = [None] * len(queries)
+        self._sent = 0
+        self._received = 0
+        self._completed = queue.SimpleQueue()
+
+    def __len__(self) -> int:
+        return len(self.queries)
+
+    def __call__(self, *args):
+        """Lua generic-for iterator: `for index, result in batch do ... end`."""
+        index = self.next()
+        if index is not None:
+            return index + 1, self.results[index]
+
+    def next(self) -> Optional[int]:
+        """Index of the next finished query, None when the batch is exhausted."""
+        if self._received >= len(self.queries):
+            return None
+
+        self._fill()
+        index = self._completed.get()
+        self._received += 1
+        return index
+
+    def wait(self) -> List[Response]:
+        while self.next() is not None:
+            pass
+
+        return self.results
+
+    def _fill(self) -> None:
+        while self._sent < len(self.queries) and self._sent - self._received < self.concurrency:
+            index = self._sent
+            self._sent += 1
+
+            result = self.client._send_query(self.queries[index], block=False, timeout=self.timeout)
+            self.results[index] = result
+            result.on_done(lambda _, index=index: self._completed.put(index))
+
+    def table(self):
+        return current_loop().table(self.results)
@@ -0,0 +1,266 @@
+import threading
+import collections
+from typing import Optional, Dict, Tuple, Hashable
+
+from .gadget.tools import copy_json
+
+
+# objects TDLib pushes or returns whole: @type -> kind
+OBJECTS: Dict[str, str] = {
+    'chat': 'chat',
+    'user': 'user',
+    'supergroup': 'supergroup',
+    'basicGroup': 'basic_group',
+    'message': 'message'
+}
+
+# updates carrying a whole object: @type -> field holding it
+CARRIERS: Dict[str, str] = {
+    'updateNewChat': 'chat',
+    'updateUser': 'user',
+    'updateSupergroup': 'supergroup',
+    'updateBasicGroup': 'basic_group',
+    'updateNewMessage': 'message',
+    'updateMessageSendSucceeded': 'message',
+    'updateMessageSendFailed': 'message'
+}
+
+# updates changing fields of a cached chat or user: @type -> (kind, id field, {update field: object field})
+PATCHES: Dict[str, Tuple[str, str, Dict[str, str]]] = {
+    'updateChatTitle': ('chat', 'chat_id', {'title': 'title'}),
+    'updateChatPhoto': ('chat', 'chat_id', {'photo': 'photo'}),
+    'updateChatPermissions': ('chat', 'chat_id', {'permissions': 'permissions'}),
+    'updateChatLastMessage': ('chat', 'chat_id', {'last_message': 'last_message', 'positions': 'positions'}),
+    'updateChatReadInbox': ('chat', 'chat_id', {'last_read_inbox_message_id': 'last_read_inbox_message_id',
+                                                'unread_count': 'unread_count'}),
+    'updateChatReadOutbox': ('chat', 'chat_id', {'last_read_outbox_message_id': 'last_read_outbox_message_id'}),
+    'updateChatUnreadMentionCount': ('chat', 'chat_id', {'unread_mention_count': 'unread_mention_count'}),
+    'updateChatNotificationSettings': ('chat', 'chat_id', {'notification_settings': 'notification_settings'}),
+    'updateChatDraftMessage': ('chat', 'chat_id', {'draft_message': 'draft_message', 'positions': 'positions'}),
+    'updateUserStatus': ('user', 'user_id', {'status': 'status'})
+}
+
+# getter queries answered from the cache: @type -> (kind, id fields)
+GETTERS: Dict[str, Tuple[str, Tuple[str, ...]]] = {
+    'getChat': ('chat', ('chat_id',)),
+    'getUser': ('user', ('user_id',)),
+    'getSupergroup': ('supergroup', ('supergroup_id',)),
+    'getBasicGroup': ('basic_group', ('basic_group_id',)),
+    'getMessage': ('message', ('chat_id', 'message_id'))
+}
+
+# message updates handled by `EntityCache.feed` itself, any other `updateMessage*`
+# update naming a message drops it
+MESSAGE_UPDATES = ('updateMessageContent', 'updateMessageEdited', 'updateDeleteMessages')
+
+# updateChat* updates that do not change the chat object
+UNRELATED = ('updateChatAction', 'updateChatOnlineMemberCount')
+
+KINDS = ('chat', 'user', 'supergroup', 'basic_group', 'message')
+
+# TDLib bookkeeping keys that belong to one response, not to the object
+TRANSIENT_KEYS = ('@extra', '@client_id')
+
+# offline methods whose result depends only on the query, cached by `ExecuteCache`
+EXECUTE_METHODS = ('parseTextEntities', 'parseMarkdown', 'getMarkdownText', 'getTextEntities', 'getFileMimeType',
+                   'getFileExtension', 'cleanFileName', 'getJsonValue', 'getJsonString', 'searchStringsByPrefix',
+                   'getCountryFlagEmoji', 'getThemeParametersJsonString', 'searchQuote')
+
+
+class LRU:
+    """A dict bounded to `max_size` entries, evicting the least recently used one."""
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Optional[dict]:
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+
+        return value
+
+    def put(self, key: Hashable, value: dict) -> None:
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        if 0 < self.max_size < len(self._items):
+            self._items.popitem(last=False)
+
+    def pop(self, key: Hashable) -> Optional[dict]:
+        return self._items.pop(key, None)
+
+
+class EntityCache:
+    """
+    Users, chats, groups and messages as TDLib last pushed them.
+
+    Fed by the listener with every update and query result: whole objects
+    (`updateNewChat`, `updateUser`, a `getChat` result, ...) are stored,
+    updates listed in `PATCHES` replace fields of the stored object and any
+    other `updateChat*` (or `updateMessage*`) update drops the chat (or the
+    message), so the cache never serves an object it can not keep current.
+    Stored objects are never modified in place, a patch stores a patched
+    copy, and callers get copies of their own. Every kind is an LRU of
+    `max_size` entries.
+    """
+
+    def __init__(self, max_size: int = 10000) -> None:
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entities = {kind: LRU(max_size) for kind in KINDS}
+
+    def wants(self, update_type: str) -> bool:
+        return (update_type in CARRIERS or update_type in OBJECTS or update_type in PATCHES
+                or update_type in MESSAGE_UPDATES or update_type.startswith(('updateChat', 'updateMessage')))
+
+    def chat(self, chat_id: int) -> Optional[dict]:
+        return self.get('chat', chat_id)
+
+    def user(self, user_id: int) -> Optional[dict]:
+        return self.get('user', user_id)
+
+    def supergroup(self, supergroup_id: int) -> Optional[dict]:
+        return self.get('supergroup', supergroup_id)
+
+    def basic_group(self, basic_group_id: int) -> Optional[dict]:
+        return self.get('basic_group', basic_group_id)
+
+    def message(self, chat_id: int, message_id: int) -> Optional[dict]:
+        return self.get('message', (chat_id, message_id))
+
+    def get(self, kind: str, key: Hashable) -> Optional[dict]:
+        with self._lock:
+            value = self._entities[kind].get(key)
+
+        return copy_json(value)
+
+    def __len__(self) -> int:
+        return sum(len(entities) for entities in self._entities.values())
+
+    def lookup(self, query: dict) -> Optional[dict]:
+        """The cached answer to a getter `query`, None if it is not a getter or not cached."""
+        getter = GETTERS.get(query.get('@type'))
+        if getter is None:
+            return None
+
+        kind, fields = getter
+        key = query.get(fields[0]) if len(fields) == 1 else tuple(query.get(field) for field in fields)
+
+        with self._lock:
+            value = self._entities[kind].get(key)
+            if value is None:
+                self.misses += 1
+
+            else:
+                self.hits += 1
+
+        return copy_json(value)
+
+    def feed(self, update: dict) -> None:
+        update_type = update.get('@type')
+
+        if update_type in OBJECTS:
+            return self._store(update)
+
+        field = CARRIERS.get(update_type)
+        if field is not None:
+            value = update.get(field)
+            if isinstance(value, dict):
+                self._store(value)
+
+            if 'old_message_id' in update and isinstance(value, dict):
+                # the message was sent (or failed) under a new id
+                self._pop('message', (value.get('chat_id'), update.get('old_message_id')))
+
+            return
+
+        patch = PATCHES.get(update_type)
+        if patch is not None:
+            kind, id_field, fields = patch
+            return self._patch(kind, update.get(id_field), {name: update[key]
+                                                            for key, name in fields.items() if key in update})
+
+        if update_type == 'updateMessageContent':
+            return self._patch('message', (update.get('chat_id'), update.get('message_id')),
+                               {'content': update.get('new_content')})
+
+        if update_type == 'updateMessageEdited':
+            return self._patch('message', (update.get('chat_id'), update.get('message_id')),
+                               {'edit_date': update.get('edit_date'), 'reply_markup': update.get('reply_markup')})
+
+        if update_type == 'updateDeleteMessages':
+            chat_id = update.get('chat_id')
+            for message_id in update.get('message_ids') or ():
+                self._pop('message', (chat_id, message_id))
+
+            return
+
+        if update_type and update_type.startswith('updateChat') and update_type not in UNRELATED:
+            self._pop('chat', update.get('chat_id'))
+
+        elif update_type and update_type.startswith('updateMessage') and 'message_id' in update:
+            self._pop('message', (update.get('chat_id'), update.get('message_id')))
+
+    def _key(self, kind: str, value: dict) -> Hashable:
+        if kind == 'message':
+            return value.get('chat_id'), value.get('id')
+
+        return value.get('id')
+
+    def _store(self, value: dict) -> None:
+        kind = OBJECTS.get(value.get('@type'))
+        if kind is None:
+            return
+
+        if any(key in value for key in TRANSIENT_KEYS):
+            value = {key: item for key, item in value.items() if key not in TRANSIENT_KEYS}
+
+        with self._lock:
+            self._entities[kind].put(self._key(kind, value), value)
+
+    def _patch(self, kind: str, key: Hashable, fields: dict) -> None:
+        with self._lock:
+            entities = self._entities[kind]
+            value = entities.get(key)
+            if value is not None:
+                entities.put(key, {**value, **fields})
+
+    def _pop(self, kind: str, key: Hashable) -> None:
+        with self._lock:
+            self._entities[kind].pop(key)
+
+
+class ExecuteCache:
+    """Results of `EXECUTE_METHODS` as TDLib encoded them, keyed on the encoded query."""
+
+    def __init__(self, max_size: int) -> None:
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._results = LRU(max_size)
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def get(self, dump: bytes) -> Optional[bytes]:
+        with self._lock:
+            data = self._results.get(dump)
+            if data is None:
+                self.misses += 1
+
+            else:
+                self.hits += 1
+
+        return data
+
+    def put(self, dump: bytes, data: bytes) -> None:
+        with self._lock:
+            self._results.put(dump, data)
@@ -0,0 +1,224 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from logging import Logger
+from typing import Optional, Callable, List, Tuple
+
+from .cache import LRU
+
+
+# updates `UploadIndex.learn` looks at
+UPDATES = ('updateFile', 'updateMessageSendSucceeded', 'updateMessageSendFailed')
+
+# errors meaning TDLib no longer accepts a remote file id
+STALE_ERRORS = ('wrong remote file identifier', 'file_reference', 'file reference', 'media_empty',
+                'file_id_invalid', 'invalid file identifier')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS remotes (
+    digest TEXT PRIMARY KEY,
+    remote_id TEXT NOT NULL,
+    unique_id TEXT,
+    updated REAL NOT NULL
+);
+'''
+
+
+def is_stale(error_info: Optional[dict]) -> bool:
+    message = ((error_info or {}).get('message') or '').lower()
+    return any(error in message for error in STALE_ERRORS)
+
+
+def rewrite(value, replace: Callable[[dict], dict]):
+    """Copy of `value` with every `inputFileLocal` passed through `replace`, untouched parts are shared."""
+    if isinstance(value, dict):
+        if value.get('@type') == 'inputFileLocal':
+            return replace(value)
+
+        copy = None
+        for key, item in value.items():
+            new = rewrite(item, replace)
+            if new is not item:
+                if copy is None:
+                    copy = dict(value)
+
+                copy[key] = new
+
+        return value if copy is None else copy
+
+    if isinstance(value, list):
+        items = [rewrite(item, replace) for item in value]
+        if any(new is not item for new, item in zip(items, value)):
+            return items
+
+    return value
+
+
+def find_files(value, found: List[dict]) -> List[dict]:
+    if isinstance(value, dict):
+        if value.get('@type') == 'file':
+            found.append(value)
+
+        else:
+            for item in value.values():
+                find_files(item, found)
+
+    elif isinstance(value, list):
+        for item in value:
+            find_files(item, found)
+
+    return found
+
+
+class UploadIndex:
+    """
+    Persistent map of file content hashes to the remote ids TDLib gave them.
+
+    `rewrite` turns `inputFileLocal` references whose content was uploaded
+    before into `inputFileRemote`; local files without an entry are watched
+    and recorded once TDLib reports them uploaded (`learn`). Hashes are cached
+    by path, size and mtime, so an unchanged file is hashed once. Entries
+    TDLib rejects are removed with `forget`.
+    """
+
+    # messages sent with rewritten files, kept to match a later updateMessageSendFailed
+    SENT_MESSAGES = 1024
+    # local files waiting for their upload to complete
+    WATCHED_FILES = 1024
+
+    def __init__(self, logger: Logger, path: str) -> None:
+        self.logger = logger
+        self.path = path
+
+        self.hits = 0
+        self.learned = 0
+        self.forgotten = 0
+
+        dir_name = os.path.dirname(path)
+        if dir_name and not os.path.isdir(dir_name):
+            os.makedirs(dir_name)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+        self._watched = LRU(self.WATCHED_FILES)
+        self._sent = LRU(self.SENT_MESSAGES)
+
+    @property
+    def watching(self) -> bool:
+        return len(self._watched) > 0 or len(self._sent) > 0
+
+    def digest(self, path: str) -> Optional[str]:
+        try:
+            stat = os.stat(path)
+
+        except OSError:
+            return None
+
+        with self._lock:
+            row = self._db.execute('SELECT size, mtime_ns, digest FROM hashes WHERE path = ?', (path,)).fetchone()
+
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+
+        digest = digest.hexdigest()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO hashes (path, size, mtime_ns, digest) VALUES (?, ?, ?, ?)',
+                             (path, stat.st_size, stat.st_mtime_ns, digest))
+
+        return digest
+
+    def rewrite(self, query: dict) -> Tuple[dict, List[str]]:
+        """`query` with known local files replaced by remote ids, and the digests it used."""
+        used = []
+
+        def replace(value: dict) -> dict:
+            path = value.get('path')
+            digest = self.digest(path) if isinstance(path, str) else None
+            if digest is None:
+                return value
+
+            with self._lock:
+                row = self._db.execute('SELECT remote_id FROM remotes WHERE digest = ?', (digest,)).fetchone()
+                if row is None:
+                    self._watched.put(os.path.abspath(path), digest)
+                    return value
+
+            self.hits += 1
+            used.append(digest)
+            return {'@type': 'inputFileRemote', 'id': row[0]}
+
+        return rewrite(query, replace), used
+
+    def sent(self, update: dict, digests: List[str]) -> None:
+        """Remember a message sent with rewritten files until TDLib confirms or fails it."""
+        if update.get('@type') == 'message':
+            with self._lock:
+                self._sent.put((update.get('chat_id'), update.get('id')), digests)
+
+    def learn(self, update: dict) -> None:
+        """Record uploads completed in `update`, forget ids of a message TDLib could not send."""
+        update_type = update.get('@type')
+
+        if update_type in ('updateMessageSendFailed', 'updateMessageSendSucceeded'):
+            message = update.get('message') or {}
+            with self._lock:
+                digests = self._sent.pop((message.get('chat_id'), update.get('old_message_id')))
+
+            # newer TDLib reports an error object, older ones error_code and error_message
+            error = update.get('error') or {'message': update.get('error_message')}
+            if digests and update_type == 'updateMessageSendFailed' and is_stale(error):
+                self.forget(digests)
+
+        if not len(self._watched):
+            return
+
+        for file in find_files(update, []):
+            remote = file.get('remote') or {}
+            path = (file.get('local') or {}).get('path')
+            if not remote.get('id') or not remote.get('is_uploading_completed') or not path:
+                continue
+
+            with self._lock:
+                digest = self._watched.pop(os.path.abspath(path))
+                if digest is None:
+                    continue
+
+                self._db.execute('INSERT OR REPLACE INTO remotes (digest, remote_id, unique_id, updated) '
+                                 'VALUES (?, ?, ?, ?)', (digest, remote['id'], remote.get('unique_id'), time.time()))
+
+            self.learned += 1
+            self.logger.debug('upload index: %s is %s', path, remote.get('unique_id'))
+
+    def forget(self, digests: List[str]) -> None:
+        with self._lock:
+            for digest in digests:
+                self._db.execute('DELETE FROM remotes WHERE digest = ?', (digest,))
+
+        self.forgotten += len(digests)
+        self.logger.info('upload index: forgot %s stale remote files', len(digests))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM remotes').fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            # nothing is watched any more, `learn` is not called past this point
+            self._watched = LRU(self.WATCHED_FILES)
+            self._sent = LRU(self.SENT_MESSAGES)
+            self._db.close()
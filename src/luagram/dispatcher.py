@@ -0,0 +1,367 @@
+import time
+import queue
+import itertools
+import threading
+from logging import Logger
+from typing import Optional, Callable, Dict, Tuple, Iterable, Union, List
+
+from .loop import current_loop, run_task
+from .metrics import Metrics
+from .filters import Filter
+
+
+class Handler:
+    __slots__ = ('callback', 'types', 'filter', 'batch', 'order')
+
+    _counter = itertools.count()
+
+    def __repr__(self) -> str:
+        return 'Handler<%s, %s%s>' % (self.callback, self.types or '*', ', batch' if self.batch else '')
+
+    def __init__(self, callback: Callable, types: Optional[Iterable[str]] = None, filters=None, batch: bool = False) -> None:
+        if not callable(callback):
+            raise TypeError(f'Expected a function for \'handler\', but got {type(callback).__name__} instead.')
+
+        if type(types).__name__ == '_LuaTable':
+            types = list(types.values())
+
+        elif isinstance(types, str):
+            types = [types]
+
+        self.callback = callback
+        self.types = frozenset(types) if types else None
+        self.filter = Filter.parse(filters)
+        # called once per batch of updates with a list of them, see `Dispatcher.dispatch_many`
+        self.batch = bool(batch)
+        self.order = next(self._counter)
+
+
+class Dispatcher:
+    """
+    Route updates to the handlers subscribed to their `@type`.
+
+    The Lua handler spec is compiled once into an index of `@type` -> handlers
+    plus a list of catch-all handlers, so dispatching an update costs
+    O(matching handlers). The index is copy-on-write, adding or removing a
+    handler only touches the routes of its own types.
+    """
+
+    def __init__(self,
+                 logger: Logger,
+                 lua_runtime=None,
+                 metrics: Optional[Metrics] = None,
+                 stopped: Optional[threading.Event] = None) -> None:
+
+        self.logger = logger
+        # when set, handlers get updates as native tables of this Lua state
+        self.lua_runtime = lua_runtime
+        self.metrics = metrics
+        # set once the client stops, the rest of a batch is then dropped
+        self.stopped = stopped
+
+        self._lock = threading.Lock()
+        self._typed: Dict[str, Tuple[Handler, ...]] = {}
+        self._catch_all: Tuple[Handler, ...] = ()
+        self._routes: Dict[str, Tuple[Handler, ...]] = {}
+        # handlers with a filter, dispatch skips the filtering pass while there are none
+        self._filtered = 0
+        # batch handlers, `dispatch_many` collects batches only while there are some
+        self._batched = 0
+
+    @staticmethod
+    def parse(value) -> Handler:
+        """Build a handler from a `function` or `{function, {types}, {filters}, batch = true}` entry."""
+        if type(value).__name__ == '_LuaTable':
+            return Handler(value[1], value[2], value[3], value['batch'])
+
+        return Handler(value)
+
+    def compile(self, handlers) -> Tuple[Handler, ...]:
+        values = handlers.values() if type(handlers).__name__ == '_LuaTable' else handlers
+        return tuple(self.add(self.parse(value)) for value in values)
+
+    def add(self, handler: Handler) -> Handler:
+        with self._lock:
+            if handler.types is None:
+                self._catch_all += (handler,)
+
+            else:
+                for update_type in handler.types:
+                    self._typed[update_type] = self._typed.get(update_type, ()) + (handler,)
+
+            self._filtered += handler.filter is not None
+            self._batched += handler.batch
+            self._invalidate(handler.types)
+
+        return handler
+
+    def remove(self, handler: Handler) -> None:
+        with self._lock:
+            found = False
+
+            if handler.types is None:
+                found = handler in self._catch_all
+                self._catch_all = tuple(h for h in self._catch_all if h is not handler)
+
+            else:
+                for update_type in handler.types:
+                    typed = self._typed.get(update_type, ())
+                    handlers = tuple(h for h in typed if h is not handler)
+                    found = found or len(handlers) != len(typed)
+                    if handlers:
+                        self._typed[update_type] = handlers
+
+                    else:
+                        self._typed.pop(update_type, None)
+
+            if not found:
+                # removed already, or registered with another dispatcher (e.g. before a reload)
+                return
+
+            self._filtered -= handler.filter is not None
+            self._batched -= handler.batch
+            self._invalidate(handler.types)
+
+    def _invalidate(self, types: Optional[frozenset]) -> None:
+        # routes are swapped rather than mutated, a dispatch running
+        # concurrently keeps filling the table it started with
+        if types is None:
+            self._routes = {}
+
+        else:
+            self._routes = {key: value for key, value in self._routes.items() if key not in types}
+
+    def wants(self, update_type: str) -> bool:
+        return bool(self._catch_all) or update_type in self._typed
+
+    def route(self, update_type: Optional[str]) -> Tuple[Handler, ...]:
+        routes = self._routes
+        handlers = routes.get(update_type)
+
+        if handlers is None:
+            typed = self._typed.get(update_type)
+            if typed:
+                # keep the registration order of the original handler table
+                handlers = tuple(sorted(typed + self._catch_all, key=lambda h: h.order))
+
+            else:
+                handlers = self._catch_all
+
+            routes[update_type] = handlers
+
+        return handlers
+
+    def dispatch(self, update: dict, batches: Optional[Dict[Handler, list]] = None) -> None:
+        """
+        Call the handlers of `update`. Batch handlers get a list holding only
+        this update, or, given `batches`, the update is collected there for
+        `dispatch_many` to hand over with the rest of its batch.
+        """
+        update_type = update.get('@type')
+        handlers = self.route(update_type)
+        if handlers and self._filtered:
+            # decided on the decoded update, before anything crosses into Lua
+            handlers = [handler for handler in handlers if handler.filter is None or handler.filter(update)]
+
+        if handlers and self.lua_runtime is not None:
+            update = self.lua_runtime.table_from(update, recursive=True)
+
+        profiler = current_loop().profiler if handlers else None
+
+        for handler in handlers:
+            if handler.batch:
+                if batches is not None:
+                    batches.setdefault(handler, []).append(update)
+
+                else:
+                    self._call(handler, 'batch', [update], profiler)
+
+            else:
+                self._call(handler, update_type, update, profiler)
+
+    def dispatch_many(self, updates: List[dict]) -> None:
+        """
+        Dispatch a batch of updates in order; each batch handler is called
+        once, after the other handlers, with the updates it matched.
+        """
+        stopped = self.stopped
+        batches: Optional[Dict[Handler, list]] = {} if self._batched else None
+
+        for update in updates:
+            if stopped is not None and stopped.is_set():
+                return
+
+            self.dispatch(update, batches)
+
+        if not batches:
+            return
+
+        profiler = current_loop().profiler if batches else None
+        for handler in sorted(batches, key=lambda h: h.order):
+            self._call(handler, 'batch', batches[handler], profiler)
+
+    def _call(self, handler: Handler, update_type: Optional[str], value, profiler) -> None:
+        metrics = self.metrics
+        if metrics is not None:
+            started = time.perf_counter()
+
+        if profiler is not None:
+            profiler.enter(update_type or '?')
+
+        if handler.batch:
+            # a Lua array, so `ipairs` and `#` work on it
+            value = current_loop().table(value)
+
+        try:
+            handler.callback(value)
+
+        except BaseException as e:
+            self.logger.error('handler %s: %s', handler, e)
+
+        if metrics is not None:
+            metrics.observe('handler', update_type, time.perf_counter() - started)
+
+
+def shard_key(update: dict, field: str):
+    value = update.get(field)
+
+    if value is None:
+        message = update.get('message')
+        if isinstance(message, dict):
+            value = message.get(field)
+
+    return value
+
+
+class Worker(threading.Thread):
+    def __init__(self, pool: 'WorkerPool', index: int) -> None:
+        super().__init__(name='luagram-worker-%s' % index, daemon=True)
+        self.pool = pool
+        self.index = index
+        self.queue = queue.Queue(maxsize=pool.queue_size)
+        self.dispatcher: Optional[Dispatcher] = None
+        # set once the first dispatcher is loaded, `error` holds why it failed
+        self.ready = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def run(self) -> None:
+        try:
+            self._run()
+
+        finally:
+            # the Lua state goes away with the thread
+            current_loop().close()
+
+    def _run(self) -> None:
+        # the dispatcher and its Lua state are created and used only here
+        self.reload()
+        self.ready.set()
+        if self.dispatcher is None:
+            return
+
+        with current_loop().attach(self.queue.put):
+            while True:
+                # everything already queued is taken at once, updates in between tasks form a batch
+                items = [self.queue.get()]
+                while len(items) < self.pool.batch_size:
+                    try:
+                        items.append(self.queue.get_nowait())
+
+                    except queue.Empty:
+                        break
+
+                updates = []
+                for item in items:
+                    if item is None or callable(item):
+                        self._dispatch(updates)
+                        updates = []
+
+                    if item is None:
+                        return
+
+                    if callable(item):
+                        run_task(self.pool.logger, item)
+
+                    else:
+                        updates.append(item)
+
+                self._dispatch(updates)
+
+    def _dispatch(self, updates: List[dict]) -> None:
+        if updates and self.dispatcher is not None:
+            self.dispatcher.dispatch_many(updates)
+
+    def reload(self) -> None:
+        """Load a new dispatcher, run on the worker's own thread; a failure keeps the current one."""
+        try:
+            self.dispatcher = self.pool.create_dispatcher(self.index)
+
+        except BaseException as e:
+            self.error = e
+            self.pool.logger.error('worker %s: %s', self.index, e, exc_info=e)
+
+
+class WorkerPool:
+    """
+    Run handlers on a fixed number of worker threads.
+
+    Updates are sharded by a key such as `chat_id`: updates sharing a key
+    always land on the same worker and keep their order, updates of
+    different keys run in parallel. Updates without a key are spread
+    round-robin.
+    """
+
+    def __init__(self,
+                 logger: Logger,
+                 workers: int,
+                 create_dispatcher: Callable[[int], Dispatcher],
+                 key: Union[str, Callable] = 'chat_id',
+                 queue_size: int = 0,
+                 batch_size: int = 1000) -> None:
+
+        self.logger = logger
+        self.key = key
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.create_dispatcher = create_dispatcher
+
+        self._round_robin = itertools.count()
+        self._workers = [Worker(self, index) for index in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+        # a worker without a dispatcher would drop every update of its shard
+        for worker in self._workers:
+            worker.ready.wait()
+
+        failed = [worker for worker in self._workers if worker.dispatcher is None]
+        if failed:
+            self.close()
+            raise RuntimeError('worker %s could not load its handlers: %s' % (failed[0].index, failed[0].error))
+
+    def submit(self, update: dict) -> None:
+        if callable(self.key):
+            key = self.key(update)
+
+        else:
+            key = shard_key(update, self.key)
+
+        if key is None:
+            index = next(self._round_robin)
+
+        else:
+            index = hash(key)
+
+        self._workers[index % len(self._workers)].queue.put(update)
+
+    def reload(self) -> None:
+        """Have every worker load a new dispatcher once it is done with the updates queued before."""
+        for worker in self._workers:
+            worker.queue.put(worker.reload)
+
+    def close(self) -> None:
+        for worker in self._workers:
+            worker.queue.put(None)
+
+        for worker in self._workers:
+            worker.join()
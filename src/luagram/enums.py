@@ -5,6 +5,7 @@ class Status(enum.Enum):
     OK = enum.auto()
     ERROR = enum.auto()
     PENDING = enum.auto()
+    TIMEOUT = enum.auto()
 
 
 class AuthState(enum.Enum):
@@ -19,3 +20,9 @@ class AuthState(enum.Enum):
     WAIT_ENCRYPTION_KEY = 'authorizationStateWaitEncryptionKey'
     WAIT_TDLIB_PARAMETERS = 'authorizationStateWaitTdlibParameters'
 
+
+class QueuePolicy(enum.Enum):
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    PRIORITY = 'priority'
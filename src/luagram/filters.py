@@ -0,0 +1,158 @@
+import re
+from typing import Optional, Callable, Iterable, Union, List
+
+from .gadget import tools
+
+
+def message_of(update: dict) -> Optional[dict]:
+    message = update.get('message')
+    if isinstance(message, dict):
+        return message
+
+    if update.get('@type') == 'message':
+        return update
+
+
+def chat_id_of(update: dict):
+    chat_id = update.get('chat_id')
+    if chat_id is None:
+        message = message_of(update)
+        if message is not None:
+            chat_id = message.get('chat_id')
+
+    return chat_id
+
+
+def sender_id_of(update: dict):
+    message = message_of(update)
+    sender = message.get('sender_id') if message is not None else None
+    if isinstance(sender, dict):
+        return sender.get('user_id', sender.get('chat_id'))
+
+
+def content_of(update: dict) -> Optional[dict]:
+    message = message_of(update)
+    content = message.get('content') if message is not None else update.get('new_content')
+    if isinstance(content, dict):
+        return content
+
+
+def text_of(update: dict) -> Optional[str]:
+    content = content_of(update)
+    if content is None:
+        return None
+
+    text = content.get('text', content.get('caption'))
+    if isinstance(text, dict):
+        text = text.get('text')
+
+    if isinstance(text, str):
+        return text
+
+
+def _ids(name: str, value) -> frozenset:
+    values = tools.as_list(value) if tools.is_lua_table(value) or isinstance(value, (list, tuple, set)) else [value]
+    for item in values:
+        if not isinstance(item, (int, float)):
+            raise TypeError(f'Expected numbers for \'{name}\', but got {type(item).__name__} instead.')
+
+    return frozenset(int(item) for item in values)
+
+
+def _strings(name: str, value) -> tuple:
+    values = tools.as_list(value) if tools.is_lua_table(value) or isinstance(value, (list, tuple)) else [value]
+    for item in values:
+        if not isinstance(item, str):
+            raise TypeError(f'Expected strings for \'{name}\', but got {type(item).__name__} instead.')
+
+    return tuple(values)
+
+
+class Filter:
+    """
+    Declarative conditions on an update, checked in Python before a handler
+    is called, so updates it would discard never cross into Lua.
+
+    Conditions look at the update's message (`updateNewMessage`, a
+    `message` result) or its own fields (`chat_id`, `new_content`); an
+    update lacking the field a condition needs does not match it.
+    """
+
+    __slots__ = ('_checks',)
+
+    KEYS = ('chat_ids', 'sender_ids', 'outgoing', 'content_types', 'text_prefix', 'text_regex')
+
+    def __repr__(self) -> str:
+        return 'Filter<%s>' % len(self._checks)
+
+    def __init__(self,
+                 chat_ids: Optional[Iterable[int]] = None,
+                 sender_ids: Optional[Iterable[int]] = None,
+                 outgoing: Optional[bool] = None,
+                 content_types: Optional[Union[str, Iterable[str]]] = None,
+                 text_prefix: Optional[Union[str, Iterable[str]]] = None,
+                 text_regex: Optional[str] = None) -> None:
+
+        checks: List[Callable[[dict], bool]] = []
+
+        if chat_ids is not None:
+            chat_ids = _ids('chat_ids', chat_ids)
+            checks.append(lambda update: chat_id_of(update) in chat_ids)
+
+        if sender_ids is not None:
+            sender_ids = _ids('sender_ids', sender_ids)
+            checks.append(lambda update: sender_id_of(update) in sender_ids)
+
+        if outgoing is not None:
+            outgoing = bool(outgoing)
+            checks.append(lambda update: (message_of(update) or {}).get('is_outgoing') is outgoing)
+
+        if content_types is not None:
+            content_types = frozenset(_strings('content_types', content_types))
+            checks.append(lambda update: (content_of(update) or {}).get('@type') in content_types)
+
+        if text_prefix is not None:
+            prefixes = _strings('text_prefix', text_prefix)
+
+            def has_prefix(update: dict) -> bool:
+                text = text_of(update)
+                return text is not None and text.startswith(prefixes)
+
+            checks.append(has_prefix)
+
+        if text_regex is not None:
+            if not isinstance(text_regex, str):
+                raise TypeError(f'Expected a string for \'text_regex\', but got {type(text_regex).__name__} instead.')
+
+            pattern = re.compile(text_regex)
+
+            def matches(update: dict) -> bool:
+                text = text_of(update)
+                return text is not None and pattern.search(text) is not None
+
+            checks.append(matches)
+
+        self._checks = tuple(checks)
+
+    @classmethod
+    def parse(cls, value) -> Optional['Filter']:
+        """Build a filter from a table of conditions, None when there are none."""
+        if value is None or isinstance(value, Filter):
+            return value
+
+        if not (tools.is_lua_table(value) or isinstance(value, dict)):
+            raise TypeError(f'Expected a table for \'filters\', but got {type(value).__name__} instead.')
+
+        conditions = tools.as_dict(value)
+        for key in conditions:
+            if key not in cls.KEYS:
+                raise ValueError(f'Unknown filter \'{key}\', expected one of {", ".join(cls.KEYS)}.')
+
+        return cls(**conditions) if conditions else None
+
+    def __call__(self, update: dict) -> bool:
+        for check in self._checks:
+            if not check(update):
+                return False
+
+        return True
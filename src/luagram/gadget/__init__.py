@@ -1,2 +1,2 @@
 from . import tools
-from .tdjson import TDJson
\ No newline at end of file
+from .tdjson import TDJson, TDJsonMultiplexer, TDJsonClient, get_codec
\ No newline at end of file
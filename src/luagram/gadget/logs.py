@@ -0,0 +1,121 @@
+import re
+import queue
+import random
+import logging
+import threading
+from typing import Optional, Dict
+
+from .tdjson import peek_type
+
+
+_ANY_TYPE_PATTERN = re.compile(rb'"@type"\s*:\s*"([^"]*)"')
+
+
+def payload_type(data: bytes) -> Optional[str]:
+    update_type = peek_type(data)
+    if update_type is None:
+        # queries encoded from Lua tables do not start with @type
+        match = _ANY_TYPE_PATTERN.search(data)
+        if match:
+            update_type = match.group(1).decode(encoding='utf-8', errors='replace')
+
+    return update_type
+
+
+class PayloadFilter(logging.Filter):
+    """
+    Sample and truncate records that carry a JSON payload.
+
+    `sampling` maps a `@type` to the fraction of its records to keep, records
+    of other types are always kept. Payloads longer than `max_payload` bytes
+    are cut short.
+    """
+
+    def __init__(self, max_payload: int = 0, sampling: Optional[Dict[str, float]] = None) -> None:
+        super().__init__()
+
+        self.max_payload = max_payload
+        self.sampling = sampling or {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not isinstance(record.args, tuple):
+            return True
+
+        for index, arg in enumerate(record.args):
+            if not isinstance(arg, (bytes, bytearray)):
+                continue
+
+            if self.sampling:
+                rate = self.sampling.get(payload_type(arg))
+                if rate is not None and random.random() >= rate:
+                    return False
+
+            if 0 < self.max_payload < len(arg):
+                truncated = b'%s... (%d bytes)' % (arg[:self.max_payload], len(arg))
+                record.args = record.args[:index] + (truncated,) + record.args[index + 1:]
+
+        return True
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Hand records to `handler` on a background writer thread.
+
+    The calling thread only queues the record, formatting, file writes and
+    rollover happen on the writer. Once `capacity` records are waiting, new
+    ones are dropped and counted in `dropped` instead of blocking the caller.
+    """
+
+    def __init__(self, handler: logging.Handler, capacity: int = 10000) -> None:
+        super().__init__()
+
+        self.handler = handler
+        self.dropped = 0
+
+        self._queue = queue.Queue(maxsize=capacity)
+        self._writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self._writer_thread.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        args = record.args.values() if isinstance(record.args, dict) else record.args or ()
+        if any(isinstance(arg, (dict, list, set)) for arg in args):
+            # mutable arguments may change before the writer formats them
+            record.msg = record.getMessage()
+            record.args = None
+
+        try:
+            self._queue.put_nowait(record)
+
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self) -> None:
+        """Wait until every queued record has been written."""
+        if self._writer_thread.is_alive():
+            self._queue.join()
+
+        self.handler.flush()
+
+    def close(self) -> None:
+        if self._writer_thread.is_alive():
+            self._queue.put(None)
+            self._writer_thread.join()
+
+        self.handler.close()
+        super().close()
+
+    def _writer(self) -> None:
+        while True:
+            record = self._queue.get()
+
+            try:
+                if record is None:
+                    return
+
+                self.handler.handle(record)
+
+            except Exception:
+                self.handler.handleError(record)
+
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,140 @@
+import json
+from typing import Callable
+
+from .tools import is_lua_table
+from .tdjson import dumper
+
+
+# Runs inside the Lua state, so encoding a query crosses into Python once per
+# query instead of once per nested table. Values Lua can not encode itself
+# (Python objects stored in the table) go through `fallback`.
+LUA_ENCODER = r'''
+local fallback = ...
+
+local type, pairs, tostring, next = type, pairs, tostring, next
+local format, gsub, byte, concat = string.format, string.gsub, string.byte, table.concat
+local floor, huge, mtype = math.floor, math.huge, math.type
+
+local escapes = {['"'] = '\\"', ['\\'] = '\\\\', ['\b'] = '\\b', ['\f'] = '\\f',
+                 ['\n'] = '\\n', ['\r'] = '\\r', ['\t'] = '\\t'}
+
+local function escape(char)
+    return escapes[char] or format('\\u%04x', byte(char))
+end
+
+local function string_value(value)
+    return '"' .. gsub(value, '[%c"\\]', escape) .. '"'
+end
+
+local function number_value(value)
+    if value ~= value or value == huge or value == -huge then
+        return 'null'
+    end
+
+    if mtype and mtype(value) == 'integer' then
+        return tostring(value)
+    end
+
+    if value == floor(value) and value > -2^53 and value < 2^53 then
+        return format('%.0f', value)
+    end
+
+    return format('%.17g', value)
+end
+
+local encode
+
+local function table_value(value, buffer)
+    local count = 0
+    local is_array = true
+
+    for key in pairs(value) do
+        count = count + 1
+        if is_array and (type(key) ~= 'number' or key < 1 or key % 1 ~= 0) then
+            is_array = false
+        end
+    end
+
+    -- an empty table is an object, as `@extra = {}` must be
+    if is_array and count > 0 and #value == count then
+        buffer[#buffer + 1] = '['
+        for index = 1, count do
+            if index > 1 then
+                buffer[#buffer + 1] = ','
+            end
+            encode(value[index], buffer)
+        end
+        buffer[#buffer + 1] = ']'
+        return
+    end
+
+    local first = true
+    buffer[#buffer + 1] = '{'
+    for key, item in pairs(value) do
+        if first then
+            first = false
+        else
+            buffer[#buffer + 1] = ','
+        end
+        buffer[#buffer + 1] = string_value(tostring(key))
+        buffer[#buffer + 1] = ':'
+        encode(item, buffer)
+    end
+    buffer[#buffer + 1] = '}'
+end
+
+encode = function(value, buffer)
+    local kind = type(value)
+
+    if kind == 'string' then
+        buffer[#buffer + 1] = string_value(value)
+    elseif kind == 'number' then
+        buffer[#buffer + 1] = number_value(value)
+    elseif kind == 'boolean' then
+        buffer[#buffer + 1] = value and 'true' or 'false'
+    elseif kind == 'nil' then
+        buffer[#buffer + 1] = 'null'
+    elseif kind == 'table' then
+        table_value(value, buffer)
+    else
+        buffer[#buffer + 1] = fallback(value)
+    end
+end
+
+return function(value)
+    local buffer = {}
+    encode(value, buffer)
+    return concat(buffer)
+end
+'''
+
+
+def fallback(value) -> str:
+    return json.dumps(value, default=dumper)
+
+
+def create_encoder(lua_runtime) -> Callable:
+    """Compile the table -> JSON encoder into `lua_runtime`."""
+    return lua_runtime.execute(LUA_ENCODER, fallback)
+
+
+def to_python(value):
+    """
+    Convert a Lua table to Python lists and dicts, walking it from Python.
+
+    Tables whose keys are exactly 1..n become lists, everything else a dict,
+    an empty table too. Slower than the Lua-side encoder but works on tables of any runtime.
+    """
+    if not is_lua_table(value):
+        return value
+
+    items = list(value.items())
+    if not items:
+        return {}
+
+    if all(isinstance(key, int) and not isinstance(key, bool) for key, _ in items):
+        keys = sorted(key for key, _ in items)
+        if keys[0] == 1 and keys[-1] == len(keys):
+            return [to_python(value[key]) for key in keys]
+
+    return {key: to_python(item) for key, item in items}
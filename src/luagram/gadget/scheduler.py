@@ -0,0 +1,110 @@
+import time
+import heapq
+import logging
+import threading
+from typing import Callable, Optional
+
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled', '_scheduler')
+
+    def __init__(self, scheduler: 'Scheduler', when: float, callback: Callable, args: tuple) -> None:
+        self.when = when
+        self.args = args
+        self.callback = callback
+        self.cancelled = False
+        self._scheduler = scheduler
+
+    def __lt__(self, other: 'Timer') -> bool:
+        return self.when < other.when
+
+    def cancel(self) -> None:
+        self._scheduler._cancel(self)
+
+
+class Scheduler:
+    """
+    Run callbacks after a delay on one shared background thread.
+
+    Timers live in a heap ordered by deadline; cancelled timers are skipped
+    when they come due and the heap is compacted once most of it is dead.
+    Callbacks run on the scheduler thread and must not block.
+    """
+
+    def __init__(self, logger: Optional[logging.Logger] = None) -> None:
+        self.logger = logger or logging.getLogger('luagram.scheduler')
+
+        self._heap = []
+        self._dead = 0
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def __len__(self) -> int:
+        return len(self._heap) - self._dead
+
+    def in_thread(self) -> bool:
+        """True when called from a timer callback."""
+        return threading.current_thread() is self._thread
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        return self.call_at(time.monotonic() + delay, callback, *args)
+
+    def call_at(self, when: float, callback: Callable, *args) -> Timer:
+        timer = Timer(self, when, callback, args)
+
+        with self._condition:
+            heapq.heappush(self._heap, timer)
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='luagram-scheduler', daemon=True)
+                self._thread.start()
+
+            elif self._heap[0] is timer:
+                self._condition.notify()
+
+        return timer
+
+    def _cancel(self, timer: Timer) -> None:
+        with self._condition:
+            if timer.cancelled:
+                return
+
+            timer.cancelled = True
+            self._dead += 1
+
+            if self._dead > 1024 and self._dead * 2 > len(self._heap):
+                self._heap = [item for item in self._heap if not item.cancelled]
+                heapq.heapify(self._heap)
+                self._dead = 0
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+
+                    timer = self._heap[0]
+                    if timer.cancelled:
+                        heapq.heappop(self._heap)
+                        self._dead -= 1
+                        continue
+
+                    delay = timer.when - time.monotonic()
+                    if delay <= 0:
+                        heapq.heappop(self._heap)
+                        # a fired timer can no longer be cancelled
+                        timer.cancelled = True
+                        break
+
+                    self._condition.wait(delay)
+
+            try:
+                timer.callback(*timer.args)
+
+            except Exception as err:
+                self.logger.error('timer %s: %s', timer.callback, err, exc_info=err)
+
+
+scheduler = Scheduler()
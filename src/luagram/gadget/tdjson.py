@@ -1,11 +1,20 @@
+import re
 import sys
 import json
 import base64
+import logging
+import threading
 import ctypes.util
 from logging import Logger
-from typing import Optional
+from typing import Optional, Callable, Dict, List
 from ctypes import CDLL, CFUNCTYPE, c_int, c_char_p, c_double, c_void_p, c_longlong
 
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
 
 def dumper(value):
     if isinstance(value, bytes):
@@ -18,9 +27,95 @@ def dumper(value):
         return str(value)
 
 
+class JsonCodec:
+    name = 'json'
+
+    def dumps(self, value) -> bytes:
+        return json.dumps(value, default=dumper).encode(encoding='utf-8')
+
+    def loads(self, data: bytes):
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    name = 'orjson'
+
+    def dumps(self, value) -> bytes:
+        # lua arrays reach here as tables with integer keys
+        return orjson.dumps(value, default=dumper, option=orjson.OPT_NON_STR_KEYS)
+
+    def loads(self, data: bytes):
+        return orjson.loads(data)
+
+
+CODECS = {
+    'json': JsonCodec,
+    'orjson': OrjsonCodec
+}
+
+
+def get_codec(name: str = 'auto') -> JsonCodec:
+    """`auto` picks the fastest installed codec, falling back to the stdlib."""
+    if name == 'auto':
+        name = 'json' if orjson is None else 'orjson'
+
+    if name not in CODECS:
+        raise ValueError(f'Unknown json codec {name!r}, expected one of auto, {", ".join(CODECS)}.')
+
+    if name == 'orjson' and orjson is None:
+        raise ImportError('the orjson codec requires the orjson package')
+
+    return CODECS[name]()
+
+
+_TYPE_PREFIX = b'{"@type":"'
+_TYPE_PATTERN = re.compile(rb'\{\s*"@type"\s*:\s*"([^"]*)"')
+_CLIENT_ID_PATTERN = re.compile(rb'"@client_id"\s*:\s*(-?\d+)')
+
+
+def peek_type(data: bytes) -> Optional[str]:
+    """Read the top-level `@type` without decoding, TDLib always writes it first."""
+    if data.startswith(_TYPE_PREFIX):
+        end = data.find(b'"', len(_TYPE_PREFIX))
+        if end != -1:
+            return data[len(_TYPE_PREFIX):end].decode(encoding='utf-8')
+
+    match = _TYPE_PATTERN.match(data)
+    if match:
+        return match.group(1).decode(encoding='utf-8')
+
+
+def peek_client_id(data: bytes) -> Optional[int]:
+    """Read the `@client_id` TDLib appends to every multiplexed update."""
+    start = data.rfind(b'"@client_id"')
+    if start != -1:
+        match = _CLIENT_ID_PATTERN.match(data, start)
+        if match:
+            return int(match.group(1))
+
+
+def skip_update(data: bytes, type_filter: Optional[Callable[[str], bool]]) -> bool:
+    """Whether `data` can be dropped undecoded: nobody wants its type and no query waits on it."""
+    if type_filter is None or b'"@extra"' in data:
+        return False
+
+    update_type = peek_type(data)
+    return update_type is not None and not type_filter(update_type)
+
+
 class TDJson:
-    def __init__(self, logger: Logger, verbosity: int, library_path: Optional[str] = None):
+    def __init__(self,
+                 logger: Logger,
+                 verbosity: int,
+                 library_path: Optional[str] = None,
+                 codec: Optional[JsonCodec] = None):
+
         self.logger = logger
+        self.codec = codec or get_codec()
+        self.type_filter: Optional[Callable[[str], bool]] = None
+        # called with the raw bytes of everything received, see `JournalWriter`
+        self.recorder: Optional[Callable[[bytes], None]] = None
+        self.skipped = 0
 
         if library_path is None:
             library_path = ctypes.util.find_library('tdjson')
@@ -75,30 +170,280 @@ class TDJson:
         def on_fatal_error_callback(error_message: str) -> None:
             self.logger.error('TDLib fatal error: %s', error_message)
 
-        c_on_fatal_error_callback = fatal_error_callback_type(on_fatal_error_callback)
-        self._td_set_log_fatal_error_callback(c_on_fatal_error_callback)
+        # ctypes does not keep the callback alive, the instance has to
+        self._c_on_fatal_error_callback = fatal_error_callback_type(on_fatal_error_callback)
+        self._td_set_log_fatal_error_callback(self._c_on_fatal_error_callback)
 
     def stop(self):
         return self._td_json_client_destroy(self.td_json_client)
 
     def send(self, query: dict) -> None:
-        dump = json.dumps(query, default=dumper)
+        dump = self.codec.dumps(query)
         self.logger.debug('sent query: %s', dump)
-        self._td_json_client_send(self.td_json_client, dump.encode(encoding='utf-8'))
+        self._td_json_client_send(self.td_json_client, dump)
+
+    def send_bytes(self, dump: bytes) -> None:
+        """Send a query already encoded with `codec`."""
+        self.logger.debug('sent query: %s', dump)
+        self._td_json_client_send(self.td_json_client, dump)
 
     def receive(self) -> Optional[dict]:
         result = self._td_json_client_receive(self.td_json_client, 1.0)
 
+        if result:
+            return self._decode(result)
+
+    def receive_many(self, limit: int = 1000) -> List[dict]:
+        """
+        Wait up to a second for the first update, then drain whatever else
+        TDLib already holds without waiting, up to `limit` updates.
+        """
+        updates = []
+        timeout = 1.0
+
+        while len(updates) < limit:
+            result = self._td_json_client_receive(self.td_json_client, timeout)
+            if not result:
+                break
+
+            timeout = 0.0
+            update = self._decode(result)
+            if update is not None:
+                updates.append(update)
+
+        return updates
+
+    def _decode(self, result: bytes) -> Optional[dict]:
+        if self.recorder is not None:
+            self.recorder(result)
+
+        if skip_update(result, self.type_filter):
+            self.skipped += 1
+            return None
+
+        self.logger.debug('received: %s', result)
+        return self.codec.loads(result)
+
+    def execute(self, query):
+        result = self.execute_bytes(self.codec.dumps(query))
+
+        if result:
+            return self.codec.loads(result)
+
+    def execute_bytes(self, dump: bytes) -> Optional[bytes]:
+        """Run an encoded query synchronously, return the encoded result."""
+        self.logger.debug('sent query: %s', dump)
+        result = self._td_json_client_execute(self.td_json_client, dump)
+
         if result:
             self.logger.debug('received: %s', result)
-            return json.loads(result)
+
+        return result
+
+
+class TDJsonMultiplexer:
+    """
+    Share one TDLib receive loop between many clients.
+
+    Built on `td_create_client_id`/`td_send`/`td_receive`: a single receiver
+    thread drains every TDLib instance created through the library and routes
+    each update to its client by `@client_id`. It is shared by clients with
+    different settings, each client brings its own logger and codec.
+    """
+
+    _instances: Dict[Optional[str], 'TDJsonMultiplexer'] = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, verbosity: int, library_path: Optional[str] = None) -> 'TDJsonMultiplexer':
+        with cls._instances_lock:
+            multiplexer = cls._instances.get(library_path)
+            if multiplexer is None:
+                logger = logging.getLogger('luagram.multiplexer')
+                multiplexer = cls._instances[library_path] = cls(logger, verbosity, library_path)
+
+            return multiplexer
+
+    def __init__(self,
+                 logger: Logger,
+                 verbosity: int,
+                 library_path: Optional[str] = None,
+                 codec: Optional[JsonCodec] = None):
+
+        self.logger = logger
+        self.codec = codec or get_codec()
+
+        if library_path is None:
+            library_path = ctypes.util.find_library('tdjson')
+
+        if library_path is None:
+            sys.exit('tdjson library not found')
+
+        else:
+            self._tdjson = CDLL(library_path)
+            self.logger.info('Using shared library "%s" (multiplexed)', library_path)
+
+
+
+        # load tdjson functions 
+        self._td_create_client_id = self._tdjson.td_create_client_id
+        self._td_create_client_id.restype = c_int
+        self._td_create_client_id.argtypes = []
+
+
+        self._td_receive = self._tdjson.td_receive
+        self._td_receive.restype = c_char_p
+        self._td_receive.argtypes = [c_double]
+
+
+        self._td_send = self._tdjson.td_send
+        self._td_send.restype = None
+        self._td_send.argtypes = [c_int, c_char_p]
+
+
+        self._td_execute = self._tdjson.td_execute
+        self._td_execute.restype = c_char_p
+        self._td_execute.argtypes = [c_char_p]
+
+
+        self._td_set_log_verbosity_level = self._tdjson.td_set_log_verbosity_level
+        self._td_set_log_verbosity_level.restype = None
+        self._td_set_log_verbosity_level.argtypes = [c_int]
+        self._td_set_log_verbosity_level(verbosity)
+
+
+        fatal_error_callback_type = CFUNCTYPE(None, c_char_p)
+        self._td_set_log_fatal_error_callback = self._tdjson.td_set_log_fatal_error_callback
+        self._td_set_log_fatal_error_callback.restype = None
+        self._td_set_log_fatal_error_callback.argtypes = [fatal_error_callback_type]
+
+        def on_fatal_error_callback(error_message: str) -> None:
+            self.logger.error('TDLib fatal error: %s', error_message)
+
+        self._c_on_fatal_error_callback = fatal_error_callback_type(on_fatal_error_callback)
+        self._td_set_log_fatal_error_callback(self._c_on_fatal_error_callback)
+
+
+        self._clients: Dict[int, 'TDJsonClient'] = {}
+        self._lock = threading.Lock()
+        self._receiver_thread = None
+
+    def create_client(self,
+                      logger: Logger,
+                      callback: Callable[[Optional[dict]], None],
+                      codec: Optional[JsonCodec] = None) -> 'TDJsonClient':
+
+        client_id = self._td_create_client_id()
+        client = TDJsonClient(self, logger, client_id, callback, codec)
+
+        with self._lock:
+            self._clients[client_id] = client
+
+            if self._receiver_thread is None:
+                self._receiver_thread = threading.Thread(target=self._receiver, daemon=True)
+                self._receiver_thread.start()
+
+        # td_create_client_id does not start the instance, the first request does
+        client.send({'@type': 'getOption', 'name': 'version'})
+        return client
+
+    def remove_client(self, client_id: int) -> None:
+        with self._lock:
+            self._clients.pop(client_id, None)
+
+    def send(self, client_id: int, dump: bytes) -> None:
+        self._td_send(client_id, dump)
+
+    def execute(self, dump: bytes) -> Optional[bytes]:
+        return self._td_execute(dump)
+
+    def _receiver(self):
+        self.logger.info('multiplexed receiver started')
+        while True:
+            with self._lock:
+                if not self._clients:
+                    self._receiver_thread = None
+                    break
+
+            result = self._td_receive(1.0)
+            if not result:
+                continue
+
+            client = self._clients.get(peek_client_id(result))
+            if client is not None and client.recorder is not None:
+                client.recorder(result)
+
+            if client is not None and skip_update(result, client.type_filter):
+                client.skipped += 1
+                continue
+
+            # decoded with the codec of its client, if the id could be read
+            codec = self.codec if client is None else client.codec
+            update = codec.loads(result)
+            client_id = update.get('@client_id')
+            client = self._clients.get(client_id)
+
+            if client is None:
+                self.logger.debug('client has not been found by client_id=%s', client_id)
+                continue
+
+            try:
+                client.callback(update)
+
+            except Exception as err:
+                self.logger.error('client_id=%s callback: %s', client_id, err, exc_info=err)
+
+            if update.get('@type') == 'updateAuthorizationState':
+                if update['authorization_state'].get('@type') == 'authorizationStateClosed':
+                    self.remove_client(client_id)
+
+        self.logger.info('multiplexed receiver stopped')
+
+
+class TDJsonClient:
+    """A TDLib instance whose updates are delivered by a `TDJsonMultiplexer`."""
+
+    def __init__(self,
+                 multiplexer: TDJsonMultiplexer,
+                 logger: Logger,
+                 client_id: int,
+                 callback: Callable[[Optional[dict]], None],
+                 codec: Optional[JsonCodec] = None):
+
+        self.logger = logger
+        self.callback = callback
+        self.client_id = client_id
+        self.codec = codec or multiplexer.codec
+        self.type_filter: Optional[Callable[[str], bool]] = None
+        # called with the raw bytes of everything received, see `JournalWriter`
+        self.recorder: Optional[Callable[[bytes], None]] = None
+        self.skipped = 0
+        self._multiplexer = multiplexer
+
+    def stop(self):
+        # the multiplexer forgets the client once authorizationStateClosed arrives
+        return self.send({'@type': 'close'})
+
+    def send(self, query: dict) -> None:
+        dump = self.codec.dumps(query)
+        self.logger.debug('sent query: %s', dump)
+        self._multiplexer.send(self.client_id, dump)
+
+    def send_bytes(self, dump: bytes) -> None:
+        self.logger.debug('sent query: %s', dump)
+        self._multiplexer.send(self.client_id, dump)
 
     def execute(self, query):
-        dump = json.dumps(query, default=dumper)
+        result = self.execute_bytes(self.codec.dumps(query))
+
+        if result:
+            return self.codec.loads(result)
+
+    def execute_bytes(self, dump: bytes) -> Optional[bytes]:
         self.logger.debug('sent query: %s', dump)
-        result = self._td_json_client_execute(self.td_json_client,
-                                              dump.encode(encoding='utf-8'))
+        result = self._multiplexer.execute(dump)
 
         if result:
             self.logger.debug('received: %s', result)
-            return json.loads(result)
+
+        return result
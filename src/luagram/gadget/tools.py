@@ -23,3 +23,35 @@ def arguments(func):
     return warp
 
 
+
+def is_lua_table(value) -> bool:
+    return type(value).__name__ == '_LuaTable'
+
+
+def is_lua_function(value) -> bool:
+    return type(value).__name__ == '_LuaFunction'
+
+
+def as_list(value) -> list:
+    if is_lua_table(value):
+        return list(value.values())
+
+    return list(value)
+
+
+def as_dict(value) -> dict:
+    if is_lua_table(value):
+        return dict(value.items())
+
+    return dict(value)
+
+
+def copy_json(value):
+    """Copy of a decoded JSON value, down to its nested dicts and lists."""
+    if isinstance(value, dict):
+        return {key: copy_json(item) for key, item in value.items()}
+
+    if isinstance(value, list):
+        return [copy_json(item) for item in value]
+
+    return value
@@ -0,0 +1,296 @@
+import os
+import time
+import queue
+import struct
+import logging
+import threading
+from logging import Logger
+from typing import TYPE_CHECKING, Optional, Iterator, Tuple, List
+
+from .gadget.tdjson import JsonCodec, skip_update
+
+
+if TYPE_CHECKING:
+    from .runtime import Script
+
+
+MAGIC = b'LGJ1'
+# receive time (unix seconds) and length of one record
+HEADER = struct.Struct('<dI')
+SUFFIX = '.journal'
+
+logger = logging.getLogger('luagram.journal')
+
+
+def journal_path(name: str) -> str:
+    return os.path.join('.app-data', name, 'journal')
+
+
+def segments(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return []
+
+    return sorted(os.path.join(path, file) for file in os.listdir(path) if file.endswith(SUFFIX))
+
+
+def read_journal(path: str) -> Iterator[Tuple[float, bytes]]:
+    """Records of every segment under `path` in order, a record cut short by a crash ends its segment."""
+    for segment in segments(path):
+        with open(segment, 'rb') as file:
+            if file.read(len(MAGIC)) != MAGIC:
+                logger.warning('%s is not a journal segment, skipped', segment)
+                continue
+
+            while True:
+                header = file.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+
+                timestamp, size = HEADER.unpack(header)
+                data = file.read(size)
+                if len(data) < size:
+                    break
+
+                yield timestamp, data
+
+
+class JournalWriter:
+    """
+    Append-only journal of raw updates, split into segments of about
+    `segment_size` bytes. A new writer never touches existing segments, it
+    continues the numbering after them. Writes are buffered and flushed at
+    most once a second, and on `close`.
+    """
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path: str, segment_size: int = 64 << 20) -> None:
+        self.path = path
+        self.segment_size = segment_size
+        self.written = 0
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        existing = segments(path)
+        self._index = int(os.path.basename(existing[-1])[:-len(SUFFIX)]) if existing else 0
+        self._file = None
+        self._size = 0
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+
+    def write(self, data: bytes) -> None:
+        """Record one update as received, answers to queries (carrying `@extra`) are left out."""
+        if b'"@extra"' in data:
+            return
+
+        with self._lock:
+            if self._file is None or self._size >= self.segment_size > 0:
+                self._open()
+
+            self._file.write(HEADER.pack(time.time(), len(data)))
+            self._file.write(data)
+            self._size += HEADER.size + len(data)
+            self.written += 1
+
+            now = time.monotonic()
+            if now - self._flushed >= self.FLUSH_INTERVAL:
+                self._file.flush()
+                self._flushed = now
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _open(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+        self._index += 1
+        self._file = open(os.path.join(self.path, '%08d%s' % (self._index, SUFFIX)), 'wb')
+        self._file.write(MAGIC)
+        self._size = len(MAGIC)
+
+
+class ReplayTDJson:
+    """
+    Stand-in for `TDJson` feeding a recorded journal to the client.
+
+    `receive` hands out the journal's updates, paced like the recording
+    divided by `speed` (0 replays as fast as possible). Queries never reach
+    TDLib: `getAuthorizationState` is answered with a ready state so `start`
+    passes, anything else with an error.
+    """
+
+    def __init__(self, logger: Logger, codec: JsonCodec, path: str, speed: float = 1.0) -> None:
+        self.logger = logger
+        self.codec = codec
+        self.path = path
+        self.speed = speed
+        self.type_filter = None
+        self.recorder = None
+        self.skipped = 0
+
+        self.replayed = 0
+        self.started_at = None
+        self.finished = threading.Event()
+
+        self._records = read_journal(path)
+        self._next = None
+        self._origin = None
+        self._answers = queue.SimpleQueue()
+
+        if not segments(path):
+            self.logger.warning('no journal found under %s', path)
+
+    def stop(self) -> None:
+        self.finished.set()
+
+    def send(self, query: dict) -> None:
+        self._answers.put(self._answer(query))
+
+    def send_bytes(self, dump: bytes) -> None:
+        self.send(self.codec.loads(dump))
+
+    def execute(self, query):
+        return self.codec.loads(self._answer(query))
+
+    def execute_bytes(self, dump: bytes) -> Optional[bytes]:
+        return self._answer(self.codec.loads(dump))
+
+    def receive(self) -> Optional[dict]:
+        data = self._next_record()
+        if data is None:
+            return None
+
+        if skip_update(data, self.type_filter):
+            self.skipped += 1
+            return None
+
+        return self.codec.loads(data)
+
+    def receive_many(self, limit: int = 1000) -> List[dict]:
+        # records are paced one by one, a batch takes those already due
+        updates = []
+        while True:
+            update = self.receive()
+            if update is not None:
+                updates.append(update)
+
+            if len(updates) >= limit or not self._due():
+                return updates
+
+    def _due(self) -> bool:
+        """Whether an answer or the next record can be handed out without waiting."""
+        if not self._answers.empty():
+            return True
+
+        self._advance()
+        if self._next is None:
+            return False
+
+        if self.speed <= 0 or self._origin is None:
+            return True
+
+        return (self._next[0] - self._origin[0]) / self.speed <= time.monotonic() - self._origin[1]
+
+    def _advance(self) -> None:
+        if self._next is None and not self.finished.is_set():
+            self._next = next(self._records, None)
+            if self._next is None:
+                self.logger.info('journal replayed: %s updates', self.replayed)
+                self.finished.set()
+
+    def _next_record(self) -> Optional[bytes]:
+        try:
+            return self._answers.get_nowait()
+
+        except queue.Empty:
+            pass
+
+        self._advance()
+        if self._next is None:
+            try:
+                return self._answers.get(timeout=1.0)
+
+            except queue.Empty:
+                return None
+
+        timestamp, data = self._next
+        now = time.monotonic()
+        if self.started_at is None:
+            self.started_at = now
+
+        if self.speed > 0:
+            if self._origin is None:
+                self._origin = timestamp, now
+
+            delay = (timestamp - self._origin[0]) / self.speed - (now - self._origin[1])
+            if delay > 0:
+                # answers to queries of the handlers are not held back by the pacing
+                try:
+                    return self._answers.get(timeout=delay)
+
+                except queue.Empty:
+                    pass
+
+        self._next = None
+        if b'"@extra"' in data:
+            # the answer to a query of the recorded session
+            return None
+
+        self.replayed += 1
+        return data
+
+    def _answer(self, query: dict) -> bytes:
+        if query.get('@type') == 'getAuthorizationState':
+            answer = {'@type': 'authorizationStateReady'}
+
+        else:
+            answer = {'@type': 'error', 'code': 400, 'message': 'Not available while replaying a journal'}
+
+        if '@extra' in query:
+            answer['@extra'] = query['@extra']
+
+        return self.codec.dumps(answer)
+
+
+class Replay:
+    """
+    Run a script with every client replaying the journal recorded under its
+    name, then stop the clients once their journals are replayed and their
+    updates queues drained, logging the throughput handlers reached.
+    """
+
+    def __init__(self, script: 'Script', speed: float = 1.0) -> None:
+        self.script = script
+        self.speed = speed
+        self._transports: List[ReplayTDJson] = []
+        script.transport = self.transport
+
+    def transport(self, name: str, logger: Logger, codec: JsonCodec) -> ReplayTDJson:
+        transport = ReplayTDJson(logger, codec, journal_path(name), speed=self.speed)
+        self._transports.append(transport)
+        return transport
+
+    def run(self):
+        threading.Thread(target=self._watch, daemon=True).start()
+        return self.script.execute()
+
+    def _watch(self) -> None:
+        while True:
+            time.sleep(0.1)
+            for client in list(self.script.clients.values()):
+                transport = client._tdjson
+                if client._stopped_event.is_set() or not isinstance(transport, ReplayTDJson):
+                    continue
+
+                if not transport.finished.is_set() or client._updates_queue.qsize():
+                    continue
+
+                elapsed = time.monotonic() - (transport.started_at or time.monotonic())
+                client.logger.info('replayed %s updates in %.2fs (%.0f updates/s)', transport.replayed,
+                                   elapsed, transport.replayed / elapsed if elapsed > 0 else 0)
+                client.stop()
@@ -0,0 +1,153 @@
+import time
+import logging
+import functools
+import threading
+import collections
+from contextlib import contextmanager
+from typing import Optional, Callable
+
+from .gadget.luatable import create_encoder
+
+
+_local = threading.local()
+
+
+class Loop:
+    """
+    Tasks waiting to run on the thread that owns a Lua state.
+
+    A `LuaRuntime` must only be entered from its own thread, so callbacks
+    that come due on the listener or scheduler thread are posted here. While
+    a dispatcher (`get_updates` or a worker) runs on the owning thread, tasks
+    are pushed straight into the queue it waits on; until then they are
+    kept in a backlog, which a blocking wait on the owning thread runs.
+    """
+
+    def __init__(self) -> None:
+        self._lua_runtime = None
+        self._lua_encoder = None
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._post: Optional[Callable] = None
+        self._backlog = collections.deque()
+        # the running `Profiler` of this thread's Lua state
+        self.profiler = None
+        self._closers = []
+
+    def call_soon(self, callback: Callable, *args) -> None:
+        task = functools.partial(callback, *args)
+
+        with self._lock:
+            post = self._post
+            if post is None:
+                self._backlog.append(task)
+                self._ready.notify_all()
+                return
+
+        post(task)
+
+    @property
+    def lua_runtime(self):
+        """The Lua state owned by this thread, if any."""
+        return self._lua_runtime
+
+    @lua_runtime.setter
+    def lua_runtime(self, lua_runtime) -> None:
+        self._lua_runtime = lua_runtime
+        self._lua_encoder = None
+
+    @property
+    def lua_encoder(self) -> Optional[Callable]:
+        """Lua function encoding a table of this thread's state to JSON, compiled on first use."""
+        if self._lua_encoder is None and self._lua_runtime is not None:
+            self._lua_encoder = create_encoder(self._lua_runtime)
+
+        return self._lua_encoder
+
+    def table(self, values, recursive: bool = False):
+        """Wrap `values` in a Lua table of this thread's Lua state, if it has one."""
+        if self.lua_runtime is None:
+            return values
+
+        return self.lua_runtime.table_from(values, recursive=recursive)
+
+    def run_until(self, future, timeout: Optional[float] = None, logger: Optional[logging.Logger] = None) -> bool:
+        """
+        Block the owning thread until `future` is done, return whether it is.
+
+        Without a dispatcher attached (the top level of a script, before
+        `get_updates`) nothing else runs the backlog, so its tasks run here
+        meanwhile: a spawned coroutine the future waits on can make progress.
+        """
+        if self._post is not None or future.done:
+            return future._result_event.wait(timeout=timeout)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # resolving the future posts a no-op, which wakes the wait below
+        future.on_done(lambda _: self.call_soon(_nothing))
+
+        while not future.done:
+            with self._lock:
+                if not self._backlog:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+
+                    self._ready.wait(remaining)
+                    continue
+
+                task = self._backlog.popleft()
+
+            run_task(logger or logging.getLogger('luagram.loop'), task)
+
+        return True
+
+    def on_close(self, callback: Callable[[], None]) -> None:
+        """Call `callback` on the owning thread once it is done with its Lua state."""
+        self._closers.append(callback)
+
+    def close(self) -> None:
+        closers, self._closers = self._closers, []
+        for callback in closers:
+            callback()
+
+    @contextmanager
+    def attach(self, post: Callable[[Callable], None]):
+        """Route tasks into `post` for as long as the dispatcher runs."""
+        with self._lock:
+            previous, self._post = self._post, post
+            backlog, self._backlog = self._backlog, collections.deque()
+
+        for task in backlog:
+            post(task)
+
+        try:
+            yield self
+
+        finally:
+            with self._lock:
+                self._post = previous
+
+
+def _nothing() -> None:
+    pass
+
+
+def current_loop() -> Loop:
+    loop = getattr(_local, 'loop', None)
+    if loop is None:
+        loop = _local.loop = Loop()
+
+    return loop
+
+
+def run_task(logger, task: Callable) -> None:
+    profiler = current_loop().profiler
+    if profiler is not None:
+        profiler.enter('task')
+
+    try:
+        task()
+
+    except BaseException as e:
+        logger.error('task %s: %s', task, e)
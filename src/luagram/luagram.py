@@ -1,17 +1,34 @@
 import os
 import re
-import uuid
+import time
 import queue
+import itertools
 import getpass
 import logging
 import platform
 import threading
-from typing import Optional, Callable, Union, List
+from typing import Optional, Callable, Union, List, Dict
 from logging.handlers import RotatingFileHandler
 
-from .enums import Status, AuthState
-from .gadget import TDJson, tools
-from .response import Response
+from .enums import Status, AuthState, QueuePolicy
+from .gadget import TDJson, TDJsonMultiplexer, get_codec, tools
+from .gadget.luatable import to_python
+from .gadget.logs import AsyncHandler, PayloadFilter
+from .response import Response, Future, Gathering, FirstOf, Task
+from .loop import current_loop, run_task
+from .pending import PendingQueries, resolving
+from .batch import Batch
+from .pager import Pager, history_step, chat_search_step, search_step
+from .template import Template
+from .journal import JournalWriter, journal_path
+from .updates import UpdatesQueue, COALESCE_KEYS
+from .metrics import Metrics, prometheus, write_file
+from .cache import EntityCache, ExecuteCache, EXECUTE_METHODS
+from .throttle import SendScheduler
+from .transfer import Transfers, Transfer
+from .dedup import UploadIndex, UPDATES as UPLOAD_UPDATES, is_stale
+from .gadget.scheduler import scheduler
+from .dispatcher import Dispatcher, Handler, WorkerPool
 
 
 __version__ = '1.0.3'
@@ -94,7 +111,33 @@ class Settings:
                  verbosity: int = 0,
                  base_logger: Optional['BaseLogger'] = None,
                  queue_put_timeout: int = 10,
-                 updates_queue_size: int = 1000) -> None:
+                 updates_queue_size: int = 1000,
+                 multiplexed: bool = False,
+                 queue_policy: Union[str, QueuePolicy] = QueuePolicy.BLOCK,
+                 update_priorities: Optional[Dict[str, int]] = None,
+                 coalesce_updates: Union[bool, List[str]] = False,
+                 query_timeout: Optional[float] = None,
+                 max_pending_queries: int = 0,
+                 pending_policy: Union[str, QueuePolicy] = QueuePolicy.BLOCK,
+                 json_codec: str = 'auto',
+                 prefilter_updates: bool = False,
+                 lua_tables: bool = False,
+                 metrics: bool = False,
+                 metrics_file: Optional[str] = None,
+                 metrics_interval: float = 15,
+                 cache: bool = False,
+                 cache_size: int = 10000,
+                 cache_queries: bool = False,
+                 rate_limits: Optional[Dict[str, float]] = None,
+                 chat_rate_limit: Optional[float] = None,
+                 flood_wait_retries: int = 0,
+                 max_flood_wait: float = 60,
+                 max_transfers: int = 4,
+                 dedup_uploads: bool = False,
+                 execute_cache_size: int = 0,
+                 record_updates: bool = False,
+                 journal_segment_size: int = 64 << 20,
+                 update_batch_size: int = 1000) -> None:
 
         if not isinstance(verbosity, int):
             raise TypeError(f'Expected a int for \'verbosity\', but got {type(verbosity).__name__} instead.')
@@ -111,12 +154,115 @@ class Settings:
 
         if not isinstance(updates_queue_size, int):
             raise TypeError(f'Expected a int for \'updates_queue_size\', but got {type(updates_queue_size).__name__} instead.')
+
+        if not isinstance(queue_policy, (str, QueuePolicy)):
+            raise TypeError(f'Expected a string or QueuePolicy for \'queue_policy\', but got {type(queue_policy).__name__} instead.')
+
+        queue_policy = QueuePolicy(queue_policy)
+
+        if update_priorities is None:
+            update_priorities = {}
+
+        else:
+            update_priorities = tools.as_dict(update_priorities)
+
+        if coalesce_updates is True:
+            coalesce_updates = list(COALESCE_KEYS)
+
+        elif not coalesce_updates:
+            coalesce_updates = []
+
+        else:
+            coalesce_updates = tools.as_list(coalesce_updates)
+            for update_type in coalesce_updates:
+                if update_type not in COALESCE_KEYS:
+                    raise ValueError(f'Can not coalesce \'{update_type}\', expected one of {", ".join(COALESCE_KEYS)}.')
+
+        if not (isinstance(query_timeout, (int, float)) or query_timeout is None):
+            raise TypeError(f'Expected a number or None for \'query_timeout\', but got {type(query_timeout).__name__} instead.')
+
+        if not isinstance(max_pending_queries, int):
+            raise TypeError(f'Expected a int for \'max_pending_queries\', but got {type(max_pending_queries).__name__} instead.')
+
+        if not isinstance(pending_policy, (str, QueuePolicy)):
+            raise TypeError(f'Expected a string or QueuePolicy for \'pending_policy\', but got {type(pending_policy).__name__} instead.')
+
+        pending_policy = QueuePolicy(pending_policy)
+        if pending_policy is QueuePolicy.PRIORITY:
+            raise ValueError('Expected \'block\', \'drop_oldest\' or \'drop_newest\' for \'pending_policy\'.')
+
+        if not isinstance(json_codec, str):
+            raise TypeError(f'Expected a string for \'json_codec\', but got {type(json_codec).__name__} instead.')
+
+        if not (isinstance(metrics_file, str) or metrics_file is None):
+            raise TypeError(f'Expected a string or None for \'metrics_file\', but got {type(metrics_file).__name__} instead.')
+
+        if not isinstance(metrics_interval, (int, float)):
+            raise TypeError(f'Expected a number for \'metrics_interval\', but got {type(metrics_interval).__name__} instead.')
+
+        if not isinstance(cache_size, int):
+            raise TypeError(f'Expected a int for \'cache_size\', but got {type(cache_size).__name__} instead.')
+
+        if rate_limits is None:
+            rate_limits = {}
+
+        else:
+            rate_limits = tools.as_dict(rate_limits)
+
+        if not (isinstance(chat_rate_limit, (int, float)) or chat_rate_limit is None):
+            raise TypeError(f'Expected a number or None for \'chat_rate_limit\', but got {type(chat_rate_limit).__name__} instead.')
+
+        if not isinstance(flood_wait_retries, int):
+            raise TypeError(f'Expected a int for \'flood_wait_retries\', but got {type(flood_wait_retries).__name__} instead.')
+
+        if not isinstance(max_flood_wait, (int, float)):
+            raise TypeError(f'Expected a number for \'max_flood_wait\', but got {type(max_flood_wait).__name__} instead.')
+
+        if not isinstance(max_transfers, int):
+            raise TypeError(f'Expected a int for \'max_transfers\', but got {type(max_transfers).__name__} instead.')
+
+        if not isinstance(execute_cache_size, int):
+            raise TypeError(f'Expected a int for \'execute_cache_size\', but got {type(execute_cache_size).__name__} instead.')
+
+        if not isinstance(journal_segment_size, int):
+            raise TypeError(f'Expected a int for \'journal_segment_size\', but got {type(journal_segment_size).__name__} instead.')
+
+        if not isinstance(update_batch_size, int):
+            raise TypeError(f'Expected a int for \'update_batch_size\', but got {type(update_batch_size).__name__} instead.')
         
 
         self.verbosity = verbosity
         self.base_logger = base_logger
         self.queue_put_timeout = queue_put_timeout
         self.updates_queue_size = updates_queue_size
+        self.multiplexed = bool(multiplexed)
+        self.queue_policy = queue_policy
+        self.update_priorities = update_priorities
+        self.coalesce_updates = coalesce_updates
+        self.query_timeout = query_timeout
+        self.max_pending_queries = max_pending_queries
+        self.pending_policy = pending_policy
+        self.json_codec = json_codec
+        self.prefilter_updates = bool(prefilter_updates)
+        self.lua_tables = bool(lua_tables)
+        # writing a metrics file implies collecting metrics
+        self.metrics = bool(metrics) or metrics_file is not None
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        # serving getters from the cache implies keeping one
+        self.cache = bool(cache) or bool(cache_queries)
+        self.cache_size = cache_size
+        self.cache_queries = bool(cache_queries)
+        self.rate_limits = rate_limits
+        self.chat_rate_limit = chat_rate_limit
+        self.flood_wait_retries = flood_wait_retries
+        self.max_flood_wait = max_flood_wait
+        self.max_transfers = max_transfers
+        self.dedup_uploads = bool(dedup_uploads)
+        self.execute_cache_size = execute_cache_size
+        self.record_updates = bool(record_updates)
+        self.journal_segment_size = journal_segment_size
+        self.update_batch_size = max(1, update_batch_size)
 
 
 class BaseLogger:
@@ -124,7 +270,11 @@ class BaseLogger:
     def __init__(self,
                  path: Optional[str] = None,
                  level: int = 1,
-                 max_file_size: int = 0):
+                 max_file_size: int = 0,
+                 asynchronous: bool = False,
+                 buffer_size: int = 10000,
+                 max_payload: int = 0,
+                 sampling: Optional[Dict[str, float]] = None):
 
 
         if not (isinstance(path, str) or path is None):
@@ -136,11 +286,27 @@ class BaseLogger:
 
         if not isinstance(max_file_size, int):
             raise TypeError(f'Expected a int for \'max_file_size\', but got {type(max_file_size).__name__} instead.')
+
+        if not isinstance(buffer_size, int):
+            raise TypeError(f'Expected a int for \'buffer_size\', but got {type(buffer_size).__name__} instead.')
+
+        if not isinstance(max_payload, int):
+            raise TypeError(f'Expected a int for \'max_payload\', but got {type(max_payload).__name__} instead.')
+
+        if sampling is None:
+            sampling = {}
+
+        else:
+            sampling = tools.as_dict(sampling)
         
 
         self.path = path
         self.level = level
         self.max_file_size = max_file_size
+        self.asynchronous = bool(asynchronous)
+        self.buffer_size = buffer_size
+        self.max_payload = max_payload
+        self.sampling = sampling
 
 
 class LuagramClient:
@@ -149,7 +315,8 @@ class LuagramClient:
                  name: str,
                  params: Params,
                  settings: Optional[Settings] = None,
-                 library_path: Optional[str] = None):
+                 library_path: Optional[str] = None,
+                 transport: Optional[Callable] = None):
         
 
         if not isinstance(name, str):
@@ -161,7 +328,7 @@ class LuagramClient:
         if not (isinstance(settings, Settings) or settings is None):
             raise TypeError(f'Expected a Settings or None for \'settings\', but got {type(params).__name__} instead.')
 
-        if not isinstance(library_path, str):
+        if not (isinstance(library_path, str) or transport is not None):
             raise TypeError(f'Expected a string for \'library_path\', but got {type(library_path).__name__} instead.')
 
         if settings is None:
@@ -171,9 +338,11 @@ class LuagramClient:
         self.name = name
         self.params = params
         self.settings = settings
+        self.script = None
     
     
         self.logger = logging.getLogger('luagram.client.%s' % name)
+        self._log_handler = None
         if settings.base_logger.path:
             path = settings.base_logger.path.replace('%name', name)
 
@@ -184,29 +353,146 @@ class LuagramClient:
             hdlr = RotatingFileHandler(path,
                                        maxBytes=settings.base_logger.max_file_size)
 
+            if settings.base_logger.asynchronous:
+                # formatting, writes and rollover move to a writer thread
+                hdlr = AsyncHandler(hdlr, capacity=settings.base_logger.buffer_size)
+
+            if settings.base_logger.max_payload or settings.base_logger.sampling:
+                hdlr.addFilter(PayloadFilter(max_payload=settings.base_logger.max_payload,
+                                             sampling=settings.base_logger.sampling))
+
+            self._log_handler = hdlr
             self.logger.addHandler(hdlr)
         self.logger.setLevel(settings.base_logger.level)
 
 
-        self._tdjson = TDJson(self.logger,
-                              verbosity=settings.verbosity,
-                              library_path=library_path)
-        
-        self._pending_results = {}
-        
-        self._updates_queue = queue.Queue(maxsize=settings.updates_queue_size)
+        self._pending_results = PendingQueries(self.logger,
+                                               max_size=settings.max_pending_queries,
+                                               policy=settings.pending_policy,
+                                               timeout=settings.query_timeout)
+        # None unless enabled, so every recording site costs a single check
+        self.metrics = Metrics() if settings.metrics else None
+        self._metrics_timer = None
+        self.cache = EntityCache(max_size=settings.cache_size) if settings.cache else None
+        self._executed = ExecuteCache(settings.execute_cache_size) if settings.execute_cache_size > 0 else None
+
+        self._transfers = Transfers(self, concurrency=settings.max_transfers)
+        self._uploads = None
+        if settings.dedup_uploads:
+            self._uploads = UploadIndex(self.logger, os.path.join('.app-data', name, 'uploads.sqlite'))
+
+        self._throttle = None
+        if settings.rate_limits or settings.chat_rate_limit or settings.flood_wait_retries:
+            self._throttle = SendScheduler(self.logger,
+                                           send=self._tdjson_send,
+                                           fail=self._fail_query,
+                                           method_limits=settings.rate_limits,
+                                           chat_limit=settings.chat_rate_limit,
+                                           retries=settings.flood_wait_retries,
+                                           max_wait=settings.max_flood_wait)
+
         self._stopped_event = threading.Event()
+        self._stop_lock = threading.Lock()
+        self._dispatcher = Dispatcher(self.logger, metrics=self.metrics, stopped=self._stopped_event)
+        self._dispatchers = [self._dispatcher]
+        self._worker_dispatchers: Dict[int, Dispatcher] = {}
+        self._pool = None
+        self._internal_types = {'updateAuthorizationState'}
+        self._query_ids = itertools.count(1)
+        self._received = 0
+        
+        self._updates_queue = UpdatesQueue(self.logger,
+                                           maxsize=settings.updates_queue_size,
+                                           policy=settings.queue_policy,
+                                           put_timeout=settings.queue_put_timeout,
+                                           priorities=settings.update_priorities,
+                                           coalesce=settings.coalesce_updates)
+
+
+        codec = get_codec(settings.json_codec)
+        if transport is not None:
+            # `transport(name, logger, codec)` stands in for libtdjson, e.g. a journal replay
+            self._tdjson = transport(name, self.logger, codec)
+            self._listener_thread = threading.Thread(target=self._listener, daemon=True)
+
+        elif settings.multiplexed:
+            multiplexer = TDJsonMultiplexer.get(verbosity=settings.verbosity, library_path=library_path)
+
+            # updates arrive on the multiplexer's shared receiver thread
+            self._tdjson = multiplexer.create_client(self.logger, self._on_update, codec)
+            self._listener_thread = None
+
+        else:
+            self._tdjson = TDJson(self.logger,
+                                  verbosity=settings.verbosity,
+                                  library_path=library_path,
+                                  codec=codec)
+
+            self._listener_thread = threading.Thread(target=self._listener, daemon=True)
+
+        if settings.prefilter_updates:
+            # updates nobody subscribes to are dropped before they are decoded
+            self._tdjson.type_filter = self._wants_update
 
+        self._journal = None
+        if settings.record_updates and transport is None:
+            self._journal = JournalWriter(journal_path(name), segment_size=settings.journal_segment_size)
+            self._tdjson.recorder = self._journal.write
 
-        self._listener_thread = threading.Thread(target=self._listener, daemon=True)
-        self._listener_thread.start()
+        if self._listener_thread is not None:
+            self._listener_thread.start()
+
+        if settings.metrics_file:
+            self._metrics_timer = scheduler.call_later(settings.metrics_interval, self._export_metrics)
 
     @tools.arguments
     def __call__(self,
                  query: dict,
-                 block: bool=True):
-        return self._send_query(query, block=block)
+                 block: bool=True,
+                 timeout: Optional[float] = None):
+        return self._send_query(query, block=block, timeout=timeout)
+
+    @tools.arguments
+    def prepare(self,
+                query: dict,
+                params: Optional[Dict[str, str]] = None,
+                block: bool = True,
+                timeout: Optional[float] = None) -> Template:
 
+        if not (isinstance(query, dict) or tools.is_lua_table(query)):
+            raise TypeError(f'Expected a table for \'query\', but got {type(query).__name__} instead.')
+
+        params = {} if params is None else tools.as_dict(params)
+        return Template(self, self._to_query(query), params, block=block, timeout=timeout)
+
+    @tools.arguments
+    def execute(self, query: dict) -> Optional[dict]:
+        """
+        Run an offline method (`parseTextEntities`, `getFileMimeType`, ...)
+        synchronously on the calling thread, bypassing the pending table and
+        the listener. Returns the result or error object as a plain table.
+        """
+        if not (isinstance(query, dict) or tools.is_lua_table(query)):
+            raise TypeError(f'Expected a table for \'query\', but got {type(query).__name__} instead.')
+
+        query = self._to_query(query)
+        codec = self._tdjson.codec
+        dump = codec.dumps(query)
+
+        cached = self._executed is not None and query.get('@type') in EXECUTE_METHODS
+        if cached:
+            data = self._executed.get(dump)
+            if data is not None:
+                return codec.loads(data)
+
+        data = self._tdjson.execute_bytes(dump)
+        if not data:
+            return None
+
+        if cached:
+            self._executed.put(dump, data)
+
+        return codec.loads(data)
 
     @tools.arguments
     def start(self,
@@ -359,102 +645,601 @@ class LuagramClient:
                 self.logger.error('auth state error: %s', result.error_info)
 
     @tools.arguments
-    def get_updates(self, handlers: List[Callable]):
-        self.logger.info('getting updates: %s handlers', len(handlers))
-        while not self._stopped_event.is_set():
-            try:
-                update = self._updates_queue.get(timeout=0.5)
+    def get_updates(self,
+                    handlers: List[Callable],
+                    workers: int = 0,
+                    shard_key: Union[str, Callable] = 'chat_id'):
 
-            except queue.Empty:
-                continue
+        if not isinstance(workers, int):
+            raise TypeError(f'Expected a int for \'workers\', but got {type(workers).__name__} instead.')
 
-            else:
-                if update:
-                    update_type = update.get('@type')
-        
-                    for value in handlers.values():
-                        if type(value).__name__ == '_LuaTable':
-                            if type(value[2]).__name__ == '_LuaTable':
-                                if update_type not in value[2].values():
-                                    continue
-        
-                            handler = value[1]
- 
-                        elif type(value).__name__ == '_LuaFunction':
-                            handler = value
+        if not (isinstance(shard_key, str) or callable(shard_key)):
+            raise TypeError(f'Expected a string or function for \'shard_key\', but got {type(shard_key).__name__} instead.')
 
-                        try:
-                            handler(update)
-                
-                        except BaseException as e:
-                            self.logger.error('handler %s: %s', value, e)
+        self.logger.info('getting updates: %s handlers, %s workers', len(handlers), workers)
+        compiled = self._dispatcher.compile(handlers)
+
+        if self.settings.lua_tables:
+            self._dispatcher.lua_runtime = current_loop().lua_runtime
+
+        pool = None
+        try:
+            if workers > 0:
+                pool = self._pool = WorkerPool(self.logger,
+                                               workers=workers,
+                                               create_dispatcher=self._create_worker_dispatcher,
+                                               key=shard_key,
+                                               queue_size=self.settings.updates_queue_size,
+                                               batch_size=self.settings.update_batch_size)
+
+            with current_loop().attach(self._updates_queue.put_task):
+                while not self._stopped_event.is_set():
+                    try:
+                        # queued tasks come first, then a batch of updates
+                        items = self._updates_queue.get_many(self.settings.update_batch_size, timeout=0.5)
+
+                    except queue.Empty:
+                        continue
+
+                    updates = []
+                    for item in items:
+                        if callable(item):
+                            run_task(self.logger, item)
+
+                        else:
+                            updates.append(item)
+
+                    if not updates:
+                        continue
+
+                    if pool is not None:
+                        for update in updates:
+                            pool.submit(update)
+
+                    else:
+                        # looked up per batch, a reload swaps the dispatcher between two batches
+                        self._dispatcher.dispatch_many(updates)
+
+        finally:
+            if workers > 0:
+                # also after a worker failed to load, its siblings registered their dispatchers
+                if pool is not None:
+                    pool.close()
+
+                self._pool = None
+                self._worker_dispatchers = {}
+                self._dispatchers = [self._dispatcher]
+
+            for handler in compiled:
+                self._dispatcher.remove(handler)
+
+    @tools.arguments
+    def add_handler(self,
+                    handler: Callable,
+                    types: Optional[List[str]] = None,
+                    filters: Optional[Dict[str, object]] = None,
+                    batch: bool = False) -> Handler:
+        self._check_no_workers('add')
+        return self._dispatcher.add(Handler(handler, types, filters, batch))
+
+    def remove_handler(self, handler: Handler) -> None:
+        if not isinstance(handler, Handler):
+            raise TypeError(f'Expected a Handler for \'handler\', but got {type(handler).__name__} instead.')
+
+        self._check_no_workers('remove')
+        self._dispatcher.remove(handler)
+
+    def _check_no_workers(self, action: str) -> None:
+        # workers dispatch with their own copies of the script, the handlers of
+        # this Lua state never see an update, nor can they run on another thread
+        if self._pool is not None and self.script is not None:
+            raise RuntimeError(f'Can not {action} handlers of the main Lua state while get_updates runs workers, '
+                               f'{action} them from the workers\' copy of the script instead.')
+
+    def spawn(self, function: Callable, *args) -> Task:
+        """
+        Run `function(...)` as a coroutine on the calling thread.
+
+        `coroutine.yield(response)` inside it suspends the coroutine until the
+        response is done and resumes it with the response, so a single thread
+        can keep many queries in flight.
+        """
+        if not tools.is_lua_function(function):
+            raise TypeError(f'Expected a function for \'function\', but got {type(function).__name__} instead.')
+
+        task = Task(function.coroutine(*args), current_loop(), self.logger)
+        task.step()
+        return task
+
+    @tools.arguments
+    def gather(self,
+               responses: List[Future],
+               timeout: Optional[float] = None,
+               block: bool = True):
+
+        gathering = Gathering(tools.as_list(responses))
+        if not block:
+            return gathering
+
+        if current_loop().run_until(gathering, timeout=timeout, logger=self.logger):
+            return responses
+
+    @tools.arguments
+    def wait_any(self,
+                 responses: List[Future],
+                 timeout: Optional[float] = None,
+                 block: bool = True):
+
+        first = FirstOf(tools.as_list(responses))
+        if not block:
+            return first
+
+        if current_loop().run_until(first, timeout=timeout, logger=self.logger):
+            return first.update
+
+    @tools.arguments
+    def batch(self,
+              queries: List[dict],
+              concurrency: int = 0,
+              timeout: Optional[float] = None,
+              stream: bool = False):
+
+        if not isinstance(concurrency, int):
+            raise TypeError(f'Expected a int for \'concurrency\', but got {type(concurrency).__name__} instead.')
+
+        batch = Batch(self, tools.as_list(queries), concurrency=concurrency, timeout=timeout)
+        if stream:
+            return batch
+
+        batch.wait()
+        return batch.table()
+
+    def stats(self):
+        """
+        Queue depths and counters, plus per-`@type` latency summaries of
+        queries (`queries`) and handlers (`handlers`) when metrics are enabled.
+        """
+        stats = {
+            'received': self._received,
+            'updates_queue': {
+                'size': self._updates_queue.qsize(),
+                'dropped': self._updates_queue.dropped,
+                'coalesced': self._updates_queue.coalesced
+            },
+            'pending_queries': {
+                'size': len(self._pending_results),
+                'expired': self._pending_results.expired,
+                'rejected': self._pending_results.rejected
+            },
+            'skipped_updates': self._tdjson.skipped,
+            'dropped_log_records': getattr(self._log_handler, 'dropped', 0)
+        }
+
+        if self._throttle is not None:
+            stats['throttle'] = {
+                'delayed': self._throttle.delayed,
+                'flood_waits': self._throttle.flood_waits
+            }
+
+        if self._uploads is not None:
+            stats['uploads'] = {
+                'hits': self._uploads.hits,
+                'learned': self._uploads.learned,
+                'forgotten': self._uploads.forgotten
+            }
+
+        if self.cache is not None:
+            stats['cache'] = {
+                'size': len(self.cache),
+                'hits': self.cache.hits,
+                'misses': self.cache.misses
+            }
+
+        if self._executed is not None:
+            stats['execute_cache'] = {
+                'size': len(self._executed),
+                'hits': self._executed.hits,
+                'misses': self._executed.misses
+            }
+
+        if self.metrics is not None:
+            summary = self.metrics.summary()
+            stats['queries'] = summary.get('query', {})
+            stats['handlers'] = summary.get('handler', {})
+
+        return current_loop().table(stats, recursive=True)
+
+    def _gauges(self) -> Dict[str, float]:
+        return {
+            'updates_queue_size': self._updates_queue.qsize(),
+            'updates_dropped_total': self._updates_queue.dropped,
+            'updates_coalesced_total': self._updates_queue.coalesced,
+            'updates_skipped_total': self._tdjson.skipped,
+            'pending_queries': len(self._pending_results),
+            'queries_expired_total': self._pending_results.expired,
+            'queries_rejected_total': self._pending_results.rejected,
+            'log_records_dropped_total': getattr(self._log_handler, 'dropped', 0)
+        }
+
+    def _export_metrics(self):
+        path = self.settings.metrics_file.replace('%name', self.name)
 
+        try:
+            write_file(path, prometheus(self.name, self.metrics, self._gauges()))
+
+        except Exception as err:
+            # keep exporting, the next interval may succeed
+            self.logger.error('metrics file %s: %s', path, err, exc_info=not isinstance(err, OSError))
+
+        if not self._stopped_event.is_set():
+            self._metrics_timer = scheduler.call_later(self.settings.metrics_interval, self._export_metrics)
+
+    @tools.arguments
+    def download(self,
+                 file_id: int,
+                 priority: int = 1,
+                 offset: int = 0,
+                 limit: int = 0) -> Transfer:
+
+        if not isinstance(file_id, int):
+            raise TypeError(f'Expected a int for \'file_id\', but got {type(file_id).__name__} instead.')
+
+        if not isinstance(priority, int):
+            raise TypeError(f'Expected a int for \'priority\', but got {type(priority).__name__} instead.')
+
+        query = {
+            '@type': 'downloadFile',
+            'file_id': file_id,
+            'priority': priority,
+            'offset': offset,
+            'limit': limit,
+            # progress is followed through updateFile, never block TDLib's answer
+            'synchronous': False
+        }
+        return self._transfers.submit(Transfer(self._transfers, 'download', query))
+
+    @tools.arguments
+    def upload(self,
+               path: str,
+               file_type: str = 'fileTypeDocument',
+               priority: int = 1) -> Transfer:
+
+        if not isinstance(path, str):
+            raise TypeError(f'Expected a string for \'path\', but got {type(path).__name__} instead.')
+
+        if not isinstance(file_type, str):
+            raise TypeError(f'Expected a string for \'file_type\', but got {type(file_type).__name__} instead.')
+
+        query = {
+            '@type': 'preliminaryUploadFile',
+            'file': {'@type': 'inputFileLocal', 'path': os.path.abspath(path)},
+            'file_type': {'@type': file_type},
+            'priority': priority
+        }
+        return self._transfers.submit(Transfer(self._transfers, 'upload', query))
+
+    @tools.arguments
+    def iter_history(self,
+                     chat_id: int,
+                     from_message_id: int = 0,
+                     limit: int = 0,
+                     page_size: int = 100,
+                     depth: int = 1,
+                     only_local: bool = False,
+                     timeout: Optional[float] = None) -> Pager:
+
+        if not isinstance(chat_id, int):
+            raise TypeError(f'Expected a int for \'chat_id\', but got {type(chat_id).__name__} instead.')
+
+        if not isinstance(page_size, int):
+            raise TypeError(f'Expected a int for \'page_size\', but got {type(page_size).__name__} instead.')
+
+        query = {
+            '@type': 'getChatHistory',
+            'chat_id': chat_id,
+            'from_message_id': from_message_id,
+            'offset': 0,
+            'limit': page_size,
+            'only_local': only_local
+        }
+        return Pager(self, query, history_step, limit=limit, depth=depth, timeout=timeout)
+
+    @tools.arguments
+    def iter_search(self,
+                    query: str = '',
+                    chat_id: Optional[int] = None,
+                    sender_id: Optional[dict] = None,
+                    filter: Optional[dict] = None,
+                    limit: int = 0,
+                    page_size: int = 100,
+                    depth: int = 1,
+                    timeout: Optional[float] = None) -> Pager:
+
+        if not isinstance(query, str):
+            raise TypeError(f'Expected a string for \'query\', but got {type(query).__name__} instead.')
+
+        if not isinstance(page_size, int):
+            raise TypeError(f'Expected a int for \'page_size\', but got {type(page_size).__name__} instead.')
+
+        # later pages are sent from the listener thread, which must not touch Lua tables
+        if filter is not None:
+            filter = self._to_query(filter)
+
+        if chat_id is not None:
+            search = {
+                '@type': 'searchChatMessages',
+                'chat_id': chat_id,
+                'query': query,
+                'sender_id': None if sender_id is None else self._to_query(sender_id),
+                'from_message_id': 0,
+                'offset': 0,
+                'limit': page_size,
+                'filter': filter
+            }
+            return Pager(self, search, chat_search_step, limit=limit, depth=depth, timeout=timeout)
+
+        search = {
+            '@type': 'searchMessages',
+            'query': query,
+            'offset': '',
+            'limit': page_size,
+            'filter': filter
+        }
+        return Pager(self, search, search_step, limit=limit, depth=depth, timeout=timeout)
+
+    def _create_worker_dispatcher(self, index: int) -> Dispatcher:
+        # a LuaRuntime is not thread-safe, each worker loads its own copy of the script
+        if self.script is not None:
+            binding = self.script.bind(worker=index)
+            dispatcher = binding.dispatcher(self.name)
+            self._worker_dispatchers[index] = dispatcher
+            self._dispatchers = [self._dispatcher, *self._worker_dispatchers.values()]
+            return dispatcher
+
+        self.logger.warning('worker %s: client has no script, sharing the handlers of the caller', index)
+        return self._dispatcher
+
+    def _reload(self, dispatcher: Dispatcher) -> None:
+        """Swap in the handlers of a reloaded script, on the thread running `get_updates`."""
+        self._dispatcher = dispatcher
+        self._dispatchers = [dispatcher, *self._worker_dispatchers.values()]
+
+        if self._pool is not None:
+            self._pool.reload()
 
     def stop(self):
+        # a second stop must not send to or destroy the TDLib client again
+        with self._stop_lock:
+            if self._stopped_event.is_set():
+                return
+
+            self._stopped_event.set()
+
+        # the listener may be blocked on a full queue, it must not wait out `queue_put_timeout`
+        self._updates_queue.close()
+        # wake `get_updates` now rather than at its next poll
+        self._updates_queue.put_task(lambda: None)
+
+        if self._metrics_timer is not None:
+            self._metrics_timer.cancel()
+
+        if self._listener_thread is not None and self._listener_thread is not threading.current_thread():
+            # any answer ends the listener's wait in receive, it then sees the stop;
+            # `@extra` keeps the answer out of a journal
+            self._tdjson.send({'@type': 'getOption', 'name': 'version', '@extra': {}})
+            self._listener_thread.join()
+
         self._tdjson.stop()
-        self._stopped_event.set()
-        self._listener_thread.join()
+
+        if self._journal is not None:
+            self._journal.close()
+
+        if self._uploads is not None:
+            self._uploads.close()
+
+        if self._log_handler is not None:
+            self._log_handler.flush()
 
     def _send_query(self,
                     query: dict,
                     *,
                     block: bool=True,
-                    query_id: Optional[Union[str, int]] = None):
+                    query_id: Optional[Union[str, int]] = None,
+                    timeout: Optional[float] = None):
         block = bool(block)
-        query = dict(query)
+        query = self._to_query(query)
 
         if not query_id:
-            query_id = uuid.uuid4().hex
+            query_id = next(self._query_ids)
     
         if '@extra' not in query:
             query['@extra'] = {}
 
         query['@extra']['query_id'] = query_id
 
-        self._pending_results[query_id] = result = Response(query=query,
-                                                            client=self,
-                                                            query_id=query_id)
+        digests = None
+        if self._uploads is not None:
+            # the rewritten copy shares @extra with the original
+            original = query
+            query, digests = self._uploads.rewrite(query)
+
+        result = Response(query=query,
+                          client=self,
+                          query_id=query_id)
+
+        if digests:
+            result.fallback = (original, digests)
+
+        if self.settings.cache_queries:
+            cached = self.cache.lookup(query)
+            if cached is not None:
+                result.set_update(cached)
+                return result
+
+        return self._submit(result, block=block, timeout=timeout)
+
+    def _submit(self, result: Response, block: bool, timeout: Optional[float]) -> Response:
+        if self.metrics is not None:
+            result.sent_at = time.perf_counter()
+
+        if not self._pending_results.add(result, timeout=timeout):
+            self.logger.warning('too many pending queries, rejected: %s', result.query.get('@type'))
+            result.set_error(Status.ERROR, {'@type': 'error', 'code': 503, 'message': 'Too many pending queries'})
+            return result
         
         try:
-            self._tdjson.send(query)
+            if self._throttle is None:
+                self._tdjson_send(result)
+
+            else:
+                self._throttle.submit(result)
         
         except Exception as err:
-            self._pending_results.pop(query_id)
-            self.logger.error('send query: %s', query, exc_info=err)
+            self._fail_query(result, err)
+            return result
         
         else:
             if block:
-                result = result.wait()
+                profiler = current_loop().profiler
+                if profiler is None:
+                    result = result.wait()
+
+                else:
+                    started = time.perf_counter()
+                    result = result.wait()
+                    profiler.record(result.query.get('@type') or '?', time.perf_counter() - started)
 
             return result
 
+    def _tdjson_send(self, result: Response) -> None:
+        # late bound, the throttle is built before `_tdjson`
+        if result.payload is not None:
+            self._tdjson.send_bytes(result.payload)
+
+        else:
+            self._tdjson.send(result.query)
+
+    def _fail_query(self, result: Response, err: Exception) -> None:
+        self._pending_results.pop(result.query_id)
+        self.logger.error('send query: %s', result.query, exc_info=err)
+        result.set_error(Status.ERROR, {'@type': 'error', 'code': 400, 'message': str(err)})
+
+    def _retry(self, result: Response, update: dict) -> bool:
+        if self._throttle is not None and self._throttle.retry(result, update):
+            return True
+
+        if result.fallback is not None and is_stale(update):
+            # TDLib rejected a remembered remote id, upload the local files after all
+            original, digests = result.fallback
+            self._uploads.forget(digests)
+            result.query, result.fallback = original, None
+
+            try:
+                self._tdjson.send(original)
+
+            except Exception as err:
+                self._fail_query(result, err)
+
+            return True
+
+        return False
+
+    def _wants_update(self, update_type: str) -> bool:
+        if update_type in self._internal_types:
+            return True
+
+        if self.cache is not None and self.cache.wants(update_type):
+            return True
+
+        if update_type == 'updateFile' and self._transfers.active:
+            return True
+
+        if update_type in UPLOAD_UPDATES and self._uploads is not None and self._uploads.watching:
+            return True
+
+        for dispatcher in self._dispatchers:
+            if dispatcher.wants(update_type):
+                return True
+
+        return False
+
+    def _to_query(self, query) -> dict:
+        if not tools.is_lua_table(query):
+            return dict(query)
+
+        # encode the whole table inside Lua, then decode it at C speed
+        lua_encoder = current_loop().lua_encoder
+        if lua_encoder is not None:
+            try:
+                return self._tdjson.codec.loads(lua_encoder(query))
+
+            except Exception as err:
+                self.logger.debug('lua encoder: %s', err)
+
+        return to_python(query)
+
     def _listener(self):
         self.logger.info('listener started')
+        resolving.active = True
+        limit = self.settings.update_batch_size
         while not self._stopped_event.is_set():
-            update = self._tdjson.receive()
-            if update:
-                extra = update.get('@extra')
-                query_id = None
+            # a burst is drained in one go and queued with a single hand-off
+            updates = [update for update in self._tdjson.receive_many(limit) if self._process(update)]
+            if updates:
+                self._updates_queue.put_many(updates)
+
+    def _on_update(self, update: Optional[dict]):
+        # called on the multiplexed receiver thread, shared by every client of the
+        # process: a full queue drops the update rather than stall the others
+        resolving.active = True
+        if update and self._process(update):
+            self._updates_queue.put(update, block=False)
+
+    def _process(self, update: dict) -> bool:
+        """Resolve the query `update` answers, False when it is held back for a retry instead of queued."""
+        self._received += 1
+        if self.cache is not None:
+            self.cache.feed(update)
+
+        if update.get('@type') == 'updateFile' and self._transfers.active:
+            self._transfers.feed(update)
+
+        if self._uploads is not None and update.get('@type') in UPLOAD_UPDATES and self._uploads.watching:
+            self._uploads.learn(update)
+
+        extra = update.get('@extra')
+        query_id = None
+
+        if update.get('@type') == 'updateAuthorizationState':
+            query_id = update['@type']
+        
+        elif isinstance(extra, dict):
+            query_id = extra.get('query_id')
 
-                if update.get('@type') == 'updateAuthorizationState':
-                    query_id = update['@type']
-                
-                elif isinstance(extra, dict):
-                    query_id = extra.get('query_id')
+        else:
+            self.logger.debug('extra has not been found in the update')
 
-                else:
-                    self.logger.debug('extra has not been found in the update')
+        if not query_id:
+            self.logger.debug('query_id has not been found in the update')
+
+        if update.get('@type') == 'error' and (self._throttle is not None or self._uploads is not None):
+            result = self._pending_results.get(query_id)
+            if result is not None and self._retry(result, update):
+                # stays pending until the query is sent again
+                return False
         
-                if not query_id:
-                    self.logger.debug('query_id has not been found in the update')
-                
-                result = self._pending_results.get(query_id)
+        result = self._pending_results.pop(query_id)
 
-                if result is None:
-                    self.logger.debug('result has not been found in by query_id=%s', query_id)
+        if result is None:
+            self.logger.debug('result has not been found in by query_id=%s', query_id)
 
-                else:
-                    result.set_update(update)
-                    self._pending_results.pop(query_id, None)
+        else:
+            if result.fallback is not None:
+                self._uploads.sent(update, result.fallback[1])
+
+            if result.sent_at is not None:
+                self.metrics.observe('query', result.query.get('@type'), time.perf_counter() - result.sent_at)
+
+            result.set_update(update)
 
-            self._updates_queue.put(update, timeout=self.settings.queue_put_timeout)
+        return True
@@ -0,0 +1,165 @@
+import os
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+# seconds, the last bucket (+Inf) is implicit
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations in seconds."""
+
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, other: 'Histogram') -> None:
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+        self.sum += other.sum
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding the `q` quantile, None when empty or past the last bound."""
+        rank = q * self.count
+        seen = 0
+
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else None
+
+        return None
+
+    def summary(self) -> dict:
+        count = self.count
+        return {
+            'count': count,
+            'sum': self.sum,
+            'mean': self.sum / count if count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)
+        }
+
+
+class Metrics:
+    """
+    Per-`@type` latency histograms of one client.
+
+    Every thread records into its own shard, so recording takes no lock and
+    never contends with other threads; shards are merged when read.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._shards: List[Dict[Tuple[str, str], Histogram]] = []
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict[Tuple[str, str], Histogram]:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+
+        return shard
+
+    def observe(self, kind: str, update_type: Optional[str], value: float) -> None:
+        if not isinstance(update_type, str):
+            # an update or query without `@type`, keys must stay sortable
+            update_type = 'unknown' if update_type is None else str(update_type)
+
+        shard = self._shard()
+        key = (kind, update_type)
+
+        histogram = shard.get(key)
+        if histogram is None:
+            histogram = shard[key] = Histogram()
+
+        histogram.observe(value)
+
+    def histograms(self) -> Dict[Tuple[str, str], Histogram]:
+        merged: Dict[Tuple[str, str], Histogram] = {}
+
+        with self._lock:
+            shards = list(self._shards)
+
+        for shard in shards:
+            # a recording thread may add keys while we read
+            for key, histogram in list(shard.items()):
+                total = merged.get(key)
+                if total is None:
+                    total = merged[key] = Histogram()
+
+                total.merge(histogram)
+
+        return merged
+
+    def summary(self) -> Dict[str, Dict[str, dict]]:
+        result: Dict[str, Dict[str, dict]] = {}
+        for (kind, update_type), histogram in self.histograms().items():
+            result.setdefault(kind, {})[update_type] = histogram.summary()
+
+        return result
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus(client_name: str, metrics: Metrics, gauges: Dict[str, float]) -> str:
+    """Render `metrics` and `gauges` in the Prometheus text exposition format."""
+    client_label = 'client="%s"' % escape(client_name)
+    lines = []
+
+    by_kind: Dict[str, List[Tuple[str, Histogram]]] = {}
+    for (kind, update_type), histogram in sorted(metrics.histograms().items(), key=lambda item: tuple(map(str, item[0]))):
+        by_kind.setdefault(kind, []).append((update_type, histogram))
+
+    for kind, histograms in by_kind.items():
+        name = 'luagram_%s_duration_seconds' % kind
+        lines.append('# TYPE %s histogram' % name)
+
+        for update_type, histogram in histograms:
+            labels = '%s,type="%s"' % (client_label, escape(update_type))
+            cumulative = 0
+
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+
+            lines.append('%s_sum{%s} %r' % (name, labels, histogram.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, cumulative))
+
+    for name, value in gauges.items():
+        metric = 'luagram_%s' % name
+        lines.append('# TYPE %s %s' % (metric, 'counter' if name.endswith('_total') else 'gauge'))
+        lines.append('%s{%s} %s' % (metric, client_label, value))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_file(path: str, text: str) -> None:
+    # write then rename, a scraper never sees a half-written file
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+
+    temporary = '%s.tmp' % path
+    with open(temporary, 'w') as file:
+        file.write(text)
+
+    os.replace(temporary, path)
@@ -0,0 +1,148 @@
+import threading
+import collections
+from typing import TYPE_CHECKING, Optional, Callable
+
+from .enums import Status
+from .response import Response
+
+
+if TYPE_CHECKING:
+    from .luagram import LuagramClient
+
+
+def history_step(query: dict, page: dict) -> Optional[dict]:
+    """getChatHistory: continue from the oldest message of the page, which TDLib sends again."""
+    from_message_id = page['messages'][-1]['id']
+    if from_message_id != query.get('from_message_id'):
+        return dict(query, from_message_id=from_message_id, offset=0)
+
+
+def chat_search_step(query: dict, page: dict) -> Optional[dict]:
+    """searchChatMessages: continue from `next_from_message_id`, 0 at the end."""
+    next_from_message_id = page.get('next_from_message_id')
+    if next_from_message_id:
+        return dict(query, from_message_id=next_from_message_id)
+
+
+def search_step(query: dict, page: dict) -> Optional[dict]:
+    """searchMessages: continue from `next_offset`, empty at the end."""
+    next_offset = page.get('next_offset')
+    if next_offset:
+        return dict(query, offset=next_offset)
+
+
+class Pager:
+    """
+    Lua generic-for iterator over the messages of a paginated query:
+    `for message in client.iter_history{chat_id = chat_id} do ... end`.
+
+    The next page is requested as soon as the current one arrives, from the
+    listener thread, so it travels while Lua is still busy with the current
+    page; up to `depth` pages are kept ahead. `step` builds the query of the
+    next page from the last one, messages the previous page already handed
+    out (pages overlap at their boundary) are skipped and iteration stops
+    after `limit` messages (0 for all). On error the iterator ends and
+    `status`/`error_info` tell why.
+    """
+
+    def __init__(self,
+                 client: 'LuagramClient',
+                 query: dict,
+                 step: Callable[[dict, dict], Optional[dict]],
+                 limit: int = 0,
+                 depth: int = 1,
+                 timeout: Optional[float] = None) -> None:
+
+        self.client = client
+        self.limit = limit
+        self.depth = max(depth, 1)
+        self.timeout = timeout
+
+        self.count = 0
+        self.status = Status.PENDING
+        self.error_info = None
+
+        self._step = step
+        self._next_query = query
+        self._fetching = False
+        self._pages = collections.deque()
+        self._items = collections.deque()
+        # keys handed out from the previous page and from the current one
+        self._seen = set()
+        self._current = set()
+        self._condition = threading.Condition()
+
+        self._fetch()
+
+    def __call__(self, *args):
+        return self.next()
+
+    def next(self) -> Optional[dict]:
+        """The next message, None once the history is exhausted."""
+        while True:
+            while self._items:
+                item = self._items.popleft()
+                key = item.get('chat_id'), item.get('id')
+                if key in self._seen or key in self._current:
+                    continue
+
+                self._current.add(key)
+                self.count += 1
+                return item
+
+            if 0 < self.limit <= self.count:
+                return self._finish()
+
+            with self._condition:
+                ready = self._condition.wait_for(
+                    lambda: self._pages or (not self._fetching and self._next_query is None), timeout=self.timeout)
+
+                if not self._pages:
+                    if not ready:
+                        self.status = Status.TIMEOUT
+                        self.error_info = {'@type': 'error', 'code': 408, 'message': 'Page timed out'}
+
+                    return self._finish()
+
+                items = self._pages.popleft()
+
+            self._seen, self._current = self._current, set()
+            self._items.extend(items[:self.limit - self.count] if self.limit else items)
+            self._fetch()
+
+    def _finish(self) -> None:
+        if self.status is Status.PENDING:
+            self.status = Status.OK
+
+        with self._condition:
+            self._next_query = None
+
+    def _fetch(self) -> None:
+        with self._condition:
+            if self._fetching or self._next_query is None or len(self._pages) >= self.depth:
+                return
+
+            self._fetching = True
+            query = self._next_query
+
+        result = self.client._send_query(query, block=False, timeout=self.timeout)
+        result.on_done(self._on_page)
+
+    def _on_page(self, result: Response) -> None:
+        with self._condition:
+            self._fetching = False
+
+            if result.status is not Status.OK:
+                self.status = result.status
+                self.error_info = result.error_info
+                self._next_query = None
+
+            else:
+                page = result.update
+                messages = page.get('messages') or []
+                self._pages.append(messages)
+                self._next_query = self._step(self._next_query, page) if messages and self._next_query else None
+
+            self._condition.notify_all()
+
+        self._fetch()
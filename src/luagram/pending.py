@@ -0,0 +1,118 @@
+import threading
+from logging import Logger
+from typing import Optional, Union, Dict
+
+from .enums import Status, QueuePolicy
+from .response import Response
+from .gadget.scheduler import scheduler
+
+
+QueryId = Union[str, int]
+
+# marks the threads resolving pending queries (the listener, the multiplexed
+# receiver): a query they send is never made to wait for a slot only they can free
+resolving = threading.local()
+
+
+class PendingQueries:
+    """
+    Queries sent to TDLib and still waiting for their result.
+
+    Every entry may carry a deadline; when it passes the entry is evicted and
+    its `Response` resolved with `Status.TIMEOUT`, so lost results can not
+    pile up. `max_size` caps the number of queries in flight: at the cap
+    `policy` either blocks the sender until a slot frees up, rejects the new
+    query (`drop_newest`) or gives up on the oldest one (`drop_oldest`).
+    Under `block`, follow-up queries sent while resolving a result (the next
+    page of a pager, the next queued transfer) are let in over the cap.
+    """
+
+    def __init__(self,
+                 logger: Logger,
+                 max_size: int = 0,
+                 policy: QueuePolicy = QueuePolicy.BLOCK,
+                 timeout: Optional[float] = None) -> None:
+
+        if policy is QueuePolicy.PRIORITY:
+            raise ValueError('pending queries do not support the priority policy')
+
+        self.logger = logger
+        self.policy = policy
+        self.timeout = timeout
+        self.max_size = max_size
+
+        self.expired = 0
+        self.rejected = 0
+
+        self._results: Dict[QueryId, Response] = {}
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self) -> int:
+        return len(self._results)
+
+    def __contains__(self, query_id: QueryId) -> bool:
+        return query_id in self._results
+
+    def get(self, query_id: QueryId) -> Optional[Response]:
+        return self._results.get(query_id)
+
+    def add(self, result: Response, timeout: Optional[float] = None) -> bool:
+        """Register `result`, return False if it was rejected because the table is full."""
+        if timeout is None:
+            timeout = self.timeout
+
+        evicted = None
+        with self._lock:
+            if result.query_id not in self._results and 0 < self.max_size <= len(self._results):
+                overflow = self.policy is QueuePolicy.BLOCK and getattr(resolving, 'active', False)
+
+                if self.policy is QueuePolicy.BLOCK and not overflow:
+                    self._not_full.wait_for(lambda: len(self._results) < self.max_size, timeout=timeout)
+
+                elif self.policy is QueuePolicy.DROP_OLDEST:
+                    evicted = self._pop(next(iter(self._results)))
+
+                if len(self._results) >= self.max_size and not overflow:
+                    self.rejected += 1
+                    return False
+
+            previous = self._results.pop(result.query_id, None)
+            if previous is not None and previous.deadline is not None:
+                previous.deadline.cancel()
+
+            self._results[result.query_id] = result
+            if timeout:
+                result.deadline = scheduler.call_later(timeout, self._expire, result.query_id, result)
+
+        if evicted is not None:
+            self.expired += 1
+            evicted.set_error(Status.TIMEOUT, {'@type': 'error', 'code': 408, 'message': 'Evicted by a newer query'})
+
+        return True
+
+    def pop(self, query_id: QueryId) -> Optional[Response]:
+        with self._lock:
+            return self._pop(query_id)
+
+    def _pop(self, query_id: QueryId) -> Optional[Response]:
+        result = self._results.pop(query_id, None)
+
+        if result is not None:
+            if result.deadline is not None:
+                result.deadline.cancel()
+
+            self._not_full.notify()
+
+        return result
+
+    def _expire(self, query_id: QueryId, result: Response) -> None:
+        with self._lock:
+            if self._results.get(query_id) is not result:
+                return
+
+            self._pop(query_id)
+
+        self.expired += 1
+        self.logger.debug('query_id=%s timed out', query_id)
+        result.set_error(Status.TIMEOUT, {'@type': 'error', 'code': 408, 'message': 'Query timed out'})
@@ -0,0 +1,266 @@
+import os
+import time
+import logging
+import threading
+import collections
+from typing import Dict, Iterable, Optional
+
+from .gadget.tools import arguments
+
+
+logger = logging.getLogger('luagram.profiler')
+
+
+# count hook attributing the time since the previous sample to the current
+# stack; `enter` starts a new root (the update type) and resets the clock
+LUA_PROFILER = '''
+local clock, interval = ...
+local SOURCE = '=luagram.profiler'
+local getinfo, sethook, concat, insert = debug.getinfo, debug.sethook, table.concat, table.insert
+local profiler = {root = 'lua', samples = {}}
+local last = clock()
+
+local function stack(level)
+    local frames = {}
+    while true do
+        local info = getinfo(level, 'Sln')
+        if info == nil then
+            break
+        end
+
+        -- C functions and the profiler itself are left out
+        if info.what ~= 'C' and info.source ~= SOURCE then
+            local name = info.name or (info.what == 'main' and 'main' or 'function:' .. info.linedefined)
+            insert(frames, 1, name .. ' (' .. info.short_src .. ':' .. info.currentline .. ')')
+        end
+
+        level = level + 1
+    end
+
+    insert(frames, 1, profiler.root)
+    return concat(frames, ';')
+end
+
+local function add(key, seconds)
+    local samples = profiler.samples
+    samples[key] = (samples[key] or 0) + seconds
+end
+
+local function hook()
+    add(stack(3), clock() - last)
+    last = clock()
+end
+
+function profiler.enter(root)
+    profiler.root = root
+    last = clock()
+end
+
+function profiler.record(query_type, seconds)
+    add(stack(3) .. ';query:' .. query_type, seconds)
+    last = clock()
+end
+
+function profiler.start(count)
+    -- compiled traces never call hooks
+    if jit then
+        jit.off()
+        jit.flush()
+    end
+
+    last = clock()
+    sethook(hook, '', count or interval)
+end
+
+function profiler.stop()
+    sethook()
+    if jit then
+        jit.on()
+    end
+end
+
+return profiler
+'''
+
+
+def collapse(samples: Dict[str, float]) -> str:
+    """Samples in the collapsed-stack format of flamegraph tools, weighted in microseconds."""
+    lines = []
+    for stack, seconds in sorted(samples.items()):
+        micros = int(seconds * 1e6)
+        if micros > 0:
+            lines.append('%s %d' % (stack, micros))
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def merge(profilers: Iterable['Profiler']) -> Dict[str, float]:
+    samples = collections.Counter()
+    for profiler in profilers:
+        samples.update(profiler.samples)
+
+    return samples
+
+
+def write(path: str, samples: Dict[str, float]) -> None:
+    dir_name = os.path.dirname(path)
+    if dir_name and not os.path.isdir(dir_name):
+        os.makedirs(dir_name)
+
+    with open(path, 'w') as file:
+        file.write(collapse(samples))
+
+
+class Profiler:
+    """
+    Sampling profiler of one Lua state, exposed to Lua as `profiler`.
+
+    A debug count hook fires every `interval` Lua instructions and charges
+    the time since the previous sample to the current stack, rooted at the
+    update type being handled (or `task` for callbacks). Blocking queries
+    add a `query:<@type>` frame with their round trip. The hook belongs to
+    the Lua state, so `start` and `stop` must run on the thread owning it;
+    samples are copied to Python on `stop`.
+    """
+
+    def __repr__(self) -> str:
+        return 'Profiler<%s, %s samples>' % ('running' if self.running else 'stopped', len(self.samples))
+
+    def __init__(self, lua_runtime, loop, interval: int = 1000) -> None:
+        self.loop = loop
+        self.interval = interval
+        self.running = False
+        self.samples = collections.Counter()
+
+        self._lua_runtime = lua_runtime
+        self._lua = lua_runtime.execute(LUA_PROFILER, time.perf_counter, interval, name='=luagram.profiler')
+
+    @arguments
+    def start(self, interval: Optional[int] = None) -> None:
+        if interval is not None:
+            if not isinstance(interval, int):
+                raise TypeError(f'Expected a int for \'interval\', but got {type(interval).__name__} instead.')
+
+            self.interval = interval
+
+        if not self.running:
+            self.running = True
+            self._lua.start(self.interval)
+            self.loop.profiler = self
+
+    def stop(self) -> None:
+        if not self.running:
+            return
+
+        self._lua.stop()
+        self.running = False
+        if self.loop.profiler is self:
+            self.loop.profiler = None
+
+        samples = self._lua.samples
+        self.samples.update(dict(samples.items()))
+        self._lua.samples = self._lua_runtime.table()
+
+    def reset(self) -> None:
+        self.samples.clear()
+
+    @arguments
+    def write(self, path: str) -> None:
+        """Write the samples collected so far, stopping first if running."""
+        if not isinstance(path, str):
+            raise TypeError(f'Expected a string for \'path\', but got {type(path).__name__} instead.')
+
+        self.stop()
+        write(path, self.samples)
+
+    def enter(self, root: str) -> None:
+        self._lua.enter(root)
+
+    def record(self, query_type: str, seconds: float) -> None:
+        self._lua.record(query_type, seconds)
+
+
+class Profiling:
+    """
+    The profilers of every Lua state of a script, one per owning thread.
+
+    `toggle` starts all of them, or stops all of them and writes their
+    merged samples to `path` once every owning thread has stopped its own.
+    A thread whose loop exits (a worker) drops its profiler, its samples
+    still go into the next profile written.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.profilers: Dict[object, Profiler] = {}
+        self._lock = threading.Lock()
+        self._running = False
+        # profilers a stop still waits for, and all of them to merge
+        self._stopping = set()
+        self._stopped = []
+        # profilers dropped while profiling, merged by the next stop
+        self._retired = []
+
+    def add(self, profiler: Profiler) -> None:
+        """Register the profiler of a new Lua state, replacing (and continuing) the one its thread had."""
+        with self._lock:
+            previous = self.profilers.get(profiler.loop)
+            self.profilers[profiler.loop] = profiler
+
+        if previous is None:
+            profiler.loop.on_close(lambda: self.remove(profiler.loop))
+
+        else:
+            # a reload, on the thread owning both states
+            running = previous.running
+            previous.stop()
+            profiler.samples = previous.samples
+            profiler.interval = previous.interval
+            if running:
+                profiler.start()
+
+    def toggle(self) -> None:
+        with self._lock:
+            self._running = not self._running
+            profilers = list(self.profilers.values())
+            retired, self._retired = self._retired, []
+
+        if self._running:
+            logger.info('profiling %s Lua states', len(profilers))
+            for profiler in profilers:
+                profiler.reset()
+                profiler.loop.call_soon(profiler.start)
+
+            return
+
+        with self._lock:
+            self._stopping = set(profilers)
+            self._stopped = profilers + retired
+
+        for profiler in profilers:
+            profiler.loop.call_soon(self._stop, profiler)
+
+    def remove(self, loop) -> None:
+        """Drop the profiler of `loop`, on its thread once the loop exited."""
+        with self._lock:
+            profiler = self.profilers.pop(loop, None)
+            if profiler is not None and self._running:
+                self._retired.append(profiler)
+
+        if profiler is not None:
+            self._stop(profiler)
+
+    def _stop(self, profiler: Profiler) -> None:
+        profiler.stop()
+        with self._lock:
+            if profiler not in self._stopping:
+                return
+
+            self._stopping.discard(profiler)
+            if self._stopping:
+                return
+
+            profilers, self._stopped = self._stopped, []
+
+        write(self.path, merge(profilers))
+        logger.info('profile written to %s', self.path)
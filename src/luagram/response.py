@@ -1,40 +1,97 @@
+import logging
 import threading
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Callable, List
 
 from .enums import Status
-from .gadget.tools import arguments
+from .loop import Loop, current_loop
+from .gadget.tools import arguments, is_lua_function
 
 
 if TYPE_CHECKING:
     from .luagram import Luagram
 
 
-class Response:
-    def __repr__(self) -> str:
-        return 'Response<%s, %s>' % (self.status, self.query_id)
+logger = logging.getLogger('luagram.response')
 
-    def __init__(self, query: dict, client: 'Luagram', query_id: str) -> None:
 
-        self.query = query
-        self.client = client
-        self.query_id = query_id
-        
+class Future:
+    def __init__(self) -> None:
         self.update = None
         self.status = Status.PENDING
         self.error_info = None
+        self._callbacks = []
+        self._lock = threading.Lock()
         self._result_event = threading.Event()
-    
+
     @property
     def done(self):
         return self._result_event.is_set()
 
     @arguments
     def wait(self, timeout: int=None):
-        self._result_event.wait(timeout=timeout)
+        current_loop().run_until(self, timeout=timeout)
 
         if self.done:
             return self
 
+    def on_done(self, callback: Callable):
+        """
+        Call `callback(self)` once the result is available.
+
+        Lua callbacks run on the thread that registered them, the next time
+        its dispatcher picks up a task; Python callbacks run on whichever
+        thread resolves the result.
+        """
+        if is_lua_function(callback):
+            callback = self._bind_loop(callback)
+
+        with self._lock:
+            if not self.done:
+                self._callbacks.append(callback)
+                return self
+
+        callback(self)
+        return self
+
+    @staticmethod
+    def _bind_loop(callback: Callable) -> Callable:
+        loop = current_loop()
+        return lambda future: loop.call_soon(callback, future)
+
+    def _resolve(self):
+        with self._lock:
+            self._result_event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback(self)
+
+            except Exception as err:
+                self._log_error('on_done %s: %s', callback, err)
+
+    def _log_error(self, msg: str, *args):
+        logger.error(msg, *args)
+
+
+class Response(Future):
+    def __repr__(self) -> str:
+        return 'Response<%s, %s>' % (self.status, self.query_id)
+
+    def __init__(self, query: dict, client: 'Luagram', query_id: str) -> None:
+        super().__init__()
+
+        self.query = query
+        self.client = client
+        self.query_id = query_id
+        self.deadline = None
+        self.sent_at = None
+        self.retries = 0
+        # (query with local files, digests) when uploaded files were swapped for remote ids
+        self.fallback = None
+        # the encoded query, for queries sent from a prepared template
+        self.payload = None
+
 
     def set_update(self, update: dict):
         update_type = update.get('@type')
@@ -43,11 +100,126 @@ class Response:
         if update_type == 'error':
             self.status = Status.ERROR
             self.error_info = update
-        
+
         else:
             self.status = Status.OK
             self.update = update
 
-        return self._result_event.set()
+        return self._resolve()
+
+    def set_error(self, status: Status, error_info: dict):
+        self.client.logger.debug('query_id=%s status=%s', self.query_id, status)
+
+        self.status = status
+        self.error_info = error_info
+        return self._resolve()
+
+    def _log_error(self, msg: str, *args):
+        self.client.logger.error(msg, *args)
+
+
+class Gathering(Future):
+    """Resolves once every one of `futures` is done, `update` holds them in order."""
+
+    def __repr__(self) -> str:
+        return 'Gathering<%s, %s/%s>' % (self.status, len(self.update) - self._remaining, len(self.update))
+
+    def __init__(self, futures: List[Future]) -> None:
+        super().__init__()
+
+        self.update = futures
+        self._remaining = len(futures)
+        self._counter_lock = threading.Lock()
+
+        if not futures:
+            self.status = Status.OK
+            self._resolve()
+
+        for future in futures:
+            future.on_done(self._on_child_done)
+
+    def _on_child_done(self, future: Future):
+        with self._counter_lock:
+            self._remaining -= 1
+            if self._remaining:
+                return
+
+        self.status = Status.OK
+        self._resolve()
+
+
+class FirstOf(Future):
+    """Resolves as soon as one of `futures` is done, `update` holds that one."""
+
+    def __repr__(self) -> str:
+        return 'FirstOf<%s, %s>' % (self.status, self.update)
+
+    def __init__(self, futures: List[Future]) -> None:
+        super().__init__()
+
+        for future in futures:
+            future.on_done(self._on_child_done)
+
+    def _on_child_done(self, future: Future):
+        with self._lock:
+            if self.update is not None:
+                return
+
+            self.update = future
+
+        self.status = Status.OK
+        self._resolve()
+
+
+class Task(Future):
+    """
+    A Lua coroutine driven by the futures it yields.
+
+    Every time the coroutine yields a future it is suspended until that future
+    is done and then resumed with it, on the loop of the thread that spawned
+    it. Yielding anything else just gives other tasks a turn. `update` holds
+    the value the coroutine returned.
+    """
+
+    def __repr__(self) -> str:
+        return 'Task<%s, %s>' % (self.status, self._coroutine)
+
+    def __init__(self, coroutine, loop: 'Loop', logger: logging.Logger) -> None:
+        super().__init__()
+
+        self.logger = logger
+        self._loop = loop
+        self._coroutine = coroutine
+
+    def step(self, value=None):
+        try:
+            yielded = self._coroutine.send(value)
+
+        except StopIteration as e:
+            # lupa's way of ending a coroutine that returned nothing
+            self.status = Status.OK
+            self.update = e.value
+            return self._resolve()
+
+        except BaseException as e:
+            self.logger.error('task %s: %s', self, e)
+            self.status = Status.ERROR
+            self.error_info = {'@type': 'error', 'code': 500, 'message': str(e)}
+            return self._resolve()
+
+        if not self._coroutine:
+            self.status = Status.OK
+            self.update = yielded
+            return self._resolve()
+
+        if isinstance(yielded, Future):
+            yielded.on_done(self._wake)
+
+        else:
+            self._loop.call_soon(self.step, yielded)
+
+    def _wake(self, future: Future):
+        self._loop.call_soon(self.step, future)
 
-    
\ No newline at end of file
+    def _log_error(self, msg: str, *args):
+        self.logger.error(msg, *args)
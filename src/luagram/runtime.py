@@ -0,0 +1,268 @@
+import os
+import lupa
+import time
+import logging
+import threading
+import importlib
+from typing import Optional, Dict
+
+from . import enums
+from .enums import Status
+from .gadget import tools
+from .dispatcher import Dispatcher, Handler
+from .loop import current_loop
+from .response import Response
+from .profiler import Profiler, Profiling
+from .luagram import LuagramClient, Params, Settings, BaseLogger
+
+
+LUA_VERSION = os.getenv('LUAGRAM_LUA_VERSION', 'jit')
+
+logger = logging.getLogger('luagram.script')
+
+LUA_VERSIONS = {
+    '5.1': 'lupa.lua51',
+    '5.2': 'lupa.lua52',
+    '5.3': 'lupa.lua53',
+    '5.4': 'lupa.lua54',
+    'jit': 'lupa.luajit21'
+}
+
+
+def load_lua(version: str):
+    with lupa.allow_lua_module_loading():
+        return importlib.import_module(LUA_VERSIONS[version])
+
+
+class Script:
+    """
+    A Lua script and everything needed to load it into a fresh `LuaRuntime`.
+
+    `execute` runs the script for real. `bind` loads it again into a new Lua
+    state whose `create_new_client` hands back the clients the first run
+    created, so a worker thread can get its own copy of the handlers.
+    `reload` does the same with the script's current source and hands the
+    new handlers to the running clients.
+    """
+
+    def __init__(self, name: str, source: str, version: str = LUA_VERSION, path: Optional[str] = None) -> None:
+        if version not in LUA_VERSIONS:
+            raise ValueError(f'Unknown lua version {version!r}, expected one of {", ".join(LUA_VERSIONS)}.')
+
+        self.name = name
+        self.path = path
+        self.source = source
+        self.version = version
+        self.clients: Dict[str, LuagramClient] = {}
+        # passed to every client the script creates, see `LuagramClient`
+        self.transport = None
+        # the thread that executed the script, reloads run there
+        self.loop = None
+        self.binding = None
+        self.profiling = Profiling(os.path.join('.app-data', '%s.folded' % name))
+
+    def create_runtime(self, binding: Optional['Binding'] = None):
+        lua = load_lua(self.version)
+
+        lua_runtime = lua.LuaRuntime(unpack_returned_tuples=True)
+        loop = current_loop()
+        loop.lua_runtime = lua_runtime
+
+        variables = lua_runtime.globals()
+        variables.name = self.name
+
+        variables.enums = enums
+        variables.Params = Params
+        variables.Settings = Settings
+        variables.BaseLogger = BaseLogger
+        variables.create_new_client = self._create_client if binding is None else binding.create_client
+
+        variables.profiler = Profiler(lua_runtime, loop)
+        self.profiling.add(variables.profiler)
+
+        return lua_runtime
+
+    def execute(self):
+        self.loop = current_loop()
+        lua_runtime = self.create_runtime()
+        return lua_runtime.execute(self.source)
+
+    def bind(self, worker: Optional[int] = None) -> 'Binding':
+        binding = Binding(self)
+        binding.lua_runtime = self.create_runtime(binding)
+        binding.lua_runtime.globals().worker = worker
+
+        # the first run already sent the script's top-level queries
+        binding.loading = True
+        try:
+            binding.lua_runtime.execute(self.source)
+
+        finally:
+            binding.loading = False
+
+        return binding
+
+    def reload(self) -> bool:
+        """
+        Run the script again in a new Lua state and swap its handlers in.
+
+        Must run on the thread that executed the script, `request_reload`
+        posts it there. Clients, their TDLib sessions, pending queries and
+        queued updates are kept; a script that fails to load leaves the
+        running handlers in place.
+        """
+        loop = current_loop()
+        previous_runtime, previous_source = loop.lua_runtime, self.source
+
+        try:
+            if self.path is not None:
+                with open(self.path) as file:
+                    self.source = file.read()
+
+            binding = self.bind()
+
+        except Exception as err:
+            logger.error('%s: reload failed, keeping the running handlers: %s', self.name, err)
+            loop.lua_runtime, self.source = previous_runtime, previous_source
+            return False
+
+        self.binding = binding
+        for name, client in self.clients.items():
+            client._reload(binding.dispatcher(name))
+
+        logger.info('%s: reloaded', self.name)
+        return True
+
+    def request_reload(self) -> None:
+        """Reload from any thread once the script's thread picks up the task, not from a signal handler."""
+        if self.loop is not None:
+            self.loop.call_soon(self.reload)
+
+    def watch(self, interval: float = 1.0) -> threading.Thread:
+        """Request a reload whenever the file at `path` changes."""
+        def run():
+            mtime = os.stat(self.path).st_mtime_ns
+            while True:
+                time.sleep(interval)
+                try:
+                    current = os.stat(self.path).st_mtime_ns
+
+                except OSError:
+                    continue
+
+                if current != mtime:
+                    mtime = current
+                    self.request_reload()
+
+        thread = threading.Thread(target=run, name='luagram-watch', daemon=True)
+        thread.start()
+        return thread
+
+    def _create_client(self, table=None) -> LuagramClient:
+        if self.transport is not None:
+            table.transport = self.transport
+
+        client = LuagramClient(table)
+        client.script = self
+        self.clients[client.name] = client
+        return client
+
+
+class Binding:
+    """A Lua state running a second copy of a script against its live clients."""
+
+    def __init__(self, script: Script) -> None:
+        self.script = script
+        self.lua_runtime = None
+        self.dispatchers: Dict[str, Dispatcher] = {}
+        # true while the copy of the script runs its top level
+        self.loading = False
+
+    def dispatcher(self, name: str) -> Dispatcher:
+        dispatcher = self.dispatchers.get(name)
+        if dispatcher is None:
+            client = self.script.clients[name]
+            lua_runtime = self.lua_runtime if client.settings.lua_tables else None
+            dispatcher = self.dispatchers[name] = Dispatcher(client.logger,
+                                                             lua_runtime=lua_runtime,
+                                                             metrics=client.metrics,
+                                                             stopped=client._stopped_event)
+
+        return dispatcher
+
+    @tools.arguments
+    def create_client(self, name: str, *args, **kwargs) -> 'BoundClient':
+        client = self.script.clients.get(name)
+
+        if client is None:
+            raise KeyError(f'client {name!r} was not created by the script {self.script.name!r}')
+
+        return BoundClient(self, client)
+
+
+class BoundClient:
+    """
+    Stand-in for a `LuagramClient` inside a `Binding`.
+
+    Queries go to the real client, while `start`, `stop` and `get_updates`
+    only register handlers with the binding's dispatcher. While the copy
+    runs its top level only read-only queries (`get...`, `search...`) are
+    sent, the others were sent by the first run already: such a query
+    returns an error response with an empty `update`, the other sending
+    methods return nil.
+    """
+
+    SENDING = frozenset(('batch', 'download', 'upload', 'iter_history', 'iter_search'))
+    READ_ONLY = ('get', 'search')
+
+    def __init__(self, binding: Binding, client: LuagramClient) -> None:
+        self._binding = binding
+        self._client = client
+
+    def __getattr__(self, name: str):
+        if name in self.SENDING and self._binding.loading:
+            return self._skip
+
+        return getattr(self._client, name)
+
+    def __call__(self, table=None):
+        if self._binding.loading:
+            if not self._read_only(table):
+                self._skip()
+                result = Response(query={}, client=self._client, query_id=None)
+                result.set_error(Status.ERROR, {'@type': 'error', 'code': 400, 'message': 'Not sent while a copy of the script loads'})
+                # top-level code such as `client{...}.update.id` reads nil instead of failing the load
+                result.update = current_loop().table({})
+                return result
+
+        return self._client(table)
+
+    def _read_only(self, table) -> bool:
+        # `table` holds the arguments of `client{query, ...}`
+        query = None
+        if table is not None:
+            query = table[1] if table[1] is not None else table['query']
+
+        query_type = query['@type'] if query is not None else None
+        return isinstance(query_type, str) and query_type.startswith(self.READ_ONLY)
+
+    def _skip(self, *args, **kwargs) -> None:
+        logger.debug('%s: query of a loading copy not sent', self._client.name)
+
+    @tools.arguments
+    def start(self, *args, **kwargs) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+    @tools.arguments
+    def get_updates(self, handlers, *args, **kwargs) -> None:
+        self._binding.dispatcher(self._client.name).compile(handlers)
+
+    @tools.arguments
+    def add_handler(self, handler, types=None, filters=None, batch=False) -> Handler:
+        return self._binding.dispatcher(self._client.name).add(Handler(handler, types, filters, batch))
+
+    def remove_handler(self, handler: Handler) -> None:
+        self._binding.dispatcher(self._client.name).remove(handler)
@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import queue
+import signal
+import logging
+import threading
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Dict, List
+
+from .runtime import Script, LUA_VERSION, LUA_VERSIONS
+
+
+logger = logging.getLogger('luagram.supervisor')
+
+
+def load_manifest(path: str) -> List[dict]:
+    """
+    Read the sessions of a JSON manifest.
+
+    The manifest is a list of sessions, or an object with a `sessions` list,
+    each one `{"name": ..., "script": ..., "version": ...}`; `version` is
+    optional and relative script paths are resolved against the manifest.
+    """
+    with open(path) as file:
+        manifest = json.load(file)
+
+    sessions = manifest.get('sessions') if isinstance(manifest, dict) else manifest
+    if not isinstance(sessions, list):
+        raise TypeError(f'Expected a list for \'sessions\', but got {type(sessions).__name__} instead.')
+
+    root = os.path.dirname(os.path.abspath(path))
+    names = set()
+    result = []
+
+    for session in sessions:
+        if not isinstance(session, dict):
+            raise TypeError(f'Expected a object for \'session\', but got {type(session).__name__} instead.')
+
+        name = session.get('name')
+        script = session.get('script')
+        version = session.get('version', LUA_VERSION)
+
+        if not isinstance(name, str):
+            raise TypeError(f'Expected a string for \'name\', but got {type(name).__name__} instead.')
+
+        if not isinstance(script, str):
+            raise TypeError(f'Expected a string for \'script\', but got {type(script).__name__} instead.')
+
+        if version not in LUA_VERSIONS:
+            raise ValueError(f'Unknown lua version {version!r}, expected one of {", ".join(LUA_VERSIONS)}.')
+
+        if name in names:
+            raise ValueError(f'Session {name!r} is listed twice.')
+
+        names.add(name)
+        result.append({'name': name, 'script': os.path.join(root, script), 'version': version})
+
+    return result
+
+
+def run_worker(index: int, sessions: List[dict], reports, interval: float) -> None:
+    """
+    Worker process: run every session on its own thread with its own Lua state.
+
+    Stats of every client are sent to the supervisor every `interval`
+    seconds. If a session fails, the worker exits with an error so the
+    supervisor restarts it with all of its sessions.
+    """
+    finished = queue.SimpleQueue()
+    scripts: Dict[str, Script] = {}
+
+    def run_session(script: Script) -> None:
+        error = None
+        try:
+            script.execute()
+
+        except BaseException as e:
+            error = '%s: %s' % (type(e).__name__, e)
+
+        finished.put((script.name, error))
+
+    for session in sessions:
+        os.makedirs(os.path.join('.app-data', session['name']), exist_ok=True)
+
+        with open(session['script']) as file:
+            source = file.read()
+
+        script = scripts[session['name']] = Script(session['name'],
+                                                   source,
+                                                   version=session['version'],
+                                                   path=session['script'])
+
+        thread = threading.Thread(target=run_session, args=(script,), name='session-%s' % script.name, daemon=True)
+        thread.start()
+
+    running = len(scripts)
+    while running:
+        try:
+            name, error = finished.get(timeout=interval)
+
+        except queue.Empty:
+            reports.put(('stats', index, collect_stats(scripts)))
+            continue
+
+        if error is not None:
+            reports.put(('error', index, {'session': name, 'error': error}))
+            sys.exit(1)
+
+        running -= 1
+
+    reports.put(('stats', index, collect_stats(scripts)))
+
+
+def collect_stats(scripts: Dict[str, Script]) -> Dict[str, dict]:
+    stats = {}
+    for name, script in scripts.items():
+        stats[name] = {client_name: client.stats() for client_name, client in list(script.clients.items())}
+
+    return stats
+
+
+def assign(sessions: List[dict], workers: int) -> List[List[dict]]:
+    """
+    Spread `sessions` over at most `workers` groups (more if there are more Lua versions).
+
+    lupa can not load different Lua versions into one process, so every group
+    holds sessions of a single version; versions get workers in proportion to
+    their number of sessions, at least one each.
+    """
+    by_version: Dict[str, List[dict]] = {}
+    for session in sessions:
+        by_version.setdefault(session['version'], []).append(session)
+
+    groups = []
+    for version_sessions in by_version.values():
+        count = max(1, min(len(version_sessions), round(workers * len(version_sessions) / len(sessions))))
+        groups.extend(version_sessions[index::count] for index in range(count))
+
+    return groups
+
+
+class Worker:
+    __slots__ = ('index', 'sessions', 'process', 'restarts', 'failures', 'started', 'restart_at', 'done')
+
+    def __init__(self, index: int, sessions: List[dict]) -> None:
+        self.index = index
+        self.sessions = sessions
+        self.process = None
+        self.restarts = 0
+        self.failures = 0
+        self.started = 0.0
+        self.restart_at = None
+        self.done = False
+
+
+class Supervisor:
+    """
+    Run many sessions in a pool of worker processes.
+
+    Sessions are spread over `workers` processes (one per CPU core by
+    default), each session on its own thread and Lua state, so handlers of
+    different processes run in parallel. A worker that dies is restarted
+    after `backoff` seconds, doubling on every failure in a row up to
+    `max_backoff`. Workers report the stats of their clients every
+    `stats_interval` seconds and the supervisor logs received updates per
+    second and queue depths per session.
+    """
+
+    # a worker that ran this long without failing starts over with the initial backoff
+    STABLE_AFTER = 60
+    # longest wait for a worker to exit before reports are read again
+    POLL_INTERVAL = 0.5
+
+    def __init__(self,
+                 sessions: List[dict],
+                 workers: int = 0,
+                 stats_interval: float = 30,
+                 backoff: float = 1,
+                 max_backoff: float = 60) -> None:
+
+        if not sessions:
+            raise ValueError('Expected at least one session.')
+
+        workers = workers or os.cpu_count() or 1
+
+        self.stats_interval = stats_interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.stats: Dict[str, dict] = {}
+        self._previous: Dict[tuple, int] = {}
+        self._reported = time.monotonic()
+
+        self._context = multiprocessing.get_context('spawn')
+        self._reports = self._context.Queue()
+        self._workers = [Worker(index, group) for index, group in enumerate(assign(sessions, workers))]
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: self._stopped.set())
+
+        logger.info('supervising %s sessions in %s workers',
+                    sum(len(worker.sessions) for worker in self._workers), len(self._workers))
+
+        for worker in self._workers:
+            self._start(worker)
+
+        try:
+            while not self._stopped.is_set() and not all(worker.done for worker in self._workers):
+                self._poll()
+
+        finally:
+            self.stop()
+
+    def stop(self) -> None:
+        self._stopped.set()
+
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout=10)
+
+    def _start(self, worker: Worker) -> None:
+        worker.restart_at = None
+        worker.started = time.monotonic()
+        worker.process = self._context.Process(target=run_worker,
+                                               args=(worker.index, worker.sessions, self._reports,
+                                                     self.stats_interval),
+                                               name='luagram-worker-%s' % worker.index,
+                                               daemon=True)
+        worker.process.start()
+        logger.info('worker %s started: %s', worker.index, ', '.join(session['name'] for session in worker.sessions))
+
+    def _poll(self) -> None:
+        now = time.monotonic()
+        running = [worker for worker in self._workers if worker.restart_at is None and not worker.done]
+
+        for worker in self._workers:
+            if worker.restart_at is not None and worker.restart_at <= now:
+                self._start(worker)
+
+        timeout = min([worker.restart_at - now for worker in self._workers if worker.restart_at is not None]
+                      + [self.POLL_INTERVAL])
+        wait([worker.process.sentinel for worker in running], timeout=max(timeout, 0))
+
+        self._drain_reports()
+
+        for worker in running:
+            if worker.process.is_alive():
+                continue
+
+            exitcode = worker.process.exitcode
+            if exitcode == 0:
+                logger.info('worker %s finished', worker.index)
+                worker.done = True
+                continue
+
+            if self._stopped.is_set():
+                continue
+
+            if time.monotonic() - worker.started > self.STABLE_AFTER:
+                worker.failures = 0
+
+            delay = min(self.backoff * 2 ** worker.failures, self.max_backoff)
+            worker.failures += 1
+            worker.restarts += 1
+            worker.restart_at = time.monotonic() + delay
+            logger.error('worker %s exited with %s, restarting in %ss', worker.index, exitcode, delay)
+
+        if time.monotonic() - self._reported >= self.stats_interval:
+            self._report()
+
+    def _drain_reports(self) -> None:
+        while True:
+            try:
+                kind, index, payload = self._reports.get_nowait()
+
+            except queue.Empty:
+                return
+
+            if kind == 'error':
+                logger.error('worker %s: session %s failed: %s', index, payload['session'], payload['error'])
+
+            else:
+                self.stats.update(payload)
+
+    def _report(self) -> None:
+        now = time.monotonic()
+        elapsed, self._reported = now - self._reported, now
+        total = 0.0
+
+        restarts = {session['name']: worker.restarts for worker in self._workers for session in worker.sessions}
+
+        for session, clients in sorted(self.stats.items()):
+            for name, stats in clients.items():
+                received = stats.get('received', 0)
+                rate = max(received - self._previous.get((session, name), received), 0) / elapsed
+                self._previous[session, name] = received
+                total += rate
+
+                logger.info('%s/%s: %.1f updates/s, queue %s, pending %s, restarts %s',
+                            session, name, rate, stats['updates_queue']['size'],
+                            stats['pending_queries']['size'], restarts.get(session, 0))
+
+        logger.info('total: %.1f updates/s', total)
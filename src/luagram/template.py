@@ -0,0 +1,124 @@
+import re
+from typing import TYPE_CHECKING, Optional, Dict, List
+
+from .response import Response
+from .gadget import tools
+from .gadget.luatable import to_python
+
+
+if TYPE_CHECKING:
+    from .luagram import LuagramClient
+
+
+SLOT = '@@luagram-slot-%s@@'
+_SLOT_PATTERN = re.compile(rb'"@@luagram-slot-(\w+)@@"')
+
+# slot name of the query id in `@extra`
+QUERY_ID = 'id'
+
+
+class Template:
+    """
+    A query encoded once, sent by filling in its parameters.
+
+    `params` maps parameter names to dotted paths inside the query
+    (`text = 'input_message_content.text.text'`); the value found there is
+    the default. Calling the template encodes only the parameters, splices
+    the next query id into the cached bytes and sends them, skipping the
+    table conversion and the full encode of every send. Upload dedup and the
+    query cache do not apply to prepared queries, and `Response.query` only
+    holds the `@type` and `chat_id`.
+    """
+
+    def __repr__(self) -> str:
+        return 'Template<%s, %s>' % (self.method, ', '.join(self.names))
+
+    def __init__(self,
+                 client: 'LuagramClient',
+                 query: dict,
+                 params: Dict[str, str],
+                 block: bool = True,
+                 timeout: Optional[float] = None) -> None:
+
+        self.client = client
+        self.block = bool(block)
+        self.timeout = timeout
+        self.method = query.get('@type')
+        if not isinstance(self.method, str):
+            raise ValueError('a prepared query needs an \'@type\'')
+
+        query = tools.copy_json(query)
+        self.names: List[str] = []
+        self.defaults: Dict[str, object] = {}
+
+        for index, (name, path) in enumerate(params.items()):
+            if not isinstance(path, str):
+                raise TypeError(f'Expected a string for the path of \'{name}\', but got {type(path).__name__} instead.')
+
+            container = query
+            *parents, key = path.split('.')
+            for parent in parents:
+                container = container.get(parent) if isinstance(container, dict) else None
+
+            if not isinstance(container, dict) or key not in container:
+                raise ValueError(f'Parameter \'{name}\': \'{path}\' is not set in the query.')
+
+            self.names.append(name)
+            self.defaults[name] = container[key]
+            container[key] = SLOT % index
+
+        # the parameter filling in `chat_id`, whatever its name, for the per-chat throttle
+        self._chat_id = next((name for name, path in params.items() if path == 'chat_id'), None)
+        self._static = {'@type': self.method}
+        if 'chat_id' in query and self._chat_id is None:
+            self._static['chat_id'] = query['chat_id']
+
+        extra = dict(query.get('@extra') or {})
+        extra['query_id'] = SLOT % QUERY_ID
+        query['@extra'] = extra
+
+        # bytes between the slots, and the slot each gap is followed by
+        pieces = _SLOT_PATTERN.split(client._tdjson.codec.dumps(query))
+        self._parts: List[bytes] = pieces[::2]
+        self._slots = [None if slot == QUERY_ID.encode() else int(slot) for slot in pieces[1::2]]
+
+        if len(self._slots) != len(self.names) + 1:
+            raise ValueError('a parameter default collides with the slot marker')
+
+    @tools.arguments
+    def __call__(self, **values) -> Response:
+        return self.send(values)
+
+    def send(self, values: Dict[str, object]) -> Response:
+        client = self.client
+        dumps = client._tdjson.codec.dumps
+
+        for name in values:
+            if name not in self.defaults:
+                raise TypeError(f'{self!r} got an unexpected parameter \'{name}\'.')
+
+        query_id = next(client._query_ids)
+        parts = self._parts
+        chunks = [parts[0]]
+
+        for index, slot in enumerate(self._slots):
+            if slot is None:
+                chunks.append(str(query_id).encode())
+
+            else:
+                name = self.names[slot]
+                value = values.get(name, self.defaults[name])
+                if tools.is_lua_table(value):
+                    value = to_python(value)
+
+                chunks.append(dumps(value))
+
+            chunks.append(parts[index + 1])
+
+        query = self._static
+        if self._chat_id is not None:
+            query = dict(query, chat_id=values.get(self._chat_id, self.defaults[self._chat_id]))
+
+        result = Response(query=query, client=client, query_id=query_id)
+        result.payload = b''.join(chunks)
+        return client._submit(result, block=self.block, timeout=self.timeout)
@@ -0,0 +1,176 @@
+import re
+import time
+import threading
+from logging import Logger
+from typing import Optional, Callable, Dict, Hashable
+
+from .response import Response
+from .gadget.scheduler import scheduler
+
+
+FLOOD_WAIT_PATTERN = re.compile(r'retry after (\d+)|FLOOD_WAIT_(\d+)', re.IGNORECASE)
+
+
+def flood_wait(update: dict) -> Optional[int]:
+    """Seconds to wait if `update` is a 429 flood-wait error."""
+    if update.get('@type') != 'error' or update.get('code') != 429:
+        return None
+
+    match = FLOOD_WAIT_PATTERN.search(update.get('message') or '')
+    if match:
+        return int(match.group(1) or match.group(2))
+
+
+class TokenBucket:
+    """
+    Allow `rate` sends per second with bursts of up to `burst`.
+
+    `reserve` always takes a token, possibly going into debt, and returns how
+    long the caller has to wait before using it, so reservations are served
+    in order.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: Optional[float] = None) -> None:
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now: float) -> float:
+        self.refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    @property
+    def full(self) -> bool:
+        return self.tokens >= self.burst
+
+
+class SendScheduler:
+    """
+    Pace outgoing queries and retry the ones TDLib answers with a flood wait.
+
+    Every query takes a token from the bucket of its method (`method_limits`)
+    and from the bucket of its `chat_id` (`chat_limit`); a query without
+    spare tokens is sent later from the shared scheduler thread instead of
+    blocking the caller. A 429 "retry after N" error blocks the method for N
+    seconds and sends the query again, up to `retries` times, while its
+    `Response` stays pending.
+    """
+
+    # per-chat buckets kept before idle ones are swept
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self,
+                 logger: Logger,
+                 send: Callable[[Response], None],
+                 fail: Callable[[Response, Exception], None],
+                 method_limits: Optional[Dict[str, float]] = None,
+                 chat_limit: Optional[float] = None,
+                 retries: int = 0,
+                 max_wait: float = 60) -> None:
+
+        self.logger = logger
+        self.retries = retries
+        self.max_wait = max_wait
+
+        self.delayed = 0
+        self.flood_waits = 0
+
+        self._send = send
+        self._fail = fail
+        self._lock = threading.Lock()
+        self._methods = {method: TokenBucket(rate) for method, rate in (method_limits or {}).items()}
+        self._chat_limit = chat_limit
+        self._chats: Dict[Hashable, TokenBucket] = {}
+        self._blocked: Dict[str, float] = {}
+
+    def submit(self, result: Response) -> None:
+        """Send the query of `result` now if its buckets allow it, later otherwise."""
+        delay = self._reserve(result.query)
+
+        if delay <= 0:
+            return self._send(result)
+
+        self.delayed += 1
+        scheduler.call_later(delay, self._send_later, result)
+
+    def retry(self, result: Response, update: dict) -> bool:
+        """Schedule `result` again if `update` is a flood wait it may still retry, return whether it did."""
+        seconds = flood_wait(update)
+        if seconds is None or result.retries >= self.retries or seconds > self.max_wait:
+            return False
+
+        method = result.query.get('@type')
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._blocked[method] = max(self._blocked.get(method, 0), until)
+
+        self.flood_waits += 1
+        result.retries += 1
+        self.logger.warning('query_id=%s %s: flood wait, retrying in %ss (%s/%s)',
+                            result.query_id, method, seconds, result.retries, self.retries)
+
+        scheduler.call_later(seconds, self._resubmit, result)
+        return True
+
+    def _reserve(self, query: dict) -> float:
+        method = query.get('@type')
+        chat_id = query.get('chat_id')
+
+        with self._lock:
+            now = time.monotonic()
+            delay = self._blocked.get(method, now) - now
+            if delay <= 0:
+                self._blocked.pop(method, None)
+
+            bucket = self._methods.get(method)
+            if bucket is not None:
+                delay = max(delay, bucket.reserve(now))
+
+            if self._chat_limit and chat_id is not None:
+                bucket = self._chats.get(chat_id)
+                if bucket is None:
+                    if len(self._chats) >= self.MAX_CHAT_BUCKETS:
+                        self._sweep(now)
+
+                    bucket = self._chats[chat_id] = TokenBucket(self._chat_limit)
+
+                delay = max(delay, bucket.reserve(now))
+
+        return delay
+
+    def _sweep(self, now: float) -> None:
+        # a full bucket behaves like a new one, dropping it loses nothing
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if bucket.full:
+                del self._chats[chat_id]
+
+    def _resubmit(self, result: Response) -> None:
+        if result.done:
+            return
+
+        delay = self._reserve(result.query)
+        if delay <= 0:
+            return self._send_later(result)
+
+        self.delayed += 1
+        scheduler.call_later(delay, self._send_later, result)
+
+    def _send_later(self, result: Response) -> None:
+        if result.done:
+            # timed out or evicted while waiting
+            return
+
+        try:
+            self._send(result)
+
+        except Exception as err:
+            self._fail(result, err)
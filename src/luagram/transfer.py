@@ -0,0 +1,339 @@
+import os
+import base64
+import threading
+import collections
+from typing import TYPE_CHECKING, Optional, Dict, List
+
+from .enums import Status
+from .loop import current_loop
+from .response import Future, Response
+from .cache import LRU
+from .gadget.tools import arguments
+from .gadget.scheduler import scheduler
+
+
+if TYPE_CHECKING:
+    from .luagram import LuagramClient
+
+
+class Transfer(Future):
+    """
+    A file download or upload followed through `updateFile`.
+
+    `file` is the latest TDLib `file` object, `update` holds it once the
+    transfer completed. Downloads can be read while they are running with
+    `chunks`, which hands out the downloaded prefix piece by piece. A
+    download of part of a file (`offset`, `limit`) completes once that part
+    is downloaded.
+    """
+
+    def __repr__(self) -> str:
+        return 'Transfer<%s, %s, %s>' % (self.kind, self.status, self.file_id)
+
+    def __init__(self, transfers: 'Transfers', kind: str, query: dict) -> None:
+        super().__init__()
+
+        self.kind = kind
+        self.query = query
+        self.file_id = query.get('file_id')
+        self.file = None
+        # the loop of the thread that asked for the transfer
+        self.loop = current_loop()
+        self._transfers = transfers
+        self._progress = threading.Condition()
+
+    @property
+    def completed(self) -> bool:
+        if self.file is None:
+            return False
+
+        if self.kind == 'download':
+            # a download of part of the file (`limit`) is done once that part is there
+            limited = self.query.get('limit', 0) > 0 and self.available >= self.end > 0
+            return limited or bool(self.file['local'].get('is_downloading_completed'))
+
+        return bool(self.file['remote'].get('is_uploading_completed'))
+
+    @property
+    def progress(self) -> int:
+        """Bytes transferred so far."""
+        if self.file is None:
+            return 0
+
+        if self.kind == 'download':
+            return self.file['local'].get('downloaded_size', 0)
+
+        return self.file['remote'].get('uploaded_size', 0)
+
+    @property
+    def size(self) -> int:
+        """Expected size in bytes, 0 while unknown."""
+        if self.file is None:
+            return 0
+
+        return self.file.get('size') or self.file.get('expected_size') or 0
+
+    @property
+    def end(self) -> int:
+        """End of the requested part of a download (the size for a whole file), 0 while unknown."""
+        limit = self.query.get('limit', 0)
+        if self.kind != 'download' or limit <= 0:
+            return self.size
+
+        end = self.query.get('offset', 0) + limit
+        return min(end, self.size) if self.size else end
+
+    @property
+    def available(self) -> int:
+        """End of the part of a download that can be read."""
+        if self.file is None:
+            return 0
+
+        local = self.file['local']
+        if local.get('is_downloading_completed'):
+            return self.file.get('size') or local.get('downloaded_size', 0)
+
+        return local.get('download_offset', 0) + local.get('downloaded_prefix_size', 0)
+
+    @arguments
+    def chunks(self, size: int = 1 << 20, offset: Optional[int] = None, timeout: Optional[float] = None) -> 'Chunks':
+        if self.kind != 'download':
+            raise ValueError('only downloads can be read in chunks')
+
+        if not isinstance(size, int):
+            raise TypeError(f'Expected a int for \'size\', but got {type(size).__name__} instead.')
+
+        if offset is None:
+            offset = self.query.get('offset', 0)
+
+        return Chunks(self, size, offset, timeout)
+
+    def cancel(self) -> None:
+        self._transfers.cancel(self)
+
+    def set_file(self, file: dict) -> None:
+        with self._progress:
+            self.file = file
+            self._progress.notify_all()
+
+        if self.completed and not self.done:
+            self.status = Status.OK
+            self.update = file
+            self._resolve()
+
+    def set_error(self, status: Status, error_info: dict) -> None:
+        if self.done:
+            return
+
+        self.status = status
+        self.error_info = error_info
+        self._resolve()
+
+        with self._progress:
+            self._progress.notify_all()
+
+    def wait_for(self, end: int, timeout: Optional[float] = None) -> bool:
+        """Block until the download is readable up to `end` (or completed, or failed)."""
+        with self._progress:
+            return self._progress.wait_for(lambda: self.available >= end or self.completed or
+                                           self.status is Status.ERROR or self.status is Status.TIMEOUT,
+                                           timeout=timeout)
+
+
+class Chunks:
+    """
+    Lua generic-for iterator over a download: `for chunk in transfer.chunks{size = 65536} do ... end`.
+
+    Reads the local file TDLib is writing as soon as the next `size` bytes
+    are there, so only one chunk is held in memory at a time. When the file
+    is not readable from this process the parts are fetched with
+    `readFilePart` instead.
+    """
+
+    def __init__(self, transfer: Transfer, size: int, offset: int, timeout: Optional[float]) -> None:
+        self.transfer = transfer
+        self.size = size
+        self.offset = offset
+        self.timeout = timeout
+        self._file = None
+
+    def __call__(self, *args) -> Optional[bytes]:
+        return self.next()
+
+    def next(self) -> Optional[bytes]:
+        transfer = self.transfer
+
+        while True:
+            if transfer.end and self.offset >= transfer.end:
+                return self.close()
+
+            end = self.offset + self.size
+            if transfer.end:
+                end = min(end, transfer.end)
+
+            if not transfer.wait_for(end, timeout=self.timeout) or transfer.status not in (Status.OK, Status.PENDING):
+                return self.close()
+
+            end = min(end, transfer.available)
+            if end > self.offset:
+                break
+
+            if transfer.completed:
+                return self.close()
+
+        chunk = self._read(self.offset, end - self.offset)
+        self.offset += len(chunk)
+        return chunk or self.close()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read(self, offset: int, count: int) -> bytes:
+        path = self.transfer.file['local'].get('path')
+
+        if self._file is None and path and os.path.isfile(path):
+            self._file = open(path, 'rb')
+
+        if self._file is not None:
+            self._file.seek(offset)
+            return self._file.read(count)
+
+        result = self.transfer._transfers.client._send_query({'@type': 'readFilePart',
+                                                             'file_id': self.transfer.file_id,
+                                                             'offset': offset,
+                                                             'count': count})
+        if result.status is not Status.OK:
+            self.transfer.set_error(result.status, result.error_info)
+            return b''
+
+        return base64.b64decode(result.update.get('data', ''))
+
+
+class Transfers:
+    """
+    Downloads and uploads of one client, at most `concurrency` of them running.
+
+    Transfers past the limit wait in a queue and are started as running ones
+    finish. Progress comes from `updateFile`, routed here by file id before the
+    update reaches the handlers; transfers of the same file all get it.
+    """
+
+    # updateFile updates kept for files whose transfer is not registered yet
+    ORPHANS = 256
+
+    def __init__(self, client: 'LuagramClient', concurrency: int = 4) -> None:
+        self.client = client
+        self.concurrency = concurrency
+
+        self._lock = threading.Lock()
+        self._running: Dict[int, List[Transfer]] = {}
+        self._count = 0
+        self._starting = 0
+        self._waiting = collections.deque()
+        self._orphans = LRU(self.ORPHANS)
+
+    @property
+    def active(self) -> bool:
+        return bool(self._running or self._starting or self._waiting)
+
+    def submit(self, transfer: Transfer) -> Transfer:
+        with self._lock:
+            if self._starting + self._count >= self.concurrency > 0:
+                self._waiting.append(transfer)
+                return transfer
+
+            self._starting += 1
+
+        self._start(transfer)
+        return transfer
+
+    def cancel(self, transfer: Transfer) -> None:
+        with self._lock:
+            if transfer in self._waiting:
+                self._waiting.remove(transfer)
+
+            # another download of the same file keeps TDLib's download going
+            shared = any(other is not transfer for other in self._running.get(transfer.file_id, ()))
+
+        if transfer.file_id is not None and not shared:
+            query = 'cancelDownloadFile' if transfer.kind == 'download' else 'cancelPreliminaryUploadFile'
+            self.client._send_query({'@type': query, 'file_id': transfer.file_id}, block=False)
+
+        transfer.set_error(Status.ERROR, {'@type': 'error', 'code': 406, 'message': 'Transfer cancelled'})
+        self._finish(transfer)
+
+    def feed(self, update: dict) -> None:
+        """Route an `updateFile` to its transfer."""
+        file = update.get('file')
+        if not isinstance(file, dict):
+            return
+
+        with self._lock:
+            transfers = self._running.get(file.get('id'))
+            if transfers is None:
+                if self._starting:
+                    self._orphans.put(file.get('id'), file)
+
+                return
+
+        for transfer in transfers:
+            transfer.set_file(file)
+            if transfer.done:
+                self._finish(transfer)
+
+    def _start(self, transfer: Transfer) -> None:
+        response = self.client._send_query(transfer.query, block=False)
+        response.on_done(lambda result: self._started(transfer, result))
+
+    def _started(self, transfer: Transfer, result: Response) -> None:
+        with self._lock:
+            self._starting -= 1
+
+            if result.status is Status.OK and not transfer.done:
+                file = result.update
+                transfer.file_id = file.get('id')
+                # a list replaced on change, `feed` iterates it without the lock
+                self._running[transfer.file_id] = [*self._running.get(transfer.file_id, ()), transfer]
+                self._count += 1
+
+                # an updateFile may have overtaken the answer
+                newer = self._orphans.pop(transfer.file_id)
+                if newer is not None:
+                    file = newer
+
+        if result.status is not Status.OK:
+            transfer.set_error(result.status, result.error_info)
+
+        elif not transfer.done:
+            transfer.set_file(file)
+
+        if transfer.done:
+            self._finish(transfer)
+
+    def _finish(self, transfer: Transfer) -> None:
+        with self._lock:
+            transfers = self._running.get(transfer.file_id, ())
+            if transfer in transfers:
+                self._count -= 1
+                transfers = [other for other in transfers if other is not transfer]
+                if transfers:
+                    self._running[transfer.file_id] = transfers
+
+                else:
+                    del self._running[transfer.file_id]
+
+            if not self._waiting or self._starting + self._count >= self.concurrency > 0:
+                return
+
+            transfer = self._waiting.popleft()
+            self._starting += 1
+
+        if scheduler.in_thread():
+            # a timed out start resolves on the scheduler, which must not wait for a pending slot
+            transfer.loop.call_soon(self._start, transfer)
+            return
+
+        self._start(transfer)
+
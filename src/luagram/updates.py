@@ -0,0 +1,222 @@
+import time
+import queue
+import threading
+import collections
+from logging import Logger
+from typing import Optional, Dict, Tuple, Iterable, Callable, Union, List
+
+from .enums import QueuePolicy
+
+
+# updates superseded by a newer update with the same key, the latest one is enough
+COALESCE_KEYS: Dict[str, Tuple[str, ...]] = {
+    'updateOption': ('name',),
+    'updateUserStatus': ('user_id',),
+    'updateUserFullInfo': ('user_id',),
+    'updateChatLastMessage': ('chat_id',),
+    'updateChatReadInbox': ('chat_id',),
+    'updateChatReadOutbox': ('chat_id',),
+    'updateChatPhoto': ('chat_id',),
+    'updateChatTitle': ('chat_id',),
+    'updateChatPermissions': ('chat_id',),
+    'updateChatUnreadMentionCount': ('chat_id',),
+    'updateChatUnreadReactionCount': ('chat_id',),
+    'updateChatOnlineMemberCount': ('chat_id',),
+    'updateChatNotificationSettings': ('chat_id',),
+    'updateMessageInteractionInfo': ('chat_id', 'message_id'),
+    'updateConnectionState': (),
+    'updateFile': ('file.id',)
+}
+
+
+def coalesce_key(update: dict, fields: Tuple[str, ...]) -> tuple:
+    key = [update.get('@type')]
+
+    for field in fields:
+        value = update
+        for name in field.split('.'):
+            value = value.get(name) if isinstance(value, dict) else None
+
+        key.append(value)
+
+    return tuple(key)
+
+
+class UpdatesQueue:
+    """
+    Bounded queue between the listener and `get_updates`.
+
+    When full, `policy` decides whether `put` blocks (dropping the update
+    after `put_timeout`), drops the oldest or the incoming update, or drops
+    the update with the lowest priority. With coalescing enabled an update
+    replaces the queued update it supersedes (see `COALESCE_KEYS`) in place
+    instead of taking a new slot.
+    """
+
+    def __init__(self,
+                 logger: Logger,
+                 maxsize: int = 0,
+                 policy: QueuePolicy = QueuePolicy.BLOCK,
+                 put_timeout: Optional[float] = None,
+                 priorities: Optional[Dict[str, int]] = None,
+                 coalesce: Optional[Iterable[str]] = None) -> None:
+
+        self.logger = logger
+        self.maxsize = maxsize
+        self.policy = policy
+        self.put_timeout = put_timeout
+        self.priorities = dict(priorities or {})
+        self.coalesce = {update_type: COALESCE_KEYS[update_type] for update_type in coalesce or ()}
+
+        self.dropped = 0
+        self.coalesced = 0
+        # set by `close`, a blocked put gives up and later ones drop instead of waiting
+        self.closed = False
+
+        self._items = collections.deque()
+        self._tasks = collections.deque()
+        self._keys = {}
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def put(self, update: dict, block: bool = True) -> bool:
+        """
+        Queue `update`, return False if it (or nothing) was dropped instead.
+        With `block` false a full queue drops the update under the `block`
+        policy rather than waiting for room.
+        """
+        with self._lock:
+            queued = self._put(update, block)
+            self._not_empty.notify()
+            return queued
+
+    def put_many(self, updates: List[dict]) -> int:
+        """Queue a batch of updates under one lock and one wakeup, return how many were queued."""
+        with self._lock:
+            queued = 0
+            for update in updates:
+                queued += self._put(update)
+
+            self._not_empty.notify()
+            return queued
+
+    def close(self) -> None:
+        """Stop waiting for room: a put blocked on a full queue returns, and later ones no longer block."""
+        with self._lock:
+            self.closed = True
+            self._not_full.notify_all()
+            self._not_empty.notify_all()
+
+    def put_task(self, task: Callable) -> None:
+        """Queue a task for the consumer thread, tasks are never dropped or coalesced."""
+        with self._lock:
+            self._tasks.append(task)
+            self._not_empty.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Union[dict, Callable]:
+        with self._not_empty:
+            if not self._not_empty.wait_for(self._ready, timeout=timeout):
+                raise queue.Empty
+
+            if self._tasks:
+                return self._tasks.popleft()
+
+            key, update = self._pop(0)
+            self._not_full.notify()
+            return update
+
+    def get_many(self, limit: int, timeout: Optional[float] = None) -> List[Union[dict, Callable]]:
+        """Every queued task, then up to `limit` updates, waiting like `get` for the first item."""
+        with self._not_empty:
+            if not self._not_empty.wait_for(self._ready, timeout=timeout):
+                raise queue.Empty
+
+            items = list(self._tasks)
+            self._tasks.clear()
+
+            for _ in range(min(limit, len(self._items))):
+                key, update = self._pop(0)
+                items.append(update)
+
+            self._not_full.notify_all()
+            return items
+
+    def _put(self, update: dict, block: bool = True) -> bool:
+        fields = self.coalesce.get(update.get('@type'))
+        key = None if fields is None else coalesce_key(update, fields)
+
+        if key is not None:
+            entry = self._keys.get(key)
+            if entry is not None:
+                entry[1] = update
+                self.coalesced += 1
+                return True
+
+        if 0 < self.maxsize <= len(self._items) and not self._make_room(update, block):
+            self.dropped += 1
+            self.logger.debug('updates queue is full, dropped %s', update.get('@type'))
+            return False
+
+        entry = [key, update]
+        self._items.append(entry)
+        if key is not None:
+            self._keys[key] = entry
+
+        return True
+
+    def _ready(self) -> bool:
+        return bool(self._tasks or self._items)
+
+    def _pop(self, index: int) -> list:
+        if index == 0:
+            entry = self._items.popleft()
+
+        else:
+            entry = self._items[index]
+            del self._items[index]
+
+        if entry[0] is not None and self._keys.get(entry[0]) is entry:
+            del self._keys[entry[0]]
+
+        return entry
+
+    def _make_room(self, update: dict, block: bool = True) -> bool:
+        if self.policy is QueuePolicy.BLOCK:
+            if not block:
+                return False
+
+            deadline = None if self.put_timeout is None else time.monotonic() + self.put_timeout
+            # the consumer may not have been woken for the rest of a batch yet
+            self._not_empty.notify()
+            while len(self._items) >= self.maxsize:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if self.closed or timeout is not None and timeout <= 0:
+                    return False
+
+                self._not_full.wait(timeout)
+
+            return True
+
+        elif self.policy is QueuePolicy.DROP_NEWEST:
+            return False
+
+        elif self.policy is QueuePolicy.DROP_OLDEST:
+            self._pop(0)
+
+        else:
+            priority = self.priorities.get(update.get('@type'), 0)
+            lowest, index = min((self.priorities.get(entry[1].get('@type'), 0), index)
+                                for index, entry in enumerate(self._items))
+
+            if priority <= lowest:
+                return False
+
+            self._pop(index)
+
+        self.dropped += 1
+        return True
@@ -0,0 +1,60 @@
+from src.luagram.cache import EntityCache
+
+
+def message(chat_id: int, message_id: int, text: str = 'hi') -> dict:
+    return {'@type': 'message', 'chat_id': chat_id, 'id': message_id,
+            'content': {'@type': 'messageText', 'text': {'@type': 'formattedText', 'text': text}}}
+
+
+def cached(cache: EntityCache, chat_id: int, message_id: int):
+    return cache.lookup({'@type': 'getMessage', 'chat_id': chat_id, 'message_id': message_id})
+
+
+def test_message_updates_drop_the_cached_message():
+    updates = [
+        {'@type': 'updateMessageInteractionInfo', 'chat_id': 1, 'message_id': 10, 'interaction_info': None},
+        {'@type': 'updateMessageIsPinned', 'chat_id': 1, 'message_id': 10, 'is_pinned': True},
+        {'@type': 'updateMessageContentOpened', 'chat_id': 1, 'message_id': 10},
+        {'@type': 'updateMessageMentionRead', 'chat_id': 1, 'message_id': 10, 'unread_mention_count': 0},
+        {'@type': 'updateMessageUnreadReactions', 'chat_id': 1, 'message_id': 10, 'unread_reactions': []},
+    ]
+
+    for update in updates:
+        cache = EntityCache()
+        assert cache.wants(update['@type'])
+
+        cache.feed({'@type': 'updateNewMessage', 'message': message(1, 10)})
+        assert cached(cache, 1, 10) is not None
+
+        cache.feed(update)
+        assert cached(cache, 1, 10) is None, update['@type']
+
+
+def test_send_failed_replaces_the_pending_message():
+    cache = EntityCache()
+    cache.feed({'@type': 'updateNewMessage', 'message': message(1, 5)})
+    cache.feed({'@type': 'updateMessageSendFailed', 'message': message(1, 6), 'old_message_id': 5,
+                'error': {'@type': 'error', 'code': 400, 'message': 'failed'}})
+
+    assert cached(cache, 1, 5) is None
+    assert cached(cache, 1, 6)['id'] == 6
+
+
+def test_patched_message_keeps_the_update():
+    cache = EntityCache()
+    cache.feed({'@type': 'updateNewMessage', 'message': message(1, 10)})
+    cache.feed({'@type': 'updateMessageContent', 'chat_id': 1, 'message_id': 10,
+                'new_content': {'@type': 'messageText', 'text': {'@type': 'formattedText', 'text': 'edited'}}})
+
+    assert cached(cache, 1, 10)['content']['text']['text'] == 'edited'
+
+
+def test_callers_get_copies():
+    cache = EntityCache()
+    cache.feed({'@type': 'updateNewMessage', 'message': message(1, 10)})
+
+    cached(cache, 1, 10)['content']['text']['text'] = 'changed'
+    cache.message(1, 10)['id'] = 11
+
+    assert cached(cache, 1, 10)['content']['text']['text'] == 'hi'
+    assert cache.message(1, 10)['id'] == 10
@@ -0,0 +1,53 @@
+import logging
+
+from src.luagram.dispatcher import Dispatcher, Handler
+
+
+logger = logging.getLogger('luagram.test')
+
+
+def message(chat_id: int) -> dict:
+    return {'@type': 'updateNewMessage', 'message': {'@type': 'message', 'chat_id': chat_id, 'id': 1}}
+
+
+def test_filtered_handler_removed_twice_keeps_filtering():
+    dispatcher = Dispatcher(logger)
+    calls = []
+
+    kept = dispatcher.add(Handler(lambda update: calls.append(update), ['updateNewMessage'], {'chat_ids': [1]}))
+    removed = dispatcher.add(Handler(lambda update: None, ['updateNewMessage'], {'chat_ids': [2]}))
+
+    dispatcher.remove(removed)
+    dispatcher.remove(removed)
+    dispatcher.dispatch(message(5))
+    dispatcher.dispatch(message(1))
+
+    assert [update['message']['chat_id'] for update in calls] == [1]
+    assert kept.filter is not None
+
+
+def test_removing_a_foreign_handler_keeps_filtering():
+    # the compiled handlers of get_updates are removed from whichever dispatcher a reload swapped in
+    previous, current = Dispatcher(logger), Dispatcher(logger)
+    calls = []
+
+    stale = previous.add(Handler(lambda update: None, ['updateNewMessage'], {'chat_ids': [2]}))
+    current.add(Handler(lambda update: calls.append(update), ['updateNewMessage'], {'chat_ids': [1]}))
+
+    current.remove(stale)
+    current.dispatch(message(5))
+
+    assert calls == []
+
+
+def test_batch_handler_gets_the_matching_updates_once():
+    dispatcher = Dispatcher(logger)
+    batches, singles = [], []
+
+    dispatcher.add(Handler(lambda updates: batches.append(list(updates)), ['updateNewMessage'], {'chat_ids': [1]}, batch=True))
+    dispatcher.add(Handler(lambda update: singles.append(update), ['updateNewMessage']))
+
+    dispatcher.dispatch_many([message(1), message(5), message(1)])
+
+    assert len(singles) == 3
+    assert [len(batch) for batch in batches] == [2]
@@ -0,0 +1,74 @@
+import logging
+import threading
+
+from src.luagram.enums import Status, QueuePolicy
+from src.luagram.pending import PendingQueries, resolving
+from src.luagram.response import Response
+
+
+class Client:
+    logger = logging.getLogger('luagram.test')
+
+
+def query(query_id: int) -> Response:
+    return Response(query={'@type': 'getMe'}, client=Client(), query_id=query_id)
+
+
+def test_drop_newest_rejects_queries_at_the_limit():
+    pending = PendingQueries(Client.logger, max_size=1, policy=QueuePolicy.DROP_NEWEST)
+
+    assert pending.add(query(1))
+    assert not pending.add(query(2))
+    assert pending.rejected == 1 and 1 in pending and 2 not in pending
+
+
+def test_drop_oldest_gives_up_on_the_oldest_query():
+    pending = PendingQueries(Client.logger, max_size=1, policy=QueuePolicy.DROP_OLDEST)
+    oldest = query(1)
+
+    pending.add(oldest)
+    assert pending.add(query(2))
+
+    assert oldest.status is Status.TIMEOUT
+    assert pending.expired == 1 and 2 in pending and 1 not in pending
+
+
+def test_block_waits_for_a_free_slot():
+    pending = PendingQueries(Client.logger, max_size=1, policy=QueuePolicy.BLOCK)
+    pending.add(query(1))
+    added = []
+
+    sender = threading.Thread(target=lambda: added.append(pending.add(query(2))))
+    sender.start()
+    sender.join(timeout=0.1)
+    assert sender.is_alive()
+
+    pending.pop(1)
+    sender.join(timeout=5)
+    assert added == [True] and 2 in pending
+
+
+def test_resolving_thread_goes_over_the_limit():
+    pending = PendingQueries(Client.logger, max_size=1, policy=QueuePolicy.BLOCK, timeout=5)
+    pending.add(query(1))
+    added = []
+
+    def resolve():
+        resolving.active = True
+        added.append(pending.add(query(2)))
+
+    listener = threading.Thread(target=resolve)
+    listener.start()
+    listener.join(timeout=1)
+
+    assert added == [True] and len(pending) == 2
+
+
+def test_expired_query_resolves_with_a_timeout():
+    pending = PendingQueries(Client.logger)
+    result = query(1)
+
+    pending.add(result, timeout=0.05)
+
+    assert result.wait() is result
+    assert result.status is Status.TIMEOUT and 1 not in pending
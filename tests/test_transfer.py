@@ -0,0 +1,73 @@
+import logging
+
+from src.luagram.enums import Status
+from src.luagram.response import Response
+from src.luagram.transfer import Transfer, Transfers
+
+
+class Client:
+    """Answers nothing by itself, the test resolves the queries it sent."""
+
+    def __init__(self) -> None:
+        self.logger = logging.getLogger('luagram.test')
+        self.sent = []
+
+    def _send_query(self, query: dict, block: bool = True, timeout=None) -> Response:
+        result = Response(query=query, client=self, query_id=len(self.sent))
+        self.sent.append(result)
+        return result
+
+
+def file(file_id: int, completed: bool = False) -> dict:
+    return {'@type': 'file', 'id': file_id, 'size': 10,
+            'local': {'is_downloading_completed': completed, 'downloaded_size': 10 if completed else 0},
+            'remote': {}}
+
+
+def download(transfers: Transfers, file_id: int) -> Transfer:
+    return transfers.submit(Transfer(transfers, 'download', {'@type': 'downloadFile', 'file_id': file_id}))
+
+
+def test_downloads_of_the_same_file_both_complete():
+    client = Client()
+    transfers = Transfers(client, concurrency=4)
+
+    first, second = download(transfers, 7), download(transfers, 7)
+    for result in client.sent:
+        result.set_update(file(7))
+
+    transfers.feed({'@type': 'updateFile', 'file': file(7, completed=True)})
+
+    assert first.status is Status.OK and second.status is Status.OK
+    assert not transfers.active
+
+
+def test_cancelling_one_download_keeps_the_other_going():
+    client = Client()
+    transfers = Transfers(client, concurrency=4)
+
+    first, second = download(transfers, 7), download(transfers, 7)
+    for result in client.sent:
+        result.set_update(file(7))
+
+    first.cancel()
+    transfers.feed({'@type': 'updateFile', 'file': file(7, completed=True)})
+
+    assert [result.query['@type'] for result in client.sent] == ['downloadFile', 'downloadFile']
+    assert first.status is Status.ERROR and second.status is Status.OK
+
+
+def test_a_waiting_download_starts_once_one_finishes():
+    client = Client()
+    transfers = Transfers(client, concurrency=1)
+
+    first, second = download(transfers, 7), download(transfers, 7)
+    assert len(client.sent) == 1
+
+    client.sent[0].set_update(file(7))
+    transfers.feed({'@type': 'updateFile', 'file': file(7, completed=True)})
+    assert first.status is Status.OK and len(client.sent) == 2
+
+    client.sent[1].set_update(file(7, completed=True))
+    assert second.status is Status.OK
+    assert not transfers.active
@@ -0,0 +1,67 @@
+import logging
+import threading
+
+from src.luagram.enums import QueuePolicy
+from src.luagram.updates import UpdatesQueue
+
+
+logger = logging.getLogger('luagram.test')
+
+
+def message(message_id: int) -> dict:
+    return {'@type': 'updateNewMessage', 'message': {'chat_id': 1, 'id': message_id}}
+
+
+def test_drop_oldest_keeps_the_newest_updates():
+    updates = UpdatesQueue(logger, maxsize=2, policy=QueuePolicy.DROP_OLDEST)
+
+    for message_id in range(4):
+        assert updates.put(message(message_id))
+
+    assert [update['message']['id'] for update in updates.get_many(10)] == [2, 3]
+    assert updates.dropped == 2
+
+
+def test_drop_newest_refuses_updates_at_the_limit():
+    updates = UpdatesQueue(logger, maxsize=1, policy=QueuePolicy.DROP_NEWEST)
+
+    assert updates.put(message(0))
+    assert not updates.put(message(1))
+    assert [update['message']['id'] for update in updates.get_many(10)] == [0]
+    assert updates.dropped == 1
+
+
+def test_coalesced_update_replaces_the_queued_one_in_place():
+    updates = UpdatesQueue(logger, maxsize=2, coalesce=['updateChatTitle'])
+
+    updates.put({'@type': 'updateChatTitle', 'chat_id': 1, 'title': 'old'})
+    updates.put(message(0))
+    updates.put({'@type': 'updateChatTitle', 'chat_id': 1, 'title': 'new'})
+
+    queued = updates.get_many(10)
+    assert [update.get('title') for update in queued] == ['new', None]
+    assert updates.coalesced == 1 and updates.dropped == 0
+
+
+def test_tasks_come_before_updates():
+    updates = UpdatesQueue(logger)
+    task = lambda: None
+
+    updates.put(message(0))
+    updates.put_task(task)
+
+    assert updates.get_many(10) == [task, message(0)]
+
+
+def test_close_releases_a_blocked_put():
+    updates = UpdatesQueue(logger, maxsize=1, policy=QueuePolicy.BLOCK)
+    updates.put(message(0))
+    results = []
+
+    producer = threading.Thread(target=lambda: results.append(updates.put(message(1))))
+    producer.start()
+    updates.close()
+    producer.join(timeout=5)
+
+    assert results == [False]
+    assert not updates.put(message(2))